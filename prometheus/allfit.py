@@ -19,19 +19,21 @@ import astropy.units as u
 from scipy.optimize import curve_fit, least_squares
 from scipy.interpolate import interp1d
 from scipy import sparse
+from scipy.spatial import cKDTree
 #from astropy.nddata import CCDData as CCD,StdDevUncertainty
 from dlnpyutils import utils as dln, bindata
 import copy
 import logging
 import time
+import multiprocessing
+from numba import set_num_threads
 import matplotlib
 import sep
 from photutils.aperture import CircularAnnulus
 from astropy.stats import sigma_clipped_stats
 from . import leastsquares as lsq
-from . import groupfit,utils
+from . import groupfit,utils,utils_numba,models_numba as mnb
 from .ccddata import CCDData,BoundingBox
-from photutils.psf.groupstars import DAOGroup
 
 # Fit a PSF model to all stars in an image
 
@@ -50,10 +52,257 @@ def cutoutbbox(image,psf,cat):
     yhi = np.minimum(int(np.round(ymax)+hpsfpix),ny)
 
     return BoundingBox(xlo,xhi,ylo,yhi)
+
+
+def groupstars(x,y,crit_separation):
+    """
+    Group stars that are closer than a critical separation, directly or through
+    other stars, like photutils' DAOGroup.  The close pairs are found with
+    a KD-tree and linked with union-find.
+
+    Parameters
+    ----------
+    x : numpy array
+       X positions of the stars.
+    y : numpy array
+       Y positions of the stars.
+    crit_separation : float
+       Stars closer than this (in pixels) are put in the same group.
+
+    Returns
+    -------
+    groupid : numpy array
+       Group ID of each star, starting at 1.
+
+    Example
+    -------
+
+    groupid = groupstars(cat['x'],cat['y'],2.5*psf.fwhm())
+
+    """
+    X = np.vstack((np.asarray(x,float),np.asarray(y,float))).T
+    kdt = cKDTree(X)
+    pairs = kdt.query_pairs(crit_separation,output_type='ndarray')
+    # All stars are isolated
+    if len(pairs)==0:
+        return np.arange(len(X))+1
+    # query_pairs includes pairs at exactly the separation
+    dist = np.sqrt(np.sum((X[pairs[:,0]]-X[pairs[:,1]])**2,axis=1))
+    pairs = pairs[dist<crit_separation]
+    return utils_numba.pairgroups(len(X),pairs)
+
+
+def fitgroup(psf,image,inpcat,method='qr',fitradius=None,recenter=True,maxiter=10,
+             minpercdiff=0.5,reskyiter=2,nofreeze=False,skyfit=True,verbose=False):
+    """
+    Fit a single group of stars (or a single star).
+
+    Parameters
+    ----------
+    psf : PSF object
+       PSF object with initial parameters to use.
+    image : CCDData object
+       Image to fit the stars in, normally with the other groups subtracted.
+    inpcat : table
+       Catalog with initial amp/x/y values for the stars in the group.
+    The other parameters are the same as for fit().
+
+    Returns
+    -------
+    out : table
+       Table of best-fitting parameters for each star.
+    model : CCDData object
+       Best-fitting model of the stars (no sky).
+    sky : numpy array or float
+       Best-fitting sky.
+
+    Example
+    -------
+
+    out,model,sky = fitgroup(psf,image,inpcat)
+
+    """
+    # Single Star
+    if len(inpcat)==1:
+        pars = [inpcat['amp'][0],inpcat['x'][0],inpcat['y'][0]]
+        out,model = psf.fit(image,pars,niter=3,verbose=verbose,retfullmodel=True,recenter=recenter)
+        model.data -= out['sky']   # remove sky
+        sky = out['sky']
+    # Group
+    else:
+        bbox = cutoutbbox(image,psf,inpcat)
+        out,model,sky = groupfit.fit(psf,image[bbox.slices],inpcat,method=method,fitradius=fitradius,
+                                     recenter=recenter,maxiter=maxiter,minpercdiff=minpercdiff,
+                                     reskyiter=reskyiter,nofreeze=nofreeze,verbose=verbose,
+                                     skyfit=skyfit,absolute=True)
+    return out,model,sky
+
+
+def fitstars(psf,image,inpcat,recenter=True,niter=3,minpercdiff=0.5):
+    """
+    Fit many isolated stars at once.  This gives the same fits as psf.fit()
+    for each star, but all of the stars are fit in one parallel numba call.
+    The PSF must have a numba model (see groupfit.numbapsftype()).
+
+    Parameters
+    ----------
+    psf : PSF object
+       PSF object with initial parameters to use.
+    image : CCDData object
+       Image to fit the stars in.
+    inpcat : numpy array
+       Catalog with initial amp/x/y values for the stars.
+    recenter : boolean, optional
+       Allow the centroids to be fit.  Default is True.
+    niter : int, optional
+       Maximum number of iterations.  Default is 3.
+    minpercdiff : float, optional
+       Minimum percent change in the parameters to allow until the solution is
+       considered converged.  Default is 0.5.
+
+    Returns
+    -------
+    out : numpy array
+       Catalog of best-fitting parameters for each star.  Stars whose fit
+         failed have NaN parameters and are not included in the images.
+    modelim : numpy array
+       Image of the best-fitting models of the stars (no sky).
+    skyim : numpy array
+       Image of the best-fitting sky over the PSF region of each star, and
+         NaN elsewhere.
+
+    Example
+    -------
+
+    out,modelim,skyim = fitstars(psf,image,inpcat)
+
+    """
+    nstars = len(inpcat)
+    ny,nx = image.shape
+    xcen = np.array(inpcat['x'],float)
+    ycen = np.array(inpcat['y'],float)
+    # Fitting boxes, the same as psf.fit()
+    radius = np.maximum(psf.fwhm(),1)
+    x,y,inbox = groupfit.stargrid(xcen,ycen,radius,image.shape)
+    npixstar = np.sum(inbox,axis=(1,2))
+    offsets = np.concatenate(([0],np.cumsum(npixstar)))
+    xflat = x[inbox]
+    yflat = y[inbox]
+    flux = np.array(image.data[yflat,xflat],float)
+    err = np.array(image.error[yflat,xflat],float)
+    # Initial sky, median of the sky image in the box
+    skybox = np.full(inbox.shape,np.nan)
+    skybox[inbox] = image.sky[yflat,xflat]
+    initpars = np.zeros((nstars,4),float)
+    initpars[:,0] = inpcat['amp']
+    initpars[:,1] = xcen
+    initpars[:,2] = ycen
+    initpars[:,3] = np.nanmedian(skybox,axis=(1,2))
+    # Bounds, the box edges for the centers
+    bounds = np.zeros((nstars,2,4),float)
+    bounds[:,1,0] = np.inf
+    bounds[:,0,1] = np.min(np.where(inbox,x,nx),axis=(1,2))
+    bounds[:,1,1] = np.max(np.where(inbox,x,-1),axis=(1,2))
+    bounds[:,0,2] = np.min(np.where(inbox,y,ny),axis=(1,2))
+    bounds[:,1,2] = np.max(np.where(inbox,y,-1),axis=(1,2))
+    bounds[:,0,3] = -np.inf
+    bounds[:,1,3] = np.inf
+    # Not fitting centroids
+    if recenter==False:
+        bounds[:,0,1:3] = initpars[:,1:3]-1e-7
+        bounds[:,1,1:3] = initpars[:,1:3]+1e-7
+    # Maximum steps, like psf.steps(), halved up to three times
+    #  if they cross a boundary
+    initsteps = np.zeros((nstars,4),float)
+    initsteps[:,0] = initpars[:,0]*0.5
+    initsteps[:,1:3] = 0.5
+    initsteps[:,3] = np.maximum(initpars[:,3]*0.5,50)
+    maxsteps = initsteps.copy()
+    for sign in [-1,1]:
+        newpars = initpars+sign*initsteps
+        for count in range(3):
+            bad = (newpars<=bounds[:,0,:]) | (newpars>=bounds[:,1,:])
+            maxsteps[bad] /= 2
+            newpars = initpars+sign*maxsteps
+
+    # Fit all of the stars
+    psftype = groupfit.numbapsftype(psf)
+    psfparams = np.array(psf.params,float)
+    outpars = np.zeros((nstars,4),float)
+    outerror = np.zeros((nstars,4),float)
+    outchisq = np.zeros(nstars,float)
+    outrms = np.zeros(nstars,float)
+    outniter = np.zeros(nstars,int)
+    mnb.starfit_flat(xflat.astype(float),yflat.astype(float),flux,err,offsets,psftype,
+                     psfparams,float(psf.radius),initpars,bounds,maxsteps,niter,minpercdiff,
+                     outpars,outerror,outchisq,outrms,outniter)
+
+    # Output catalog
+    dt = np.dtype([('amp',float),('amp_error',float),('x',float),('x_error',float),
+                   ('y',float),('y_error',float),('sky',float),('flux',float),
+                   ('flux_error',float),('mag',float),('mag_error',float),
+                   ('niter',int),('rms',float),('chisq',float)])
+    out = np.zeros(nstars,dtype=dt)
+    for i,n in enumerate(['amp','x','y','sky']):
+        out[n] = outpars[:,i]
+        if n != 'sky':
+            out[n+'_error'] = outerror[:,i]
+    out['flux'] = out['amp']*psf.flux()
+    out['flux_error'] = out['amp_error']*psf.flux()
+    out['mag'] = -2.5*np.log10(np.maximum(out['flux'],1e-10))+25.0
+    out['mag_error'] = (2.5/np.log(10))*out['flux_error']/out['flux']
+    out['niter'] = outniter
+    out['rms'] = outrms
+    out['chisq'] = outchisq
+
+    # Models over the full PSF region, only for the stars that were fit
+    good = np.all(np.isfinite(outpars),axis=1)
+    hpsfnpix = psf.npix//2
+    fx,fy,fmask = groupfit.stargrid(np.where(good,outpars[:,1],-2*hpsfnpix-2),
+                                    np.where(good,outpars[:,2],-2*hpsfnpix-2),hpsfnpix,image.shape)
+    # The sky is set over the whole box, in order of the stars
+    skyim = np.full(image.shape,np.nan)
+    skyim[fy[fmask],fx[fmask]] = np.repeat(outpars[:,3],np.sum(fmask,axis=(1,2)))
+    # PSF corners are zero
+    fmask &= np.sqrt( (fx-outpars[:,1].reshape(-1,1,1))**2 +
+                      (fy-outpars[:,2].reshape(-1,1,1))**2 ) <= psf.radius
+    fnpix = np.sum(fmask,axis=(1,2))
+    foffsets = np.concatenate(([0],np.cumsum(fnpix)))
+    fxflat = fx[fmask]
+    fyflat = fy[fmask]
+    allpars = np.zeros((nstars,3+len(psfparams)),float)
+    allpars[:,:3] = outpars[:,:3]
+    allpars[:,3:] = psfparams
+    mflat = np.zeros(len(fxflat),float)
+    mnb.amodel2d_flat(fxflat.astype(float),fyflat.astype(float),foffsets,np.where(good)[0],
+                      psftype,allpars,0,mflat,np.zeros((len(fxflat),3),float))
+    modelim = np.bincount(fyflat*nx+fxflat,weights=mflat,minlength=ny*nx).reshape(ny,nx)
+
+    return out,modelim,skyim
+
+
+# The image and PSF are sent to each worker process once
+pooldata = {}
+
+def initpool(psf,image,databuf=None):
+    """ Save the PSF and image in a worker process.  If DATABUF is input,
+        the image data are replaced by this shared memory buffer."""
+    if databuf is not None:
+        image.data = np.frombuffer(databuf,dtype=image.data.dtype).reshape(image.shape)
+    pooldata['psf'] = psf
+    pooldata['image'] = image
+    # One numba thread per worker, the processes already use all the cores
+    set_num_threads(1)
+
+def poolfitgroup(args):
+    """ Fit one group in a worker process, args are (group index, catalog, keywords)."""
+    g,inpcat,kwargs = args
+    out,model,sky = fitgroup(pooldata['psf'],pooldata['image'],inpcat,**kwargs)
+    return g,out,model,sky
     
     
 def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minpercdiff=0.5,
-        reskyiter=2,nofreeze=False,skyfit=True,verbose=False):
+        reskyiter=2,nofreeze=False,skyfit=True,nproc=1,verbose=False):
     """
     Fit PSF to all stars in an image.
 
@@ -70,7 +319,8 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
        To pre-group the stars, add a "group_id" in the catalog.
     method : str, optional
        Method to use for solving the non-linear least squares problem: "cholesky",
-       "qr", "svd", and "curve_fit".  Default is "cholesky".
+       "qr", "svd" (complete orthogonal decomposition), "svd_full"
+       (explicit SVD), and "curve_fit".  Default is "cholesky".
     fitradius : float, optional
        The fitting radius in pixels.  By default the PSF FWHM is used.
     recenter : boolean, optional
@@ -88,6 +338,13 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
        Do not freeze any parameters even if they have converged.  Default is False.
     skyfit : boolean, optional
        Fit a constant sky offset with the stellar parameters.  Default is True.
+    nproc : int, optional
+       Number of processes to fit the groups with.  With nproc>1 the groups
+         are fit independently in parallel, so each group is fit to the
+         image with only the isolated stars subtracted instead of the
+         residual image with all of the previously fit groups subtracted.
+         Use None for the number of CPUs.  It is never more than the number
+         of groups.  Default is 1.
     verbose : boolean, optional
        Verbose output.
 
@@ -116,21 +373,15 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
 
     # Check the method
     method = str(method).lower()    
-    if method not in ['cholesky','svd','qr','sparse','htcen','curve_fit']:
-        raise ValueError('Only cholesky, svd, qr, sparse, htcen or curve_fit methods currently supported')
+    if method not in ['cholesky','svd','svd_full','qr','sparse','htcen','curve_fit']:
+        raise ValueError('Only cholesky, svd, svd_full, qr, sparse, htcen or curve_fit methods currently supported')
         
     nstars = np.array(cat).size
     ny,nx = image.data.shape
     
     # Groups
     if 'group_id' not in cat.keys():
-        daogroup = DAOGroup(crit_separation=2.5*psf.fwhm())
-        starlist = cat.copy()
-        starlist['x_0'] = cat['x']
-        starlist['y_0'] = cat['y']
-        # THIS TAKES ~4 SECONDS!!!!!! WAY TOO LONG!!!!
-        star_groups = daogroup(starlist)
-        cat['group_id'] = star_groups['group_id']
+        cat['group_id'] = groupstars(cat['x'],cat['y'],2.5*psf.fwhm())
 
     # Star index
     starindex = dln.create_index(np.array(cat['group_id']))        
@@ -144,64 +395,127 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
                    ('x_error',float),('y',float),('y_error',float),('sky',float),
                    ('flux',float),('flux_error',float),('mag',float),('mag_error',float),
                    ('niter',int),('group_id',int),('ngroup',int),('rms',float),('chisq',float)])
-    outcat = np.zeros(nstars,dtype=dt)
-    outcat = Table(outcat)
+    outcat = np.zeros(nstars,dtype=dt)   # converted to a table at the end
     if 'id' in cat.keys():
         outcat['id'] = cat['id']
     else:
         outcat['id'] = np.arange(nstars)+1
         
+    # Star amps, for all stars at once
+    if 'amp' in cat.columns:
+        staramp = np.array(cat['amp'],float)
+    else:
+        # Estimate amp from flux and fwhm
+        # area under 2D Gaussian is 2*pi*A*sigx*sigy
+        if 'fwhm' in cat.columns:
+            amp = cat['flux']/(2*np.pi*(cat['fwhm']/2.35)**2)
+        else:
+            amp = cat['flux']/(2*np.pi*(psf.fwhm()/2.35)**2)                
+        staramp = np.maximum(np.array(amp,float),0)   # make sure it's positive
+    # Isolated stars only need amp/x/y, use a plain array instead of a table
+    starcat = np.zeros(nstars,dtype=np.dtype([('amp',float),('x',float),('y',float)]))
+    starcat['amp'] = staramp
+    starcat['x'] = cat['x']
+    starcat['y'] = cat['y']
+        
+    # Input catalogs of the groups
+    grpcats = []
+    for g,grp in enumerate(groups):
+        ind = starindex['index'][starindex['lo'][g]:starindex['hi'][g]+1]
+        if len(ind)==1:
+            inpcat = starcat[ind]
+        else:
+            inpcat = cat[ind].copy()
+            inpcat['amp'] = staramp[ind]
+        grpcats.append(inpcat)
+    kwargs = {'method':method,'fitradius':fitradius,'recenter':recenter,'maxiter':maxiter,
+              'minpercdiff':minpercdiff,'reskyiter':reskyiter,'nofreeze':nofreeze,
+              'skyfit':skyfit,'verbose':verbose}
+        
     # Group Loop
     #---------------
     resid = image.copy()
     outmodel = CCDData(np.zeros(image.shape),bbox=image.bbox,unit=image.unit)
-    outsky = CCDData(np.zeros(image.shape),bbox=image.bbox,unit=image.unit)    
-    for g,grp in enumerate(groups):
-        ind = starindex['index'][starindex['lo'][g]:starindex['hi'][g]+1]
-        nind = len(ind)
-        inpcat = cat[ind].copy()
-        if 'amp' not in inpcat.columns:
-            # Estimate amp from flux and fwhm
-            # area under 2D Gaussian is 2*pi*A*sigx*sigy
-            if 'fwhm' in inpcat.columns:
-                amp = inpcat['flux']/(2*np.pi*(inpcat['fwhm']/2.35)**2)
-            else:
-                amp = inpcat['flux']/(2*np.pi*(psf.fwhm()/2.35)**2)                
-            staramp = np.maximum(amp,0)   # make sure it's positive
-            inpcat['amp'] = staramp
+    outsky = CCDData(np.zeros(image.shape),bbox=image.bbox,unit=image.unit)
+    # Columns copied from the group fits
+    cols = ['amp','amp_error','x','x_error','y','y_error',
+            'sky','flux','flux_error','mag','mag_error','niter','rms','chisq']
+    fitgroups = np.arange(ngroups)
+    single = (starindex['hi']==starindex['lo'])
+    dofitstars = (np.sum(single)>0 and groupfit.numbapsftype(psf)>0)
+    if nproc is None:
+        nproc = os.cpu_count()
+    # The isolated stars fit by fitstars() don't need a worker
+    if dofitstars:
+        nproc = min(nproc,max(np.sum(~single),1))
+    else:
+        nproc = min(nproc,ngroups)
+    if nproc>1:
+        # Start the workers before any parallel numba code runs in this
+        #  process, forking after that can hang with the TBB threading layer.
+        #  The workers get the residual image with the isolated stars
+        #  subtracted through shared memory that is filled in below.
+        residbuf = multiprocessing.RawArray('b',image.data.nbytes)
+        sharedresid = np.frombuffer(residbuf,dtype=image.data.dtype).reshape(image.shape)
+        pool = multiprocessing.Pool(nproc,initializer=initpool,initargs=(psf,resid,residbuf))
+    # Stop the workers if a fit fails
+    try:
+        # Fit all of the isolated stars at once with the numba models,
+        #  the groups are then fit with these stars subtracted
+        if dofitstars:
+            sind = starindex['index'][starindex['lo'][single]]
+            if verbose:
+                print('-- Fitting '+str(len(sind))+' isolated stars --')
+            out,modelim,skyim = fitstars(psf,resid,starcat[sind],recenter=recenter)
+            outmodel.data += modelim
+            gdsky = np.isfinite(skyim)
+            outsky.data[gdsky] = skyim[gdsky]
+            resid.data -= modelim
+            good = np.isfinite(out['amp'])
+            outcat[cols][sind[good]] = out[cols][good]
+            outcat['group_id'][sind[good]] = groups[single][good]
+            outcat['ngroup'][sind[good]] = 1
+            # Failed fits are redone one star at a time
+            fitgroups = np.sort(np.concatenate((np.where(~single)[0],np.where(single)[0][~good])))
+        nfitgroups = len(fitgroups)
+        if nproc>1:
+            # Fit the groups independently in parallel
+            #  send them in chunks, there can be thousands of small groups
+            sharedresid[:] = resid.data
+            chunksize = max(nfitgroups//(4*nproc),1)
+            results = pool.imap_unordered(poolfitgroup,[(g,grpcats[g],kwargs) for g in fitgroups],
+                                          chunksize=chunksize)
+        else:
+            # Fit the groups in order, each on the residual image of the previous ones
+            results = ((g,)+fitgroup(psf,resid,grpcats[g],**kwargs) for g in fitgroups)
+        for g,out,model,sky in results:
+            grp = groups[g]
+            ind = starindex['index'][starindex['lo'][g]:starindex['hi'][g]+1]
+            nind = len(ind)
         
-        if verbose:
-            print('-- Group '+str(grp)+'/'+str(len(groups))+' : '+str(nind)+' star(s) --')
+            if verbose:
+                print('-- Group '+str(grp)+'/'+str(len(groups))+' : '+str(nind)+' star(s) --')
         
-        # Single Star
-        if nind==1:
-            inpcat = [inpcat['amp'][0],inpcat['x'][0],inpcat['y'][0]]
-            out,model = psf.fit(resid,inpcat,niter=3,verbose=verbose,retfullmodel=True,recenter=recenter)
-            model.data -= out['sky']   # remove sky
-            outmodel.data[model.bbox.slices] += model.data
-            outsky.data[model.bbox.slices] = out['sky']
-
-        # Group
-        else:
-            bbox = cutoutbbox(image,psf,inpcat)
-            out,model,sky = groupfit.fit(psf,resid[bbox.slices],inpcat,method=method,fitradius=fitradius,
-                                         recenter=recenter,maxiter=maxiter,minpercdiff=minpercdiff,
-                                         reskyiter=reskyiter,nofreeze=nofreeze,verbose=verbose,
-                                         skyfit=skyfit,absolute=True)
-            outmodel.data[model.bbox.slices] += model.data
-            outsky.data[model.bbox.slices] = sky
+            # Update the preallocated images in place, slice the arrays
+            #  and not the CCDData objects which copies the metadata
+            sl = model.bbox.slices
+            outmodel.data[sl] += model.data
+            outsky.data[sl] = sky
             
-        # Subtract the best model for the group/star
-        resid[model.bbox.slices].data -= model.data
+            # Subtract the best model for the group/star
+            resid.data[sl] -= model.data
         
-        # Put in catalog
-        cols = ['amp','amp_error','x','x_error','y','y_error',
-                'sky','flux','flux_error','mag','mag_error','niter','rms','chisq']
-        for c in cols:
-            outcat[c][ind] = out[c]
-        outcat['group_id'][ind] = grp
-        outcat['ngroup'][ind] = nind
-        outcat = Table(outcat)
+            # Put in catalog, all columns at once
+            #  the multi-field index is a view and the fields are matched by position
+            outcat[cols][ind] = out.as_array()[cols]
+            outcat['group_id'][ind] = grp
+            outcat['ngroup'][ind] = nind
+    finally:
+        if nproc>1:
+            pool.terminate()
+            pool.join()
+        
+    outcat = Table(outcat)
         
     if verbose:
         print('dt = %.2f sec' % (time.time()-start))
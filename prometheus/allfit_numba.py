@@ -16,7 +16,7 @@ from . import utils_numba as utils, groupfit_numba as gfit, models_numba as mnb
 from .clock_numba import clock
 
 #@njit(cache=True)
-@njit
+@njit(cache=True)
 def getstar(imshape,mask,xcen,ycen,hpsfnpix,fitradius,skyradius):
     """ Return a star's full footprint and fitted pixels data."""
     # always return the same size
@@ -66,7 +66,7 @@ def getstar(imshape,mask,xcen,ycen,hpsfnpix,fitradius,skyradius):
     return (fravelindex,fcount,ravelindex,count,skyravelindex,skycount)
 
 #@njit(cache=True)
-@njit
+@njit(cache=True)
 def collatestars(imshape,mask,starx,stary,hpsfnpix,fitradius,skyradius):
     """ Get full footprint and fitted pixels data for all stars."""
     nstars = len(starx)
@@ -102,7 +102,7 @@ def collatestars(imshape,mask,starx,stary,hpsfnpix,fitradius,skyradius):
     return (fravelindex,fndata,ravelindex,ndata,skyravelindex,skyndata)
 
 #@njit(cache=True)
-@njit
+@njit(cache=True)
 def getstarsky(skyravelindex,resid,error):
     """ Calculate the local sky for a single star."""
     res = resid[skyravelindex]
@@ -111,7 +111,7 @@ def getstarsky(skyravelindex,resid,error):
     return sky
 
 #@njit(cache=True)
-@njit
+@njit(cache=True)
 def starcov(psftype,psfparams,psflookup,imshape,pars,xind,yind,ravelindex,resid,error):
     """ Determine the covariance matrix for a single star."""
 
@@ -149,7 +149,7 @@ def starcov(psftype,psfparams,psflookup,imshape,pars,xind,yind,ravelindex,resid,
     return cov
 
 #@njit(cache=True)
-@njit
+@njit(cache=True)
 def starfit(psftype,psfparams,psflookup,imshape,
             pars,xind,yind,ravelindex,resid,error,sky):
     """
@@ -210,7 +210,7 @@ def starfit(psftype,psfparams,psflookup,imshape,
     return bestpars
 
 #@njit(cache=True)
-@njit
+@njit(cache=True)
 def chisq(ravelindex,resid,error):
     """ Compute total chi-square of the current best-fit solution for all
         fitting pixels."""
@@ -218,7 +218,7 @@ def chisq(ravelindex,resid,error):
     return chisq
 
 #@njit(cache=True)
-@njit
+@njit(cache=True)
 def dofreeze(oldpars,newpars,minpercdiff):
     """ Check if we should freeze this star."""
     # Check differences and changes
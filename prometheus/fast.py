@@ -2710,8 +2710,8 @@ def jac_covariance(jac,resid,wt):
     #   J.T * W * J
     #   where W = I/sig_i**2
     if wt is not None:
-        wt2 = wt.reshape(-1,1) + np.zeros(npars)
-        hess = jac.T @ (wt2 * jac)
+        #   broadcast the weights instead of tiling them to [Npix,Npars]
+        hess = jac.T @ (jac * wt.reshape(-1,1))
     else:
         hess = jac.T @ jac  # not weighted
 
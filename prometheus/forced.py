@@ -1,20 +1,24 @@
 import os
+import gc
 import errno
 import numpy as np
 import time
-from dlnpyutils import utils as dln, robust, coords
-from astropy.coordinates import SkyCoord
+from dlnpyutils import robust, coords
 from astropy.io import fits
 from astropy.wcs import WCS
 from astropy.time import Time
 from astropy.table import Table,vstack,hstack
 from scipy import optimize
-import astropy.units as u
+from numba import njit,prange,guvectorize,set_num_threads,get_num_threads
+from concurrent.futures import ProcessPoolExecutor
 from . import groupfit,allfit,models,leastsquares as lsq
 from .ccddata import CCDData
 
 # ALLFRAME-like forced photometry
 
+# Convert proper motion slopes from deg/day to mas/yr
+PM_SCALE = 3600e3*365.2425
+
 # also see multifit.py
 
 def getimageinfo(files):
@@ -52,29 +56,110 @@ def getimageinfo(files):
         if os.path.exists(prfile)==False:
             print(prfile,' not found')
             continue
-        # Load header
-        head1 = fits.getheader(files[i],0)
+        # Load header, the data are memory-mapped and never read
+        with fits.open(files[i],memmap=True) as hdul:
+            head1 = hdul[0].header.copy()
         wcs1 = WCS(head1)
         # Load source table and PSF model from prometheus output file
         tab1 = Table.read(prfile,1)
-        for c in tab1.colnames: tab1[c].name = c.lower()
+        tab1.rename_columns(tab1.colnames,[c.lower() for c in tab1.colnames])
         psf1 = models.read(prfile,4)
         dateobs = head1['DATE-OBS']
-        jd = Time(dateobs).jd
         exptime = head1.get('exptime')
         filt = head1.get('filter')
         nx = head1['NAXIS1']
         ny = head1['NAXIS2']        
-        cencoo = wcs1.pixel_to_world(nx//2,ny//2)
+        cenra,cendec = wcs1.wcs_pix2world(nx//2,ny//2,0)
         vra,vdec = wcs1.wcs_pix2world([0,nx-1,nx-1,0],[0,0,ny-1,ny-1],0)        
         iminfo.append({'file':files[i],'residfile':files[i].replace('.fits','_resid.npy'),
-                       'header':head1,'dateobs':dateobs,'jd':jd,'exptime':exptime,'filter':filt,
-                       'nx':nx,'ny':ny,'wcs':wcs1,'cenra':cencoo.ra.deg,'cendec':cencoo.dec.deg,
-                       'vra':vra,'vdec':vdec,'table':tab1,'psf':psf1,'startmeas':-1,'nmeas':-1,
+                       'header':head1,'dateobs':dateobs,'jd':0.0,'exptime':exptime,'filter':filt,
+                       'nx':nx,'ny':ny,'wcs':wcs1,'cenra':float(cenra),'cendec':float(cendec),
+                       'vra':vra,'vdec':vdec,'table':tab1,'psf':psf1,'contained':None,
+                       'startmeas':-1,'nmeas':-1,
                        'imchisq':0.0,'srcchisq':0.0})
 
+    # Convert all of the observation dates to JD at once
+    if len(iminfo)>0:
+        jd = Time([f['dateobs'] for f in iminfo]).jd
+        for i in range(len(iminfo)):
+            iminfo[i]['jd'] = jd[i]
+        
     return iminfo
     
+def writeresid(resid,residfile,error=True,sky=True):
+    """
+    Save the residual image arrays to .npy files.  The error, mask and sky
+    images are written to sibling _error.npy, _mask.npy and _sky.npy files.
+
+    Parameters
+    ----------
+    resid : CCDData object
+       Residual image.
+    residfile : str
+       Name of the .npy file for the residual image data.
+    error : boolean, optional
+       Also write the error image and the mask, which do not change between
+         iterations.  Default is True.
+    sky : boolean, optional
+       Also write the sky image.  Default is True.
+
+    Example
+    -------
+
+    writeresid(resid,residfile)
+
+    """
+    base = residfile[:-4]  # strip .npy
+    # Memory-mapped data is modified in place, only need to flush it
+    if isinstance(resid.data,np.memmap) and resid.data.filename is not None and \
+       os.path.abspath(resid.data.filename)==os.path.abspath(residfile):
+        resid.data.flush()
+    else:
+        np.save(residfile,resid.data)
+    if error:
+        np.save(base+'_error.npy',resid.error)
+        # Don't leave a mask from an earlier run behind
+        if resid.mask is not None:
+            np.save(base+'_mask.npy',np.asarray(resid.mask,bool))
+        elif os.path.exists(base+'_mask.npy'):
+            os.remove(base+'_mask.npy')
+    if sky:
+        np.save(base+'_sky.npy',resid.sky)
+        
+def readresid(residfile):
+    """
+    Load the residual image from .npy files written by writeresid().
+    The data are memory-mapped in read/write mode so changes to the
+    residual image modify the file pages directly.  The error image is
+    memory-mapped read-only, it can't be modified in place.
+
+    Parameters
+    ----------
+    residfile : str
+       Name of the .npy file for the residual image data.
+
+    Returns
+    -------
+    resid : CCDData object
+       Residual image.
+
+    Example
+    -------
+
+    resid = readresid(residfile)
+
+    """
+    base = residfile[:-4]  # strip .npy
+    data = np.load(residfile,mmap_mode='r+')
+    error = np.load(base+'_error.npy',mmap_mode='r')
+    sky = np.load(base+'_sky.npy')
+    mask = None
+    if os.path.exists(base+'_mask.npy'):
+        mask = np.load(base+'_mask.npy')
+    resid = CCDData(data,error=error,mask=mask,sky=sky)
+    resid.skysubtracted = True
+    return resid
+    
 def makemastertab(images,dcr=1.0,mindet=2):
     """
     Make master star list from individual image star catalogs.
@@ -106,6 +191,13 @@ def makemastertab(images,dcr=1.0,mindet=2):
 
     objdt = [('objid',int),('ra',float),('dec',float),('amp',float),
              ('flux',float),('nmeas',int)]
+
+    # Preallocate the object table for the maximum possible number of objects
+    #  and collect the measurement tables in a list, stack them once at the end
+    maxobj = np.sum([len(f['table']) for f in images])
+    obj = Table(np.zeros(maxobj,dtype=np.dtype(objdt)))
+    meas_chunks = []
+    next_objid = 1
     
     # Loop over the images
     for i in range(nimages):
@@ -115,15 +207,18 @@ def makemastertab(images,dcr=1.0,mindet=2):
         tab1['dec'].unit = None        
         # First catalog
         if i==0:
-            tab1['objid'] = np.arange(len(tab1))+1
-            meas = tab1.copy()
-            obj = Table(np.zeros(len(meas),dtype=np.dtype(objdt)))
-            for c in ['ra','dec']: obj[c] = meas[c]
-            obj['nmeas'] = 1
+            ntab1 = len(tab1)
+            tab1['objid'] = np.arange(ntab1)+1
+            meas_chunks.append(tab1.copy())
+            obj['objid'][:ntab1] = tab1['objid']
+            for c in ['ra','dec']: obj[c][:ntab1] = tab1[c]
+            obj['nmeas'][:ntab1] = 1
+            next_objid += ntab1
         # 2nd and later catalog, need to crossmatch
         else:
+            nobj = next_objid-1
             # Cross-match
-            ind1,ind2,dist = coords.xmatch(obj['ra'],obj['dec'],
+            ind1,ind2,dist = coords.xmatch(obj['ra'][:nobj],obj['dec'][:nobj],
                                            tab1['ra'],tab1['dec'],dcr,unique=True)
             # Some matches
             if len(ind1)>0:
@@ -133,24 +228,25 @@ def makemastertab(images,dcr=1.0,mindet=2):
             if len(ind1) < len(tab1):
                 leftind = np.arange(len(tab1))
                 leftind = np.delete(leftind,ind2)
-                tab1['objid'][leftind] = np.arange(len(leftind))+len(obj)+1
-                meas = vstack((meas,tab1))
-                newobj = Table(np.zeros(len(leftind),dtype=np.dtype(objdt)))
-                for c in ['ra','dec']: newobj[c] = tab1[leftind][c]
-                newobj['nmeas'] = 1
-                obj = vstack((obj,newobj))
+                nleft = len(leftind)
+                tab1['objid'][leftind] = np.arange(nleft)+next_objid
+                meas_chunks.append(tab1)
+                obj['objid'][nobj:nobj+nleft] = tab1['objid'][leftind]
+                for c in ['ra','dec']: obj[c][nobj:nobj+nleft] = tab1[c][leftind]
+                obj['nmeas'][nobj:nobj+nleft] = 1
+                next_objid += nleft
+    meas = vstack(meas_chunks)
+    obj = obj[:next_objid-1]
 
     # Get mean ra, dec and flux from the measurements
-    measindex = dln.create_index(meas['objid'])
+    #  sort by objid and sum over each object's block of measurements
+    order = np.argsort(meas['objid'],kind='stable')
+    measobjid = np.array(meas['objid'])[order]
+    uobjid,starts,counts = np.unique(measobjid,return_index=True,return_counts=True)
     obj['flux'] = 0.0
-    for i in range(len(measindex['value'])):
-        objid = measindex['value'][i]
-        ind = measindex['index'][measindex['lo'][i]:measindex['hi'][i]+1]
-        nind = len(ind)
-        obj['ra'][objid-1] = np.mean(meas['ra'][ind])
-        obj['dec'][objid-1] = np.mean(meas['dec'][ind])
-        obj['amp'][objid-1] = np.mean(meas['psfamp'][ind])
-        obj['flux'][objid-1] = np.mean(meas['psfflux'][ind])
+    for c,mc in zip(['ra','dec','amp','flux'],['ra','dec','psfamp','psfflux']):
+        vals = np.array(meas[mc],float)[order]
+        obj[c][uobjid-1] = np.add.reduceat(vals,starts)/counts
 
     # Impose minimum number of detections
     if mindet is not None:
@@ -175,12 +271,13 @@ def initialize_catalogs(iminfo,mastertab):
 
     Returns
     -------
-    objtab : table
+    objtab : numpy structured array
        Catalog of unique objects.
-    meastab : table
+    meastab : numpy structured array
        Catalog of individual measurements.
-    objindex : list
-       List of measurement indices for each object.
+    objindex : dict
+       CSR-style index of the measurements for each object with the
+        'index' (into meastab, grouped by object) and 'offsets' arrays.
     iminfo : table
        List of information on the image files.  Now
         overlap information has been added.
@@ -195,10 +292,18 @@ def initialize_catalogs(iminfo,mastertab):
     nimages = len(iminfo)
     
     nobj = len(mastertab)
-    objtab = mastertab.copy()
-    objtab['ra'].unit = None   # don't want any units
-    objtab['dec'].unit = None    
-    objtab['objid'] = 0
+    # Use a plain structured array internally to avoid the Table column overhead
+    #  no units
+    objdt = [('objid',int),('cenra0',float),('cendec0',float),('cenra',float),
+             ('cendec',float),('cenpmra',float),('cenpmdec',float),('nmeas',int),
+             ('converged',bool),('chisq',float),('niter',int)]
+    objnames = [d[0] for d in objdt]
+    mdt = [(c,mastertab[c].dtype,mastertab[c].shape[1:]) for c in mastertab.colnames
+           if c not in objnames]
+    objtab = np.zeros(nobj,dtype=np.dtype(mdt+objdt))
+    for c in mastertab.colnames:
+        if c not in objnames:
+            objtab[c] = mastertab[c]
     objtab['objid'] = np.arange(nobj)+1
     objtab['cenra0'] = objtab['ra'].copy()  # initial coordinates
     objtab['cendec0'] = objtab['dec'].copy()
@@ -210,13 +315,14 @@ def initialize_catalogs(iminfo,mastertab):
     objtab['converged'] = False
     objtab['chisq'] = np.nan
     
-    # Initial master list coordinates
-    coo0 = SkyCoord(ra=objtab['cenra']*u.deg,dec=objtab['cendec']*u.deg,frame='icrs')
-    
     # Get overlap and measurement indices for the images
+    #  project the initial master list coordinates onto each image once
+    #  and save the overlap mask
     meascount = 0
     for i in range(nimages):
-        isin = coo0.contained_by(iminfo[i]['wcs'])
+        x,y = iminfo[i]['wcs'].wcs_world2pix(objtab['cenra'],objtab['cendec'],0)
+        isin = (x>=0) & (x<iminfo[i]['nx']) & (y>=0) & (y<iminfo[i]['ny'])
+        iminfo[i]['contained'] = isin
         iminfo[i]['startmeas'] = meascount
         iminfo[i]['nmeas'] = np.sum(isin)
         meascount += iminfo[i]['nmeas']
@@ -230,11 +336,10 @@ def initialize_catalogs(iminfo,mastertab):
           ('ddec',float),('sky',float),('chisq',float),('npix',int),('converged',bool)]
     nmeas = np.sum([f['nmeas'] for f in iminfo])
     #nmeas = np.sum(iminfo['nmeas'])
-    meastab = Table(np.zeros(nmeas,dtype=np.dtype(dt)))
+    meastab = np.zeros(nmeas,dtype=np.dtype(dt))
     meascount = 0
     for i in range(nimages):
-        contained = coo0.contained_by(iminfo[i]['wcs'])
-        isin, = np.where(contained)
+        isin, = np.where(iminfo[i]['contained'])
         nisin = len(isin)
         objtab['nmeas'][isin] += 1 
         if nisin > 0:
@@ -245,11 +350,11 @@ def initialize_catalogs(iminfo,mastertab):
             meascount += nisin
 
     # Create object index into measurement table
-    oindex = dln.create_index(meastab['objindex'])
-    objindex = nobj*[[]]  # initialize index with empty list for each object
-    for i in range(len(oindex['value'])):
-        ind = oindex['index'][oindex['lo'][i]:oindex['hi'][i]+1]
-        objindex[oindex['value'][i]] = ind    # value is the index in objtab
+    #  CSR-style, the measurements of object i are
+    #  meastab[objindex['index'][objindex['offsets'][i]:objindex['offsets'][i+1]]]
+    order = np.argsort(meastab['objindex'],kind='stable')
+    offsets = np.searchsorted(meastab['objindex'][order],np.arange(nobj+1))
+    objindex = {'index':order,'offsets':offsets}
 
     return objtab,meastab,objindex,iminfo
 
@@ -347,7 +452,7 @@ def solveone(psf,im,cat,method='qr',bounds=None,fitradius=None,
     xdata = np.vstack((X.ravel(), Y.ravel()))        
     #sky = np.median(skyim)
     sky = 0.0
-    if 'amp' in cat.colnames:
+    if 'amp' in cat.dtype.names:
         amp = cat['amp'][0]
         if amp==0:
             amp = 1.0
@@ -390,7 +495,11 @@ def solveone(psf,im,cat,method='qr',bounds=None,fitradius=None,
         m,jac = psf.jac(xdata,*initpar,retmodel=True)
         dy = flux.ravel()-m.ravel()
         # Solve Jacobian
-        dbeta = lsq.jac_solve(jac,dy,method=method,weight=wt.ravel())
+        if method=='qr' or method=='cholesky':
+            # Small system, solve the normal equations directly
+            dbeta = numba_wlsqsolve(jac,dy,wt.ravel())
+        else:
+            dbeta = lsq.jac_solve(jac,dy,method=method,weight=wt.ravel())
         dbeta[~np.isfinite(dbeta)] = 0.0  # deal with NaNs
     
         # Perform line search
@@ -433,7 +542,327 @@ def solveone(psf,im,cat,method='qr',bounds=None,fitradius=None,
     return newamp,newamp_error,deltax,deltay,chisq,npix
 
 
-def solve(psf,resid,meastab,fitradius=None,recenter=True,verbose=False):
+def psfvaries(psf):
+    """ Check if the PSF model changes across the image."""
+    if getattr(psf,'order',0)>0:
+        return True
+    lookup = getattr(psf,'lookup',None)
+    if lookup is not None and getattr(lookup,'order',0)>0:
+        return True
+    return False
+
+def mkpsflut(psf,imshape,osamp=10):
+    """
+    Sample the unit-amplitude PSF model and its derivatives with respect to
+    the star center on an oversampled grid of offsets from the star center.
+    The same table is used for all stars, so this is only valid for a PSF
+    that does not vary across the image (see psfvaries()).
+
+    Parameters
+    ----------
+    psf : PSF object
+       The PSF object for the image.
+    imshape : tuple
+       Image shape (ny,nx).  The PSF is evaluated at the image center.
+    osamp : int, optional
+       Oversampling factor.  Default is 10.
+
+    Returns
+    -------
+    lut : numpy array
+       The [3,Nlut,Nlut] float32 lookup table of the PSF model, and the
+         derivatives with respect to xcen and ycen.  Python images are (Y,X).
+    lutrad : int
+       The radius of the lookup table in pixels.
+
+    Example
+    -------
+
+    lut,lutrad = mkpsflut(psf,image.shape)
+
+    """
+    ny,nx = imshape
+    lutrad = psf.radius+1
+    nlut = 2*lutrad*osamp+1
+    off = np.arange(nlut)/osamp-lutrad
+    xc0 = nx//2
+    yc0 = ny//2
+    # Python images are (Y,X)
+    x = (off+xc0).reshape(1,-1)+np.zeros(nlut).reshape(-1,1)
+    y = (off+yc0).reshape(-1,1)+np.zeros(nlut)
+    xdata = np.vstack((x.ravel(),y.ravel()))
+    m,jac = psf.jac(xdata,1.0,xc0,yc0,retmodel=True)
+    lut = np.zeros((3,nlut,nlut),np.float32)
+    lut[0] = m.reshape(nlut,nlut)
+    lut[1] = jac[:,1].reshape(nlut,nlut)
+    lut[2] = jac[:,2].reshape(nlut,nlut)
+    return lut,lutrad
+
+@njit(cache=True)
+def numba_lutinterp(lut,osamp,lutrad,u,v):
+    """ Bilinear interpolation of the PSF lookup table and its derivatives."""
+    nlut = lut.shape[1]
+    fu = (u+lutrad)*osamp
+    fv = (v+lutrad)*osamp
+    if fu<0 or fv<0 or fu>=nlut-1 or fv>=nlut-1:
+        return 0.0,0.0,0.0
+    i0 = int(fu)
+    j0 = int(fv)
+    tu = fu-i0
+    tv = fv-j0
+    w00 = (1-tu)*(1-tv)
+    w01 = tu*(1-tv)
+    w10 = (1-tu)*tv
+    w11 = tu*tv
+    val = w00*lut[0,j0,i0] + w01*lut[0,j0,i0+1] + w10*lut[0,j0+1,i0] + w11*lut[0,j0+1,i0+1]
+    dmdx = w00*lut[1,j0,i0] + w01*lut[1,j0,i0+1] + w10*lut[1,j0+1,i0] + w11*lut[1,j0+1,i0+1]
+    dmdy = w00*lut[2,j0,i0] + w01*lut[2,j0,i0+1] + w10*lut[2,j0+1,i0] + w11*lut[2,j0+1,i0+1]
+    return val,dmdx,dmdy
+
+@njit(cache=True)
+def numba_cholsolve(hess,grad):
+    """
+    Solve a small symmetric positive definite system with an inlined
+    Cholesky decomposition.  Only the lower triangle of hess is used.
+    Parameters with a zero diagonal get a zero solution.
+    """
+    npars = len(grad)
+    low = np.zeros((npars,npars),float)
+    bad = np.zeros(npars,np.bool_)
+    for p in range(npars):
+        if np.abs(hess[p,p]) < 2e-300:
+            bad[p] = True
+    for p in range(npars):
+        for q in range(p+1):
+            if bad[p] or bad[q]:
+                hpq = 0.0
+                if p==q:
+                    hpq = 1.0
+            else:
+                hpq = hess[p,q]
+            for r in range(q):
+                hpq -= low[p,r]*low[q,r]
+            if p==q:
+                if hpq <= 0:
+                    return np.full(npars,np.nan)
+                low[p,p] = np.sqrt(hpq)
+            else:
+                low[p,q] = hpq/low[q,q]
+    # Forward substitution, L z = grad
+    z = np.zeros(npars,float)
+    for p in range(npars):
+        val = grad[p]
+        if bad[p]:
+            val = 0.0
+        for r in range(p):
+            val -= low[p,r]*z[r]
+        z[p] = val/low[p,p]
+    # Back substitution, L.T x = z
+    x = np.zeros(npars,float)
+    for p in range(npars-1,-1,-1):
+        val = z[p]
+        for r in range(p+1,npars):
+            val -= low[r,p]*x[r]
+        x[p] = val/low[p,p]
+    return x
+
+@njit(cache=True)
+def numba_wlsqsolve(jac,dy,wt):
+    """
+    Solve the small weighted normal equations (J.T W J) dbeta = J.T W dy.
+    The weights are applied element-wise, the diagonal weight matrix is
+    never formed.
+    """
+    npix,npars = jac.shape
+    hess = np.zeros((npars,npars),float)
+    grad = np.zeros(npars,float)
+    for k in range(npix):
+        for p in range(npars):
+            wj = wt[k]*jac[k,p]
+            grad[p] += wj*dy[k]
+            for q in range(p+1):
+                hess[p,q] += wj*jac[k,q]
+    return numba_cholsolve(hess,grad)
+
+@njit(cache=True)
+def numba_boxchisq(flux,wt,xx,yy,lut,osamp,lutrad,amp,xc,yc):
+    """ Chi-squared of a single star model in its fitting box."""
+    chisq = 0.0
+    for k in range(len(flux)):
+        val,dmdx,dmdy = numba_lutinterp(lut,osamp,lutrad,xx[k]-xc,yy[k]-yc)
+        chisq += (flux[k]-amp*val)**2 * wt[k]
+    return chisq
+
+@njit(cache=True)
+def numba_solvestar(resid,err,lut,osamp,lutrad,psfrad,xc,yc,amp,fitradius,recenter,
+                    scratch,jacscratch,boxscratch):
+    """
+    Fit the flux and offsets in coordinates for one source in the residual
+    image.  Adding the previous model back in, extracting the fitting
+    pixels and subtracting the new model are fused into a single pass
+    over a local copy of the star's box, which is written back once.
+    The work arrays are views into the preallocated scratch arrays.
+    """
+    ny,nx = resid.shape
+
+    # Box of the PSF footprint, python images are (Y,X)
+    rad = max(psfrad,fitradius)
+    bxlo = max(int(np.floor(xc-rad)),0)
+    bxhi = min(int(np.ceil(xc+rad+1)),nx)
+    bylo = max(int(np.floor(yc-rad)),0)
+    byhi = min(int(np.ceil(yc+rad+1)),ny)
+    # Get subimage of pixels to fit
+    xlo = max(int(np.floor(xc-fitradius)),0)
+    xhi = min(int(np.ceil(xc+fitradius+1)),nx)
+    ylo = max(int(np.floor(yc-fitradius)),0)
+    yhi = min(int(np.ceil(yc+fitradius+1)),ny)
+    nxsub = xhi-xlo
+    nysub = yhi-ylo
+    npix = nxsub*nysub
+    flux = scratch[0,:npix]
+    wt = scratch[1,:npix]
+    xx = scratch[2,:npix]
+    yy = scratch[3,:npix]
+    m = scratch[4,:npix]
+    dy = scratch[5,:npix]
+    jac = jacscratch[:npix,:]
+    # Unit model in the footprint box, the old and new models are at
+    #  the same position so it is only evaluated once
+    mbox = boxscratch[:byhi-bylo,:bxhi-bxlo]
+    amp0 = amp
+    if amp0==0:
+        amp0 = 1.0
+    k = 0
+    for j in range(bylo,byhi):
+        infit = (j>=ylo) and (j<yhi)
+        for i in range(bxlo,bxhi):
+            val,dmdx,dmdy = numba_lutinterp(lut,osamp,lutrad,i-xc,j-yc)
+            mbox[j-bylo,i-bxlo] = val
+            if infit and i>=xlo and i<xhi:
+                # Add the previous best-fit model back in
+                flux[k] = resid[j,i]+max(amp,0.0)*val
+                wt[k] = 1.0/max(err[j,i],1.0)**2
+                xx[k] = i
+                yy[k] = j
+                m[k] = val
+                # jacobian wrt amp, xcen, ycen
+                jac[k,0] = val
+                jac[k,1] = amp0*dmdx
+                jac[k,2] = amp0*dmdy
+                k += 1
+
+    # Only fit amplitude, no recenter
+    if recenter==False:
+        smf = 0.0
+        smm = 0.0
+        for k in range(npix):
+            smf += m[k]*flux[k]
+            smm += m[k]*m[k]
+        newamp = 0.0
+        if smm > 0:
+            newamp = max(smf/smm,0.0)
+        deltax = 0.0
+        deltay = 0.0
+    # Fit amplitude and get centroid correction terms
+    else:
+        # Weighted normal equations
+        for k in range(npix):
+            dy[k] = flux[k]-amp0*m[k]
+        dbeta = numba_wlsqsolve(jac,dy,wt)
+        for p in range(3):
+            if np.isfinite(dbeta[p])==False:
+                dbeta[p] = 0.0
+        # Perform line search with three points and a quadratic fit
+        f0 = numba_boxchisq(flux,wt,xx,yy,lut,osamp,lutrad,amp0,xc,yc)
+        f1 = numba_boxchisq(flux,wt,xx,yy,lut,osamp,lutrad,amp0+0.5*dbeta[0],
+                            xc+0.5*dbeta[1],yc+0.5*dbeta[2])
+        f2 = numba_boxchisq(flux,wt,xx,yy,lut,osamp,lutrad,amp0+dbeta[0],
+                            xc+dbeta[1],yc+dbeta[2])
+        qa = 2*(f2-2*f1+f0)
+        alpha = 1.0
+        if qa != 0:
+            alpha = -(4*f1-3*f0-f2)/(2*qa)
+        if np.isfinite(alpha)==False:
+            alpha = 1.0
+        alpha = min(max(alpha,0.0),1.0)  # 0<alpha<1
+        # Limit the steps to the maximum step sizes and boundaries
+        pars = np.array([amp0,xc-xlo,yc-ylo])
+        lbounds = np.array([0.0,0.0,0.0])
+        ubounds = np.array([np.inf,nxsub-1.0,nysub-1.0])
+        maxsteps = np.array([0.5*amp0,0.5,0.5])
+        steps = np.zeros(3,float)
+        for p in range(3):
+            steps[p] = min(np.abs(alpha*dbeta[p]),maxsteps[p])*np.sign(dbeta[p])
+            count = 0
+            while count<=2 and (pars[p]+steps[p]<=lbounds[p] or pars[p]+steps[p]>=ubounds[p]):
+                steps[p] /= 2
+                count += 1
+        newpars = pars+steps
+        for p in range(3):
+            if newpars[p]<=lbounds[p] or newpars[p]>=ubounds[p]:
+                newpars[p] = min(max(newpars[p],lbounds[p]+1e-30),ubounds[p]-1e-30)
+        newamp = max(newpars[0],0.0)  # amp cannot be negative
+        deltax = newpars[1]-pars[1]
+        deltay = newpars[2]-pars[2]
+
+    # Model with only the new flux
+    chisq = 0.0
+    for k in range(npix):
+        chisq += (flux[k]-newamp*m[k])**2 * wt[k]
+
+    # Calculate uncertainties
+    if recenter==False:
+        npars = 1
+    else:
+        npars = 3
+    hess = np.zeros((npars,npars),float)
+    for k in range(npix):
+        for p in range(npars):
+            for q in range(p+1):
+                hess[p,q] += jac[k,p]*wt[k]*jac[k,q]
+    # cov[0,0] of the inverse Hessian
+    unit = np.zeros(npars,float)
+    unit[0] = 1.0
+    cov00 = numba_cholsolve(hess,unit)[0]
+    dof = max(npix-npars,1)
+    newamp_error = np.sqrt(np.abs(cov00)*chisq/dof)
+
+    # Replace the old model with the new one, write the box back once
+    damp = max(amp,0.0)-newamp
+    for j in range(bylo,byhi):
+        for i in range(bxlo,bxhi):
+            resid[j,i] += damp*mbox[j-bylo,i-bxlo]
+
+    return newamp,newamp_error,deltax,deltay,chisq/npix,npix
+
+@njit(parallel=True,cache=True)
+def numba_solve(resid,err,lut,osamp,lutrad,psfrad,xcen,ycen,amp,fitradius,recenter,
+                order,cellstart,colorstart,scratch,jacscratch,boxscratch,
+                outamp,outamp_error,outdx,outdy,outchisq,outnpix):
+    """
+    Solve all stars in a residual image.  The stars are grouped into cells
+    that are larger than the PSF footprint and the cells are colored in a
+    2x2 checkerboard pattern.  Cells of the same color never touch the same
+    pixels and are solved in parallel, while stars within a cell are solved
+    sequentially.  Each worker reuses its own slice of the scratch arrays.
+    """
+    nworkers = scratch.shape[0]
+    for c in range(4):
+        for t in prange(nworkers):
+            for k in range(colorstart[c]+t,colorstart[c+1],nworkers):
+                for j in range(cellstart[k],cellstart[k+1]):
+                    i = order[j]
+                    out = numba_solvestar(resid,err,lut,osamp,lutrad,psfrad,xcen[i],ycen[i],
+                                          amp[i],fitradius,recenter,scratch[t],
+                                          jacscratch[t],boxscratch[t])
+                    outamp[i] = out[0]
+                    outamp_error[i] = out[1]
+                    outdx[i] = out[2]
+                    outdy[i] = out[3]
+                    outchisq[i] = out[4]
+                    outnpix[i] = out[5]
+
+def solve(psf,resid,meastab,fitradius=None,recenter=True,convtol=1e-2,verbose=False):
     """
     Solve for the flux and find corrections for x and y.
 
@@ -449,6 +878,11 @@ def solve(psf,resid,meastab,fitradius=None,recenter=True,verbose=False):
        The fitting radius in pixels.  The default is 0.5*psf.fwhm().
     recenter : boolean, optional
        Allow the centroids to be fit.  Default is True.
+    convtol : float, optional
+       Convergence tolerance for the centroid corrections (in pixels) and
+         the fractional amplitude correction.  Measurements below it are
+         marked as converged and are skipped in later iterations.
+         Only used when recenter=True.  Default is 0.01.
     verbose : bool, optional
        Verbose output to the screen.  Default is False.
 
@@ -467,47 +901,225 @@ def solve(psf,resid,meastab,fitradius=None,recenter=True,verbose=False):
     if fitradius is None:
         fitradius = 0.5*psf.fwhm()
     
-    nmeas = len(meastab)
     out = meastab.copy()
-
-    # Have a version here that fits all simultaneously
-    # use groupfit
-    #gf = groupfit.GroupFitter(psf,image,meastab,fitradius=fitradius,verbose=(verbose>=2)) 
-    
-    # Loop over the stars
-    for i in range(nmeas):
-
-        # Only fit stars that have not converged yet
-        if meastab['converged'][i]==False:
-        
+    # Measurements that are not fit get no centroid corrections
+    out['dx'] = 0.0
+    out['dy'] = 0.0
+
+    # Only fit stars that have not converged yet
+    ind, = np.where(meastab['converged']==False)
+    nind = len(ind)
+    if nind==0:
+        return out,resid
+
+    amp = np.array(meastab['amp'][ind],float)
+    outamp = np.zeros(nind,float)
+    outamp_error = np.zeros(nind,float)
+    outdx = np.zeros(nind,float)
+    outdy = np.zeros(nind,float)
+    outchisq = np.zeros(nind,float)
+    outnpix = np.zeros(nind,int)
+
+    # A spatially varying PSF can't use the single lookup table,
+    #  fit the stars one at a time with the PSF object
+    if psfvaries(psf):
+        for k,i in enumerate(ind):
             # Add the previous best-fit model back in to the image
-            #  this will be skipped on the first iterations since all amps are zero
-            if meastab['amp'][i] > 0:
-                # nocopy=True will change in place
+            #  nocopy=True will change in place
+            if amp[k] > 0:
                 _ = psf.add(resid.data,meastab[i:i+1],nocopy=True)
-
             # Solve single flux
-            newamp,newamp_error,dx,dy,chisq,npix = solveone(psf,resid,meastab[i:i+1],fitradius=fitradius,recenter=recenter)
-            
-            # Save the results
-            out['amp'][i] = newamp
-            out['amp_error'][i] = newamp_error            
-            out['dx'][i] = dx
-            out['dy'][i] = dy
-            out['chisq'][i] = chisq
-            out['npix'][i] = npix
-        
+            res = solveone(psf,resid,meastab[i:i+1],fitradius=fitradius,recenter=recenter)
+            outamp[k],outamp_error[k],outdx[k],outdy[k],outchisq[k],outnpix[k] = res
             # Immediately subtract the new model
-            #  nocopy=True will change in place
+            out['amp'][i] = outamp[k]
             _ = psf.sub(resid.data,out[i:i+1],nocopy=True)
-
-            #print(i,newamp,dx,dy)
-            
-        #import pdb; pdb.set_trace()
+    else:
+        solvelut(psf,resid,meastab,ind,fitradius,recenter,amp,outamp,outamp_error,
+                 outdx,outdy,outchisq,outnpix)
+
+    # Save the results
+    out['amp'][ind] = outamp
+    out['amp_error'][ind] = outamp_error
+    out['dx'][ind] = outdx
+    out['dy'][ind] = outdy
+    out['chisq'][ind] = outchisq
+    out['npix'][ind] = outnpix
+    # Mark the measurements that have converged
+    if recenter:
+        damp = np.abs(outamp-amp)
+        out['converged'][ind] = ((np.abs(outdx)<convtol) & (np.abs(outdy)<convtol) &
+                                 (damp<=convtol*np.maximum(outamp,1e-30)))
         
     return out,resid
 
 
+def solvelut(psf,resid,meastab,ind,fitradius,recenter,amp,outamp,outamp_error,
+             outdx,outdy,outchisq,outnpix):
+    """
+    Solve the stars IND of meastab in parallel with the PSF lookup table.
+    The output arrays and the residual image are updated in place.
+    """
+    nind = len(ind)
+    # PSF lookup table
+    osamp = 10
+    lut,lutrad = mkpsflut(psf,resid.shape,osamp)
+    psfrad = float(psf.radius)
+
+    # Tile the image into cells larger than the PSF footprint
+    #  and color them in a 2x2 checkerboard pattern
+    xcen = np.array(meastab['x'][ind],float)
+    ycen = np.array(meastab['y'][ind],float)
+    cellsize = 2*int(np.ceil(max(psf.radius,fitradius)))+3
+    cx = np.floor(xcen/cellsize).astype(int)
+    cy = np.floor(ycen/cellsize).astype(int)
+    color = (cx % 2) + 2*(cy % 2)
+    order = np.lexsort((cx,cy,color))
+    newcell = np.ones(nind,bool)
+    newcell[1:] = (cx[order][1:] != cx[order][:-1]) | (cy[order][1:] != cy[order][:-1])
+    cellstart = np.append(np.where(newcell)[0],nind)
+    colorstart = np.searchsorted(color[order][cellstart[:-1]],np.arange(5))
+
+    # Preallocate the work arrays once for each worker, sized for the
+    #  largest fitting and footprint boxes
+    ncells = len(cellstart)-1
+    nworkers = max(min(get_num_threads(),ncells),1)
+    nfit = int(np.ceil(2*fitradius))+3
+    nbox = int(np.ceil(2*max(psfrad,fitradius)))+3
+    scratch = np.empty((nworkers,6,nfit*nfit),float)
+    jacscratch = np.empty((nworkers,nfit*nfit,3),float)
+    boxscratch = np.empty((nworkers,nbox,nbox),float)
+
+    # Solve all the stars
+    numba_solve(resid.data,resid.error,lut,osamp,lutrad,psfrad,xcen,ycen,amp,
+                float(fitradius),recenter,order,cellstart,colorstart,
+                scratch,jacscratch,boxscratch,outamp,outamp_error,outdx,outdy,outchisq,outnpix)
+
+
+def solveimage(imfile,residfile,wcs,psf,jd,objtab,meastab,count,refepoch,
+               recenter=True,verbose=False):
+    """
+    Fit the sources in one image for one forced photometry iteration.
+    The residual image is loaded from (and saved to) the residual files.
+
+    Parameters
+    ----------
+    imfile : str
+       Image filename.
+    residfile : str
+       Filename of the residual image.
+    wcs : astropy WCS object
+       WCS object of the image.
+    psf : PSF object
+       The PSF object for the image.
+    jd : float
+       Julian date of the image.
+    objtab : table
+       Catalog of the unique objects that overlap this image.
+    meastab : table
+       Catalog of the measurements for this image.  Must be in the same
+        order as objtab.
+    count : int
+       Iteration number (starting at 0).
+    refepoch : Time object
+       The reference epoch for the objtab cenra/cendec coordinates.
+    recenter : boolean, optional
+       Allow the centroids to be fit.  Default is True.
+    verbose : bool, optional
+       Verbose output to the screen.  Default is False.
+
+    Returns
+    -------
+    out : table
+       Table of results for the measurements in this image.
+    imchisq : float
+       Chi-squared of the residual image.
+    srcchisq : float
+       Mean chi-squared of the sources.
+
+    Example
+    -------
+
+    out,imchisq,srcchisq = solveimage(imfile,residfile,wcs,psf,jd,objtab,meastab,count,refepoch)
+
+    """
+    
+    imtime = Time(jd,format='jd')
+            
+    # Calculate x/y position for each object in this image
+    # using the current best overall on-sky position
+    # and proper motion
+    # Need to convert celestial values to x/y position in
+    # the image using the WCS.            
+    measra,measdec,measx,measy = compute_image_coordinates(objtab,wcs,imtime,refepoch)
+    meastab['ra'] = measra
+    meastab['dec'] = measdec
+    meastab['x'] = measx
+    meastab['y'] = measy
+            
+    # Initialize or load the residual image
+    if count==0:
+        # no copy needed, the image itself becomes the residual
+        resid = CCDData.read(imfile)
+        resid.skysubtracted = False
+        # Single precision is plenty for the residuals and halves
+        #  the memory traffic, chisq sums are still done in float64
+        resid.data = resid.data.astype(np.float32)
+        resid._error = resid.error.astype(np.float32)
+    else:
+        resid = readresid(residfile)
+                
+    # Subtract sky
+    if count % 5 == 0:
+        print('Subtracting the sky')
+        if count==0:
+            resid._sky = resid.sky.astype(np.float32)
+            resid.data -= resid.sky   # subtract the sky
+            resid.skysubtracted = True
+        else:
+            # Add "current" sky image back in
+            resid.data += resid.sky
+            # Force the sky to be recomputed
+            if hasattr(resid,'_sky'):
+                resid._sky = None
+            resid._sky = resid.sky.astype(np.float32)
+            resid.data -= resid.sky  # subtract new sky
+            resid.skysubtracted = True                    
+
+    # Fit the fluxes while holding the positions fixed
+    #  only measurements that have not converged yet are fit
+    imchisq0 = np.sum((resid.data/resid.error)**2,dtype=np.float64)/resid.size
+    out,resid = solve(psf,resid,meastab,recenter=recenter,verbose=verbose)
+
+    imchisq = np.sum((resid.data/resid.error)**2,dtype=np.float64)/resid.size
+    srcchisq = np.sum(out['chisq']*out['npix'])/np.sum(out['npix'])
+    medschisq = np.median(out['chisq'])
+    print('image chisq',imchisq0,imchisq)
+    print('source chisq',srcchisq)
+    print('median source chisq',medschisq)
+
+    # Convert dx/dy to dra/ddec
+    #  these will be used later to compute proper motions
+    #  measurements that were not fit have no corrections
+    fit = (meastab['converged']==False)
+    ra2,dec2 = wcs.wcs_pix2world(meastab['x'][fit]+out['dx'][fit],meastab['y'][fit]+out['dy'][fit],0)
+    out['dra'] = 0.0
+    out['ddec'] = 0.0
+    out['dra'][fit] = ra2 - meastab['ra'][fit]     # in degrees of RA (not true angle)
+    out['ddec'][fit] = dec2 - meastab['dec'][fit]  # in degrees
+            
+    # Save the residual file
+    #  the error image only changes on the first iteration and the sky
+    #  only when it is recomputed
+    writeresid(resid,residfile,error=(count==0),sky=(count % 5 == 0))
+
+    # Release the residual image memory map
+    del resid
+    gc.collect()
+    
+    return out,imchisq,srcchisq
+
+    
 def update_object(objtab,meastab,objindex,refepoch,fitpm=False,minfitpm=10,mindeltat=1000):
     """
     Determine the mean coordinates and proper motions of objects:
@@ -520,8 +1132,9 @@ def update_object(objtab,meastab,objindex,refepoch,fitpm=False,minfitpm=10,minde
        Catalog of individual measurements.  This should contain the
         updated ra/dec and dra/ddec from the last round of fitting
         sources in the images.
-    objindex : list
-       List of measurement indices for each object.
+    objindex : dict
+       CSR-style index of the measurements for each object with the
+        'index' (into meastab, grouped by object) and 'offsets' arrays.
     refepoch : Time object
        The reference time to use.  Should be an astropy Time object.
     fitpm : boolean, optional
@@ -546,44 +1159,80 @@ def update_object(objtab,meastab,objindex,refepoch,fitpm=False,minfitpm=10,minde
 
     """
 
-    # Loop over object and calculate coordinate and proper motion corrections
-    nobj = len(objtab)
-    for i in range(nobj):
-        cosdec = np.cos(np.deg2rad(objtab['cendec'][i]))
-        measind = objindex[i]
-        meas1 = meastab[measind]
-        jd0 = np.min(meas1['jd'])
-        jd = meas1['jd']-jd0
-        ra = meas1['ra']+meas1['dra']     # both in degrees
-        dec = meas1['dec']+meas1['ddec']
-        objtab['chisq'][i] = np.mean(meas1['chisq'])
-        # Fit proper motions
-        if fitpm and len(ra)>minfitpm and (np.max(jd)-np.min(jd)>mindeltat):
-            # Perform linear fit
-            # USE ROBUST WEIGHTED LINEAR FIT
-            racoef = robust.linefit(jd,ra)
-            deccoef = robust.linefit(jd,dec)
-            # Get coordinate at the reference epoch
-            refra = np.polyval(racoef,refepoch.jd-jd0)
-            refdec = np.polyval(deccoef,refepoch.jd-jd0)
-            # Calculate new proper motion
-            pmra = racoef[0] * (3600*1e3)*365.2425      # convert slope from deg/day to mas/yr
-            pmra *= cosdec                              # multiply by cos(dec) for true angle
-            pmdec = deccoef[0] * (3600*1e3)*365.2425
-            # update object cenra, cendec, cenpmra, cenpmdec
-            objtab['cenra'][i] = refra
-            objtab['cendec'][i] = refdec
-            objtab['cenpmra'][i] = pmra
-            objtab['cenpmdec'][i] = pmdec
-        # Only fit central coordinates
-        else:
-            # USE ROBUST WEIGHTED MEAN
-            refra = np.mean(ra)
-            refdec = np.mean(dec)
-            objtab['cenra'][i] = refra
-            objtab['cendec'][i] = refdec
-
-    #import pdb; pdb.set_trace()
+    cosdec = np.cos(np.deg2rad(np.array(objtab['cendec'])))
+    
+    # Calculate coordinate and proper motion corrections for all objects at once
+    #  use the measurements grouped by object and sum over each object's block
+    order = objindex['index']
+    counts = np.diff(objindex['offsets'])
+    uobj, = np.where(counts>0)
+    starts = objindex['offsets'][uobj]
+    counts = counts[uobj]
+    if len(uobj)==0:
+        return objtab
+    jdall = np.array(meastab['jd'])[order]
+    ra = np.array(meastab['ra']+meastab['dra'])[order]     # both in degrees
+    dec = np.array(meastab['dec']+meastab['ddec'])[order]
+    chisq = np.array(meastab['chisq'])[order]
+    jd0 = np.minimum.reduceat(jdall,starts)
+    jd = jdall-np.repeat(jd0,counts)
+    deltat = np.maximum.reduceat(jd,starts)
+    objtab['chisq'][uobj] = np.add.reduceat(chisq,starts)/counts
+
+    # Only fit central coordinates
+    # USE ROBUST WEIGHTED MEAN
+    refra = np.add.reduceat(ra,starts)/counts
+    refdec = np.add.reduceat(dec,starts)/counts
+    pmra = np.array(objtab['cenpmra'][uobj])
+    pmdec = np.array(objtab['cenpmdec'][uobj])
+    
+    # Fit proper motions
+    if fitpm:
+        fitobj = (counts>minfitpm) & (deltat>mindeltat)
+    else:
+        fitobj = np.zeros(len(uobj),bool)
+    if np.sum(fitobj)>0:
+        # Perform linear fit with the closed-form least-squares solution
+        sw = counts.astype(float)
+        sx = np.add.reduceat(jd,starts)
+        sxx = np.add.reduceat(jd**2,starts)
+        denom = sw*sxx-sx**2
+        denom[denom==0] = np.nan
+        coefs = []
+        for y in [ra,dec]:
+            sy = np.add.reduceat(y,starts)
+            sxy = np.add.reduceat(jd*y,starts)
+            slope = (sw*sxy-sx*sy)/denom
+            intercept = (sy-slope*sx)/sw
+            coefs.append([slope,intercept])
+        # USE ROBUST WEIGHTED LINEAR FIT for objects with outliers
+        rresid = ra-(np.repeat(coefs[0][1],counts)+np.repeat(coefs[0][0],counts)*jd)
+        dresid = dec-(np.repeat(coefs[1][1],counts)+np.repeat(coefs[1][0],counts)*jd)
+        outlier = np.zeros(len(uobj),bool)
+        for r in [rresid,dresid]:
+            rms = np.sqrt(np.add.reduceat(r**2,starts)/counts)
+            maxr = np.maximum.reduceat(np.abs(r),starts)
+            outlier |= (maxr > 3*rms)
+        for i in np.where(fitobj & outlier)[0]:
+            lo,hi = starts[i],starts[i]+counts[i]
+            racoef = robust.linefit(jd[lo:hi],ra[lo:hi])
+            deccoef = robust.linefit(jd[lo:hi],dec[lo:hi])
+            coefs[0][0][i],coefs[0][1][i] = racoef
+            coefs[1][0][i],coefs[1][1][i] = deccoef
+        # Get coordinate at the reference epoch
+        refra[fitobj] = (coefs[0][1]+coefs[0][0]*(refepoch.jd-jd0))[fitobj]
+        refdec[fitobj] = (coefs[1][1]+coefs[1][0]*(refepoch.jd-jd0))[fitobj]
+        # Calculate new proper motion
+        # convert slope from deg/day to mas/yr
+        # multiply by cos(dec) for true angle
+        pmra[fitobj] = (coefs[0][0] * PM_SCALE * cosdec[uobj])[fitobj]
+        pmdec[fitobj] = (coefs[1][0] * PM_SCALE)[fitobj]
+
+    # update object cenra, cendec, cenpmra, cenpmdec
+    objtab['cenra'][uobj] = refra
+    objtab['cendec'][uobj] = refdec
+    objtab['cenpmra'][uobj] = pmra
+    objtab['cenpmdec'][uobj] = pmdec
             
     return objtab
 
@@ -636,6 +1285,45 @@ def make_magnitudes(meastab,iminfo,zeropoint=25.0):
 
     return meastab
 
+def istanwcs(wcs):
+    """ Check if a WCS is a plain celestial TAN projection without distortions."""
+    w = wcs.wcs
+    if wcs.naxis != 2 or w.lng != 0 or w.lat != 1:
+        return False
+    if w.ctype[0] != 'RA---TAN' or w.ctype[1] != 'DEC--TAN':
+        return False
+    if wcs.sip is not None or wcs.cpdis1 is not None or wcs.cpdis2 is not None or \
+       wcs.det2im1 is not None or wcs.det2im2 is not None:
+        return False
+    if len(w.get_pv())>0 or w.lonpole != 180.0:
+        return False
+    return True
+
+@guvectorize(['(f8[:],f8[:],f8[:],f8[:],f8[:,:],f8[:],f8[:])'],
+             '(n),(n),(m),(m),(m,m)->(n),(n)',nopython=True,cache=True)
+def numba_tanworld2pix(ra,dec,crval,crpix,cdinv,x,y):
+    """
+    Convert ra/dec to 0-based pixel coordinates for a TAN projection.
+    ra, dec and crval are in degrees, cdinv is the inverse of the
+    CD matrix (degrees per pixel) and crpix is 1-based.
+    """
+    d2r = np.pi/180.0
+    ra0 = crval[0]*d2r
+    dec0 = crval[1]*d2r
+    sdec0 = np.sin(dec0)
+    cdec0 = np.cos(dec0)
+    for i in range(len(ra)):
+        dra = ra[i]*d2r-ra0
+        sdec = np.sin(dec[i]*d2r)
+        cdec = np.cos(dec[i]*d2r)
+        cdra = np.cos(dra)
+        cosc = sdec0*sdec + cdec0*cdec*cdra
+        # Intermediate world coordinates in degrees
+        xi = cdec*np.sin(dra)/cosc/d2r
+        eta = (cdec0*sdec - sdec0*cdec*cdra)/cosc/d2r
+        x[i] = cdinv[0,0]*xi + cdinv[0,1]*eta + crpix[0] - 1
+        y[i] = cdinv[1,0]*xi + cdinv[1,1]*eta + crpix[1] - 1
+
 def compute_image_coordinates(objtab,wcs,imtime,refepoch):
     """
     Compute ra/dec and x/y coordinates for a given image.
@@ -675,19 +1363,22 @@ def compute_image_coordinates(objtab,wcs,imtime,refepoch):
     # and proper motion
     # Need to convert celestial values to x/y position in
     # the image using the WCS.
-    coo = SkyCoord(ra=objtab['cenra']*u.deg,dec=objtab['cendec']*u.deg,
-                   pm_ra_cosdec=objtab['cenpmra']*u.mas/u.year,
-                   pm_dec=objtab['cenpmdec']*u.mas/u.year,
-                   obstime=refepoch,frame='icrs')
-            
-    # Use apply_space_motion() method to get coordinates for the
-    #  epoch of this image
-    newcoo = coo.apply_space_motion(imtime)
-    ra = newcoo.ra.deg
-    dec = newcoo.dec.deg            
+    # Linear extrapolation of the proper motion to the epoch of this image
+    #  small-angle approximation, much faster than apply_space_motion()
+    dt = imtime.jd-refepoch.jd   # days
+    cosdec = np.cos(np.deg2rad(objtab['cendec']))
+    ra = np.array(objtab['cenra'] + objtab['cenpmra']/cosdec*dt/PM_SCALE)
+    dec = np.array(objtab['cendec'] + objtab['cenpmdec']*dt/PM_SCALE)
             
     # Now convert to X/Y coordinates in this image
-    x,y = wcs.world_to_pixel(newcoo)
+    #  use the fast TAN projection kernel if possible
+    if istanwcs(wcs):
+        cdinv = np.linalg.inv(wcs.pixel_scale_matrix)
+        x,y = numba_tanworld2pix(ra.astype(float),dec.astype(float),
+                                 np.array(wcs.wcs.crval,float),
+                                 np.array(wcs.wcs.crpix,float),cdinv)
+    else:
+        x,y = wcs.wcs_world2pix(ra,dec,0)
     
     return ra,dec,x,y
     
@@ -702,8 +1393,9 @@ def average_photometry(objtab,meastab,objindex,iminfo):
     meastab : table
        Catalog of individual measurements.  This should contain the
         final fluxes and "mag" from make_magnitudes().
-    objindex : list
-       List of measurement indices for each object.
+    objindex : dict
+       CSR-style index of the measurements for each object with the
+        'index' (into meastab, grouped by object) and 'offsets' arrays.
     iminfo : list
        List of structures with information on the images including
          exposure times and filter names.
@@ -775,8 +1467,9 @@ def check_convergence(objtab,meastab,objindex,last_obj,niter,fitpm=True):
     meastab : table
        Catalog of individual measurements.  This should contain the
         final fluxes and "mag" from make_magnitudes().
-    objindex : list
-       List of measurement indices for each object.
+    objindex : dict
+       CSR-style index of the measurements for each object with the
+        'index' (into meastab, grouped by object) and 'offsets' arrays.
     last_obj : table
        Object values from the last iteration.
     niter : int
@@ -802,7 +1495,7 @@ def check_convergence(objtab,meastab,objindex,last_obj,niter,fitpm=True):
 
     """
 
-    orig_converged = objtab['converged']
+    orig_converged = objtab['converged'].copy()
     
     # Check of object cenra/cendec/cenpmra/cenpmdec changed
     #  or the measurement dx/dy values
@@ -854,7 +1547,7 @@ def check_convergence(objtab,meastab,objindex,last_obj,niter,fitpm=True):
 
     return objtab,meastab
 
-def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,verbose=True):
+def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,nprocs=None,verbose=True):
     """
     ALLFRAME-like forced photometry.
 
@@ -872,6 +1565,9 @@ def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,verbose=True
          By default, the mean JD of all images is used.
     maxiter : int, optional
        Maximum iterations.  Default is 50.
+    nprocs : int, optional
+       Number of processes to use to solve the images in parallel.
+         Default is the number of CPUs or images, whichever is smaller.
     verbose : bool, optional
        Verbose output to the screen.  Default is False.
 
@@ -938,15 +1634,18 @@ def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,verbose=True
     print('Master list has {:d} stars'.format(nobj))
         
     # Make sure we have the necessary columns
-    for c in mastertab.colnames: mastertab[c].name = c.lower()
+    mastertab.rename_columns(mastertab.colnames,[c.lower() for c in mastertab.colnames])
     if 'ra' not in mastertab.colnames or 'dec' not in mastertab.colnames:
         raise ValueError('ra and dec columns must exist in mastertab')
 
     # Initialize the array of positions and proper motions
     objtab,meastab,objindex,iminfo = initialize_catalogs(iminfo,mastertab)
-    
-    # Initial master list coordinates
-    coo0 = SkyCoord(ra=objtab['cenra']*u.deg,dec=objtab['cendec']*u.deg,frame='icrs')
+
+    # The source catalogs and headers are not needed anymore, free them
+    for i in range(nimages):
+        iminfo[i]['table'] = None
+        iminfo[i]['header'] = None
+    gc.collect()
     
     # Some stars have zero measurements
     zeromeas, = np.where(objtab['nmeas']==0)
@@ -966,197 +1665,169 @@ def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,verbose=True
            ('cenpmdec',float),('chisq',float)]
     last_obj = np.zeros(len(objtab),dtype=np.dtype(ldt))
         
-    # Iterate until convergence has been reached
-    count = 0
-    flag = 0
-    #lastvalues = np.zeros(len(meastab),dtype=np.dtype([('flux',float),('dx',float),('dy',float)]))
-    while (flag==0):
+    # Process pool for the images
+    #  each worker solves one image at a time with a single numba thread
+    if nprocs is None:
+        nprocs = min(os.cpu_count(),nimages)
+    if nprocs > 1:
+        executor = ProcessPoolExecutor(max_workers=nprocs,initializer=set_num_threads,initargs=(1,))
+    else:
+        executor = None
+        
+    # Shut the pool down even if an iteration fails
+    try:
+        # Iterate until convergence has been reached
+        count = 0
+        flag = 0
+        #lastvalues = np.zeros(len(meastab),dtype=np.dtype([('flux',float),('dx',float),('dy',float)]))
+        while (flag==0):
 
-        print('----- Iteration {:d} -----'.format(count+1))
+            print('----- Iteration {:d} -----'.format(count+1))
 
-        if count % 5 == 0:
-            print('Recomputing and subtracting the sky')
+            if count % 5 == 0:
+                print('Recomputing and subtracting the sky')
 
-        # On first iteration, only fit amplitude (not centroid)
-        if count==0:
-            recenter = False
-            print('NOT recentering')
-        else:
-            recenter = True
-            print('Recentering')
-
-        # Loop over the images:
-        for i in range(nimages):
-            wcs = iminfo[i]['wcs']
-            psf = iminfo[i]['psf']
-            residfile = iminfo[i]['residfile']
-            imtime = Time(iminfo[i]['jd'],format='jd')
-            
-            # Get the objects and measurements that overlap this image
-            contained = coo0.contained_by(iminfo[i]['wcs'])
-            objtab1 = objtab[contained]
-            msbeg = iminfo[i]['startmeas']
-            msend = msbeg + iminfo[i]['nmeas']
-            meastab1 = meastab[msbeg:msend]
-            meastab1['converged'] = objtab1['converged']
-            print('Image {:d}  {:d} stars'.format(i+1,iminfo[i]['nmeas']))
-
-            # Check that meastab1 and objtab1 are ordered correctly
-            if np.sum(meastab1['objid'] != objtab1['objid']) > 0:
-                raise Exception('Image object and measurement tables are out of order')
-            
-            # Calculate x/y position for each object in this image
-            # using the current best overall on-sky position
-            # and proper motion
-            # Need to convert celestial values to x/y position in
-            # the image using the WCS.            
-            measra,measdec,measx,measy = compute_image_coordinates(objtab1,wcs,imtime,refepoch)
-            meastab1['ra'] = measra
-            meastab1['dec'] = measdec
-            meastab1['x'] = measx
-            meastab1['y'] = measy
-            
-            # Initialize or load the residual image
+            # On first iteration, only fit amplitude (not centroid)
             if count==0:
-                im = CCDData.read(iminfo[i]['file'])
-                resid = im.copy()
-                resid.skysubtracted = False
+                recenter = False
+                print('NOT recentering')
             else:
-                resid = dln.unpickle(residfile)
-                
-            # Subtract sky
-            if count % 5 == 0:
-                print('Subtracting the sky')
-                if count==0:
-                    resid.data -= resid.sky   # subtract the sky
-                    resid.skysubtracted = True
-                else:
-                    # Add "current" sky image back in
-                    resid.data += resid.sky
-                    # Force the sky to be recomputed
-                    if hasattr(resid,'_sky'):
-                        resid._sky = None
-                    resid.data -= resid.sky  # subtract new sky
-                    resid.skysubtracted = True                    
-
-            # only fit measurements that have not converged yet
-            
-            # Fit the fluxes while holding the positions fixed
-            imchisq0 = np.sum(resid.data**2/resid.error**2)/resid.size
-            out,resid = solve(psf,resid,meastab1,recenter=recenter,verbose=verbose)
-
-            imchisq = np.sum(resid.data**2/resid.error**2)/resid.size
-            iminfo[i]['imchisq'] = imchisq
-            srcchisq = np.sum(out['chisq']*out['npix'])/np.sum(out['npix'])
-            medschisq = np.median(out['chisq'])
-            iminfo[i]['srcchisq'] = srcchisq
-            print('image chisq',imchisq0,imchisq)
-            print('source chisq',srcchisq)
-            print('median source chisq',medschisq)
-
-            #if imchisq>imchisq0:
-            #    import pdb; pdb.set_trace()            
-            
-            # I THINK THIS IS SLOW BECAUSE IT IS DOING ONE STAR AT A TIME AND
-            # USING A LOOP IN PYTHON.  Try to jaxify it!
-            
-            # Convert dx/dy to dra/ddec
-            #  these will be used later to compute proper motions
-            coo2 = wcs.pixel_to_world(meastab1['x']+out['dx'],meastab1['y']+out['dy'])
-            dra = coo2.ra.deg - meastab1['ra']
-            ddec = coo2.dec.deg - meastab1['dec']
-            out['dra'] = dra    # in degrees of RA (not true angle)
-            out['ddec'] = ddec  # in degrees
-            
-            # Save the residual file
-            dln.pickle(residfile,resid)
-            
-            # SOMETHING IS WRONG, I THINK THE PSF MIGHT NOT BE GOOD
-
-            #from dlnpyutils import plotting as pl 
-            #import pdb; pdb.set_trace()
+                recenter = True
+                print('Recentering')
+
+            # Get the objects and measurements that overlap each image
+            imargs = []
+            for i in range(nimages):
+                contained = iminfo[i]['contained']
+                objtab1 = objtab[contained]
+                msbeg = iminfo[i]['startmeas']
+                msend = msbeg + iminfo[i]['nmeas']
+                meastab1 = meastab[msbeg:msend]
+                # Measurements are only kept fixed while their object has
+                #  converged, otherwise the object may have moved and they
+                #  are refit at the new position
+                meastab1['converged'] &= objtab1['converged']
+                print('Image {:d}  {:d} stars'.format(i+1,iminfo[i]['nmeas']))
+
+                # Check that meastab1 and objtab1 are ordered correctly
+                if np.sum(meastab1['objid'] != objtab1['objid']) > 0:
+                    raise Exception('Image object and measurement tables are out of order')
+
+                imargs.append((iminfo[i]['file'],iminfo[i]['residfile'],iminfo[i]['wcs'],
+                               iminfo[i]['psf'],iminfo[i]['jd'],objtab1,meastab1,count,
+                               refepoch,recenter,verbose))
+
+            # Solve the images, they are independent within an iteration
+            if executor is not None:
+                futures = [executor.submit(solveimage,*a) for a in imargs]
+                results = [f.result() for f in futures]
+            else:
+                results = [solveimage(*a) for a in imargs]
+            del imargs
             
-            # Stuff the information back in
-            meastab['damp'][msbeg:msend] = out['amp']-meastab['amp'][msbeg:msend]
-            meastab['amp'][msbeg:msend] = out['amp']
-            meastab['flux'][msbeg:msend] = out['amp']*psf.flux()
-            meastab['fluxerr'][msbeg:msend] = out['amp_error']*psf.flux()  
-            meastab['ra'][msbeg:msend] = out['ra']
-            meastab['dec'][msbeg:msend] = out['dec']
-            meastab['dx'][msbeg:msend] = out['dx']
-            meastab['dy'][msbeg:msend] = out['dy']
-            meastab['dra'][msbeg:msend] = out['dra']
-            meastab['ddec'][msbeg:msend] = out['ddec']
-            meastab['chisq'][msbeg:msend] = out['chisq']            
+            # Loop over the images:
+            for i in range(nimages):
+                psf = iminfo[i]['psf']
+                msbeg = iminfo[i]['startmeas']
+                msend = msbeg + iminfo[i]['nmeas']
+                out,imchisq,srcchisq = results[i]
+                iminfo[i]['imchisq'] = imchisq
+                iminfo[i]['srcchisq'] = srcchisq
             
-            # allframe operates on the residual map, with the best-fit model subtracted
+                # Stuff the information back in
+                meastab['damp'][msbeg:msend] = out['amp']-meastab['amp'][msbeg:msend]
+                meastab['amp'][msbeg:msend] = out['amp']
+                meastab['flux'][msbeg:msend] = out['amp']*psf.flux()
+                meastab['fluxerr'][msbeg:msend] = out['amp_error']*psf.flux()  
+                meastab['ra'][msbeg:msend] = out['ra']
+                meastab['dec'][msbeg:msend] = out['dec']
+                meastab['x'][msbeg:msend] = out['x']
+                meastab['y'][msbeg:msend] = out['y']
+                meastab['dx'][msbeg:msend] = out['dx']
+                meastab['dy'][msbeg:msend] = out['dy']
+                meastab['dra'][msbeg:msend] = out['dra']
+                meastab['ddec'][msbeg:msend] = out['ddec']
+                meastab['chisq'][msbeg:msend] = out['chisq']
+                meastab['converged'][msbeg:msend] = out['converged']
+
+                # allframe operates on the residual map, with the best-fit model subtracted
             
-            # allframe derives flux and centroid corrections for each object
-            # the flux corrections are applied immediately while the centroid
-            # corrections are saved.
-
-            # there are no groups in allframe
-            # the least-squares design matrix is completely diagonalized: the
-            # incremental brightness and position corrections are derived for
-            # each star separately!  this may add a few more iterations for the
-            # badly blended stars, but it does *not* affect the accuracy of the
-            # final results.
-
-            # Once a star has converged, it's best-fit model is subtracted from
-            # the residual map and its parameters are fixed.
+                # allframe derives flux and centroid corrections for each object
+                # the flux corrections are applied immediately while the centroid
+                # corrections are saved.
+
+                # there are no groups in allframe
+                # the least-squares design matrix is completely diagonalized: the
+                # incremental brightness and position corrections are derived for
+                # each star separately!  this may add a few more iterations for the
+                # badly blended stars, but it does *not* affect the accuracy of the
+                # final results.
+
+                # Once a star has converged, it's best-fit model is subtracted from
+                # the residual map and its parameters are fixed.
             
-            # when no further infinitesimal change to a star's parameters
-            # produces any reduction in the robust estimate of the mean-square
-            # brightness residual inside that star's fitting region, the
-            # maximum-likelihood solution has been achieved.
+                # when no further infinitesimal change to a star's parameters
+                # produces any reduction in the robust estimate of the mean-square
+                # brightness residual inside that star's fitting region, the
+                # maximum-likelihood solution has been achieved.
             
-            # Calculate dx/dy residuals for each source
-            # convert from pixel to world offset using image wcs
+                # Calculate dx/dy residuals for each source
+                # convert from pixel to world offset using image wcs
 
-            # need to save the residual image and uncertainties
-            # that's all we need to solve the least-squares problem.
+                # need to save the residual image and uncertainties
+                # that's all we need to solve the least-squares problem.
 
             
-        # Calculate new coordinates and proper motions based on the x/y residuals
-        # the accumulated centroid corrections are projected through the individual
-        # frames' geometric transformations to the coordinate system of the master list
-        # and averaged.  These net corrections are applied to the stars' positions as
-        # retained in the master list.
-
-        # Can also make modest corrections to the input geometric transformation
-        # equations by evaluating and removing systematic trends in the centroid
-        # corrections derived for stars in each input image.
-
-        # Update the central coordinates and proper motions
-        print('Updating object coordinates and proper motions')
-        objtab1 = objtab.copy()
-        objtab = update_object(objtab,meastab,objindex,refepoch,fitpm=fitpm)
-
-        # ONLY FIT PROPER MOTION EVERY FEW ITERATIONS!!
-        
-        # Check for convergence
-        #   individual stars can converge
-        if count > 0:
-            objtab,meastab = check_convergence(objtab,meastab,objindex,last_obj,count+1,fitpm=fitpm)
+            # Calculate new coordinates and proper motions based on the x/y residuals
+            # the accumulated centroid corrections are projected through the individual
+            # frames' geometric transformations to the coordinate system of the master list
+            # and averaged.  These net corrections are applied to the stars' positions as
+            # retained in the master list.
+
+            # Can also make modest corrections to the input geometric transformation
+            # equations by evaluating and removing systematic trends in the centroid
+            # corrections derived for stars in each input image.
 
-        nconverged = np.sum(objtab['converged'])
-        print('Nconverged = {:d}'.format(nconverged))
+            # Update the central coordinates and proper motions
+            print('Updating object coordinates and proper motions')
+            objtab = update_object(objtab,meastab,objindex,refepoch,fitpm=fitpm)
 
-        if (len(objtab)-nconverged)==0 or (count+1)>=maxiter:
-            flag = 1
+            # ONLY FIT PROPER MOTION EVERY FEW ITERATIONS!!
         
-        # Save object values to help check for convergence next time
-        last_obj['cenra'] = objtab['cenra']
-        last_obj['cendec'] = objtab['cendec']
-        last_obj['cenpmra'] = objtab['cenpmra']
-        last_obj['cenpmdec'] = objtab['cenpmdec']
-        last_obj['chisq'] = objtab['chisq']        
-
-        # Increment iteration counter
-        count += 1
+            # Check for convergence
+            #   individual stars can converge
+            if count > 0:
+                objtab,meastab = check_convergence(objtab,meastab,objindex,last_obj,count+1,fitpm=fitpm)
+
+            nconverged = np.sum(objtab['converged'])
+            nmeasconverged = np.sum(meastab['converged'])
+            print('Nconverged = {:d}'.format(nconverged))
+            print('Nmeasconverged = {:d}'.format(nmeasconverged))
+
+            # Done when all objects or all measurements have converged
+            if (len(objtab)-nconverged)==0 or (len(meastab)-nmeasconverged)==0 or (count+1)>=maxiter:
+                flag = 1
+        
+            # Save object values to help check for convergence next time
+            last_obj['cenra'] = objtab['cenra']
+            last_obj['cendec'] = objtab['cendec']
+            last_obj['cenpmra'] = objtab['cenpmra']
+            last_obj['cenpmdec'] = objtab['cenpmdec']
+            last_obj['chisq'] = objtab['chisq']        
+
+            # Increment iteration counter
+            count += 1
             
-        #import pdb; pdb.set_trace()
+            #import pdb; pdb.set_trace()
+
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
+    # Convert to tables
+    objtab = Table(objtab)
+    meastab = Table(meastab)
+        
     # Create magnitudes, corrected for exposure time
     meastab = make_magnitudes(meastab,iminfo)
         
@@ -1166,7 +1837,5 @@ def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,verbose=True
 
     dt = time.time()-t0
     print('dt = {:.1f} sec'.format(dt))
-    
-    import pdb; pdb.set_trace()
         
     return objtab,meastab
@@ -18,15 +18,19 @@ import astropy.units as u
 from scipy.optimize import curve_fit, least_squares, line_search
 from scipy.interpolate import interp1d,interp2d
 from scipy.interpolate import RectBivariateSpline
+from scipy import ndimage
+from numpy.lib.stride_tricks import sliding_window_view
 #from astropy.nddata import CCDData,StdDevUncertainty
 from dlnpyutils import utils as dln, bindata, ladfit, coords
 from scipy.spatial import cKDTree
 import copy
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import time
 import matplotlib
 import sep
 from . import leastsquares as lsq,models,utils
+from .utils_numba import nanmedmad3d, nanmedmad
 from .ccddata import CCDData
 
 # Fit a PSF model to multiple stars in an image
@@ -49,7 +53,7 @@ def starcube(cat,image,npix=51,fillvalue=np.nan):
     Returns
     -------
     cube : numpy array
-       Two-dimensional cube (Npix,Npix,Nstars) of the star images.
+       Three-dimensional cube (Nstars,Npix,Npix) of the star images.
 
     Example
     -------
@@ -61,37 +65,75 @@ def starcube(cat,image,npix=51,fillvalue=np.nan):
     # Get the residuals data
     nstars = len(cat)
     nhpix = npix//2
-    cube = np.zeros((npix,npix,nstars),float)
-    xx,yy = np.meshgrid(np.arange(npix)-nhpix,np.arange(npix)-nhpix)
-    rr = np.sqrt(xx**2+yy**2)        
-    x = xx[0,:]
-    y = yy[:,0]
-    for i in range(nstars):
-        xcen = cat['x'][i]            
-        ycen = cat['y'][i]
-        bbox = models.starbbox((xcen,ycen),image.shape,nhpix)
-        im = image[bbox.slices]
-        flux = image.data[bbox.slices]-image.sky[bbox.slices]
-        err = image.error[bbox.slices]
-        if 'amp' in cat.columns:
-            amp = cat['amp'][i]
-        elif 'peak' in cat.columns:
-            amp = cat['peak'][i]
-        else:
-            amp = flux[int(np.round(ycen)),int(np.round(xcen))]
-        xim,yim = np.meshgrid(im.x,im.y)
-        xim = xim.astype(float)-xcen
-        yim = yim.astype(float)-ycen
-        # We need to interpolate this onto the grid
-        f = RectBivariateSpline(yim[:,0],xim[0,:],flux/amp)
-        im2 = np.zeros((npix,npix),float)+np.nan
-        xcover = (x>=bbox.ixmin-xcen) & (x<=bbox.ixmax-1-xcen)
-        xmin,xmax = dln.minmax(np.where(xcover)[0])
-        ycover = (y>=bbox.iymin-ycen) & (y<=bbox.iymax-1-ycen)
-        ymin,ymax = dln.minmax(np.where(ycover)[0])            
-        im2[ymin:ymax+1,xmin:xmax+1] = f(y[ycover],x[xcover],grid=True)
-        # Stuff it into 3D array
-        cube[:,:,i] = im2
+    ny,nx = image.shape
+    xcen = np.array(cat['x'],float)
+    ycen = np.array(cat['y'],float)
+    ixcen = np.round(xcen).astype(int)
+    iycen = np.round(ycen).astype(int)
+    # Gather all of the cutouts at once, with two extra pixels on each
+    #  side for the cubic interpolation.  Stars fully on the image are
+    #  picked straight out of a (view-only) sliding window of the image.
+    #  Near the edges, pixels off the image are replicated from the edge
+    #  and masked at the end.
+    nbuf = 2
+    nhs = nhpix+nbuf
+    ns = 2*nhs+1
+    flux = np.zeros((nstars,ns,ns),float)
+    inside = ((ixcen>=nhs) & (ixcen<=nx-1-nhs) &
+              (iycen>=nhs) & (iycen<=ny-1-nhs))
+    if np.sum(inside)>0:
+        ylo = iycen[inside]-nhs
+        xlo = ixcen[inside]-nhs
+        flux[inside] = (sliding_window_view(image.data,(ns,ns))[ylo,xlo] -
+                        sliding_window_view(image.sky,(ns,ns))[ylo,xlo])
+    edge, = np.where(~inside)
+    if len(edge)>0:
+        soff = np.arange(-nhs,nhs+1)
+        sx = np.clip(ixcen[edge].reshape(-1,1)+soff,0,nx-1)
+        sy = np.clip(iycen[edge].reshape(-1,1)+soff,0,ny-1)
+        flux[edge] = (image.data[sy[:,:,None],sx[:,None,:]] -
+                      image.sky[sy[:,:,None],sx[:,None,:]])
+    if 'amp' in cat.columns:
+        amp = np.array(cat['amp'],float)
+    elif 'peak' in cat.columns:
+        amp = np.array(cat['peak'],float)
+    else:
+        amp = flux[:,nhs,nhs]
+    flux /= amp.reshape(-1,1,1)
+
+    # We need to interpolate this onto the grid
+    #  the sub-pixel shift is the same for all pixels of a star, so the
+    #  cubic spline interpolation is separable and can be written as
+    #  Wy * coef * Wx.T for all stars at once
+    coef = ndimage.spline_filter1d(flux,3,axis=1,mode='nearest')
+    coef = ndimage.spline_filter1d(coef,3,axis=2,mode='nearest')
+    def splineweights(frac):
+        """ Cubic B-spline interpolation matrix for a constant shift."""
+        fl = np.floor(frac)
+        t = (frac-fl).reshape(-1,1)
+        w = np.hstack(((1-t)**3/6, (3*t**3-6*t**2+4)/6,
+                       (-3*t**3+3*t**2+3*t+1)/6, t**3/6))
+        wmat = np.zeros((nstars,npix,ns),float)
+        sind = np.arange(nstars).reshape(-1,1)
+        k = np.arange(npix).reshape(1,-1)
+        lo = (nbuf+fl-1).astype(int).reshape(-1,1)
+        for a in range(4):
+            wmat[sind,k,lo+k+a] = w[:,a].reshape(-1,1)
+        return wmat
+    wx = splineweights(xcen-ixcen)
+    wy = splineweights(ycen-iycen)
+    # Fortran order keeps each pixel's star values contiguous for the
+    #  per-pixel reductions in mkempirical
+    cube = np.empty((nstars,npix,npix),float,order='F')
+    np.matmul(np.matmul(wy,coef),wx.transpose(0,2,1),out=cube)
+
+    # Mask the pixels that are off the image
+    off = np.arange(npix)-nhpix
+    xim = xcen.reshape(-1,1)+off
+    yim = ycen.reshape(-1,1)+off
+    bad = (((yim<0) | (yim>ny-1))[:,:,None] |
+           ((xim<0) | (xim>nx-1))[:,None,:])
+    cube[bad] = fillvalue
     return cube
 
 def mkempirical(cube,order=0,coords=None,shape=None,rect=False,lookup=False):
@@ -103,7 +145,7 @@ def mkempirical(cube,order=0,coords=None,shape=None,rect=False,lookup=False):
     ----------
     cube : numpy array
       Three-dimensional cube of star images (or residual images) of shape
-        (Npix,Npix,Nstars).
+        (Nstars,Npix,Npix).
     order : int, optional
       The order of the variations. 0-constant, 1-linear terms.  If order=1,
         Then coords and shape must be input.
@@ -138,33 +180,30 @@ def mkempirical(cube,order=0,coords=None,shape=None,rect=False,lookup=False):
 
     """
 
-    ny,nx,nstar = cube.shape
+    nstar,ny,nx = cube.shape
     npix = ny
     nhpix = ny//2
     
     # Do outlier rejection in each pixel
-    med = np.nanmedian(cube,axis=2)
+    #  the star axis is first, and contiguous for Fortran-ordered cubes
+    med,sig = nanmedmad3d(cube)
     bad = ~np.isfinite(med)
     if np.sum(bad)>0:
         med[bad] = np.nanmedian(med)
-    sig = dln.mad(cube,axis=2)
     bad = ~np.isfinite(sig)
     if np.sum(bad)>0:
         sig[bad] = np.nanmedian(sig)        
     # Mask outlier points
-    outliers = ((np.abs(cube-med.reshape((med.shape)+(-1,)))>3*sig.reshape((med.shape)+(-1,)))
-                & np.isfinite(cube))
-    nbadstar = np.sum(outliers,axis=(0,1))
-    goodmask = ((np.abs(cube-med.reshape((med.shape)+(-1,)))<3*sig.reshape((med.shape)+(-1,)))
-                & np.isfinite(cube))    
+    outliers = ((np.abs(cube-med)>3*sig) & np.isfinite(cube))
+    nbadstar = np.sum(outliers,axis=(1,2))
+    goodmask = ((np.abs(cube-med)<3*sig) & np.isfinite(cube))    
     # Now take the mean of the unmasked pixels
-    macube = np.ma.array(cube,mask=~goodmask)
-    medim = macube.mean(axis=2)
-    medim = medim.data
+    ngood = np.sum(goodmask,axis=0)
+    medim = np.sum(np.where(goodmask,cube,0.0),axis=0)/np.maximum(ngood,1)
     
     # Check how well each star fits the median
-    goodpix = macube.count(axis=(0,1))
-    rms = np.sqrt(np.nansum((cube-medim.reshape((medim.shape)+(-1,)))**2,axis=(0,1))/goodpix)
+    goodpix = np.sum(goodmask,axis=(1,2))
+    rms = np.sqrt(np.nansum((cube-medim)**2,axis=(1,2))/goodpix)
 
     xx,yy = np.meshgrid(np.arange(npix)-nhpix,np.arange(npix)-nhpix)
     rr = np.sqrt(xx**2+yy**2)        
@@ -195,7 +234,7 @@ def mkempirical(cube,order=0,coords=None,shape=None,rect=False,lookup=False):
         # Loop over pixels and fit line to x/y
         for i in range(ny):
             for j in range(nx):
-                data1 = cube[i,j,:]
+                data1 = cube[:,i,j]
                 if np.sum(np.abs(data1)) != 0:
                     # maybe use a small maxiter
                     pars1,perror1 = utils.poly2dfit(relx,rely,data1)
@@ -335,8 +374,11 @@ def subtractnei(image,allcat,psfcat,psf):
 
 class PSFFitter(object):
 
-    def __init__(self,psf,image,cat,fitradius=None,verbose=False):
+    def __init__(self,psf,image,cat,fitradius=None,verbose=False,nthreads=1):
         self.verbose = verbose
+        # Number of threads to refit the stars with, psf.fit() is mostly
+        #  Python and numpy and holds the GIL, so the default is serial
+        self.nthreads = nthreads
         self.psf = psf
         self.image = image
         self.cat = cat
@@ -451,131 +493,142 @@ class PSFFitter(object):
                 psf._params[i] = np.minimum(np.maximum(args[i],lbnds[i]),ubnds[i])
                 
         # Loop over the stars and generate the model image
+        #  the stars are independent, so they are refit in threads
         allim = np.zeros(self.ntotpix,float)
-        pixcnt = 0
+        def fitone(i):
+            return self.fitstar(i,psf,refit=refit,verbose=verbose)
+        if self.nthreads>1 and self.nstars>1:
+            with ThreadPoolExecutor(max_workers=self.nthreads) as executor:
+                allmodel = list(executor.map(fitone,range(self.nstars)))
+        else:
+            allmodel = [fitone(i) for i in range(self.nstars)]
         for i in range(self.nstars):
-            image = self.imdata[i]
-            amp = self.staramp[i]
-            xcenorig = self.starxcenorig[i]   
-            ycenorig = self.starycenorig[i]
-            xcen = self.starxcen[i]   
-            ycen = self.starycen[i]            
-            bbox = self.bboxdata[i]
-            x = self.xlist[i]
-            y = self.ylist[i]
             pixstart = self.pixstart[i]
             npix = self.npix[i]
-            flux = self.imflatten[pixstart:pixstart+npix]
-            err = self.errflatten[pixstart:pixstart+npix]
+            allim[pixstart:pixstart+npix] = allmodel[i]
             
-            #xy = self.xydata[i]
-            #x = np.arange(xy[0][0],xy[0][1]+1).astype(float)
-            #y = np.arange(xy[1][0],xy[1][1]+1).astype(float)
-            #rr = np.sqrt( (x-xcen).reshape(-1,1)**2 + (y-ycen).reshape(1,-1)**2 )
-            #mask = rr>self.fitradius
-
-            x0orig = xcenorig - bbox.ixmin
-            y0orig = ycenorig - bbox.iymin
-            x0 = xcen - bbox.ixmin
-            y0 = ycen - bbox.iymin            
+        self.niter += 1
             
-            # Fit amp/xcen/ycen if niter=1
-            if refit:
-                #if (self.niter<=1): # or self.niter%3==0):
-                if self.niter>-1:
-                    # force the positions to stay within +/-2 pixels of the original values
-                    bounds = (np.array([0,np.maximum(x0orig-2,0),np.maximum(y0orig-2,0),-np.inf]),
-                              np.array([np.inf,np.minimum(x0orig+2,bbox.shape[1]-1),np.minimum(y0orig+2,bbox.shape[0]-1),np.inf]))
-                    # the image still has sky in it, use sky (nosky=False)
-                    if np.isfinite(psf.fwhm())==False:
-                        print('nan fwhm')
-                        import pdb; pdb.set_trace()
-                    pars,perror,model = psf.fit(image,[amp,x0,y0],nosky=False,retpararray=True,niter=5,bounds=bounds)
-                    xcen += (pars[1]-x0)
-                    ycen += (pars[2]-y0)
-                    amp = pars[0]                    
-                    self.staramp[i] = amp
-                    self.starxcen[i] = xcen
-                    self.starycen[i] = ycen
-                    model = psf(x,y,pars=[amp,xcen,ycen])
-                    if verbose:
-                        print('Star '+str(i)+' Refitting all parameters')
-                        print(str([amp,xcen,ycen]))
-
-                    #pars2,model2,mpars2 = psf.fit(image,[amp,x0,y0],nosky=False,niter=5,allpars=True)
-                    #import pdb; pdb.set_trace()
-                        
-                # Only fit amp if niter>1
-                #   do it empirically
-                else:
-                    #im1 = psf(pars=[1.0,xcen,ycen],bbox=bbox)
-                    #wt = 1/image.error**2
-                    #amp = np.median(image.data[mask]/im1[mask])                
-                    model1 = psf(x,y,pars=[1.0,xcen,ycen])
-                    wt = 1/err**2
-                    amp = np.median(flux/model1)
-                    #amp = np.median(wt*flux/model1)/np.median(wt)
-
-
-                    #count = 0
-                    #percdiff = 1e30
-                    #while (count<3 and percdiff>0.1):                  
-                    #    m,jac = psf.jac(np.vstack((x,y)),*[amp,xcen,ycen],retmodel=True)
-                    #    jac = np.delete(jac,[1,2],axis=1)
-                    #    dy = flux-m
-                    #    dbeta = lsq.jac_solve(jac,dy,method='cholesky',weight=wt)
-                    #    print(count,amp,dbeta)
-                    #    amp += dbeta
-                    #    percdiff = np.abs(dbeta)/np.abs(amp)*100
-                    #    count += 1
-                        
-                    #pars2,perror2,model2 = psf.fit(image,[amp,x0,y0],nosky=False,retpararray=True,niter=5)
-                    #amp = pars2[0]
-                    #model = psf(x,y,pars=[amp,xcen,ycen])
-                    
-                    self.staramp[i] = amp
-                    model = model1*amp
-                    #self.starxcen[i] = pars2[1]+xy[0][0]
-                    #self.starycen[i] = pars2[2]+xy[1][0]       
-                    #print(count,self.starxcen[i],self.starycen[i])
-                    # updating the X/Y values after the first iteration
-                    #  causes problems.  bounces around too much
-
-                    if verbose:
-                        print('Star '+str(i)+' Refitting amp empirically')
-                        print(str(amp))
-                        
-                    #if i==1: print(amp)
-                    #if self.niter==2:
-                    #    import pdb; pdb.set_trace()
-
-            # No refit of stellar parameters
-            else:
+        return allim
+
+    def fitstar(self,i,psf,refit=True,verbose=False):
+        """ Refit (if refit=True) and model one star with the input PSF.
+            This only updates the values of star i, so stars can be done
+            in parallel."""
+        image = self.imdata[i]
+        amp = self.staramp[i]
+        xcenorig = self.starxcenorig[i]   
+        ycenorig = self.starycenorig[i]
+        xcen = self.starxcen[i]   
+        ycen = self.starycen[i]            
+        bbox = self.bboxdata[i]
+        x = self.xlist[i]
+        y = self.ylist[i]
+        pixstart = self.pixstart[i]
+        npix = self.npix[i]
+        flux = self.imflatten[pixstart:pixstart+npix]
+        err = self.errflatten[pixstart:pixstart+npix]
+        
+        #xy = self.xydata[i]
+        #x = np.arange(xy[0][0],xy[0][1]+1).astype(float)
+        #y = np.arange(xy[1][0],xy[1][1]+1).astype(float)
+        #rr = np.sqrt( (x-xcen).reshape(-1,1)**2 + (y-ycen).reshape(1,-1)**2 )
+        #mask = rr>self.fitradius
+
+        x0orig = xcenorig - bbox.ixmin
+        y0orig = ycenorig - bbox.iymin
+        x0 = xcen - bbox.ixmin
+        y0 = ycen - bbox.iymin            
+        
+        # Fit amp/xcen/ycen if niter=1
+        if refit:
+            #if (self.niter<=1): # or self.niter%3==0):
+            if self.niter>-1:
+                # force the positions to stay within +/-2 pixels of the original values
+                bounds = (np.array([0,np.maximum(x0orig-2,0),np.maximum(y0orig-2,0),-np.inf]),
+                          np.array([np.inf,np.minimum(x0orig+2,bbox.shape[1]-1),np.minimum(y0orig+2,bbox.shape[0]-1),np.inf]))
+                # the image still has sky in it, use sky (nosky=False)
+                if np.isfinite(psf.fwhm())==False:
+                    raise ValueError('PSF FWHM is not finite')
+                pars,perror,model = psf.fit(image,[amp,x0,y0],nosky=False,retpararray=True,niter=5,bounds=bounds)
+                xcen += (pars[1]-x0)
+                ycen += (pars[2]-y0)
+                amp = pars[0]                    
+                self.staramp[i] = amp
+                self.starxcen[i] = xcen
+                self.starycen[i] = ycen
                 model = psf(x,y,pars=[amp,xcen,ycen])
+                if verbose:
+                    print('Star '+str(i)+' Refitting all parameters')
+                    print(str([amp,xcen,ycen]))
 
-            #if self.niter>1:
-            #    import pdb; pdb.set_trace()
+                #pars2,model2,mpars2 = psf.fit(image,[amp,x0,y0],nosky=False,niter=5,allpars=True)
+                #import pdb; pdb.set_trace()
+                    
+            # Only fit amp if niter>1
+            #   do it empirically
+            else:
+                #im1 = psf(pars=[1.0,xcen,ycen],bbox=bbox)
+                #wt = 1/image.error**2
+                #amp = np.median(image.data[mask]/im1[mask])                
+                model1 = psf(x,y,pars=[1.0,xcen,ycen])
+                wt = 1/err**2
+                amp = np.median(flux/model1)
+                #amp = np.median(wt*flux/model1)/np.median(wt)
+
+
+                #count = 0
+                #percdiff = 1e30
+                #while (count<3 and percdiff>0.1):                  
+                #    m,jac = psf.jac(np.vstack((x,y)),*[amp,xcen,ycen],retmodel=True)
+                #    jac = np.delete(jac,[1,2],axis=1)
+                #    dy = flux-m
+                #    dbeta = lsq.jac_solve(jac,dy,method='cholesky',weight=wt)
+                #    print(count,amp,dbeta)
+                #    amp += dbeta
+                #    percdiff = np.abs(dbeta)/np.abs(amp)*100
+                #    count += 1
+                    
+                #pars2,perror2,model2 = psf.fit(image,[amp,x0,y0],nosky=False,retpararray=True,niter=5)
+                #amp = pars2[0]
+                #model = psf(x,y,pars=[amp,xcen,ycen])
                 
-            # Relculate reduced chi squared
-            chisq = np.sum((flux-model.ravel())**2/err**2)/npix
-            self.starchisq[i] = chisq
-            # chi value, RMS of the residuals as a fraction of the amp
-            rms = np.sqrt(np.mean(((flux-model.ravel())/self.staramp[i])**2))
-            self.starrms[i] = rms
-            
-            #model = psf(x,y,pars=[amp,xcen,ycen])
-            # Zero-out anything beyond the fitting radius
-            #im[mask] = 0.0
-            #npix = im.size
-            #npix = len(x)
-            allim[pixcnt:pixcnt+npix] = model.flatten()
-            pixcnt += npix
+                self.staramp[i] = amp
+                model = model1*amp
+                #self.starxcen[i] = pars2[1]+xy[0][0]
+                #self.starycen[i] = pars2[2]+xy[1][0]       
+                #print(count,self.starxcen[i],self.starycen[i])
+                # updating the X/Y values after the first iteration
+                #  causes problems.  bounces around too much
+
+                if verbose:
+                    print('Star '+str(i)+' Refitting amp empirically')
+                    print(str(amp))
+                    
+                #if i==1: print(amp)
+                #if self.niter==2:
+                #    import pdb; pdb.set_trace()
 
-            #import pdb; pdb.set_trace()
-            
-        self.niter += 1
+        # No refit of stellar parameters
+        else:
+            model = psf(x,y,pars=[amp,xcen,ycen])
+
+        #if self.niter>1:
+        #    import pdb; pdb.set_trace()
             
-        return allim
+        # Relculate reduced chi squared
+        chisq = np.sum((flux-model.ravel())**2/err**2)/npix
+        self.starchisq[i] = chisq
+        # chi value, RMS of the residuals as a fraction of the amp
+        rms = np.sqrt(np.mean(((flux-model.ravel())/self.staramp[i])**2))
+        self.starrms[i] = rms
+        
+        #model = psf(x,y,pars=[amp,xcen,ycen])
+        # Zero-out anything beyond the fitting radius
+        #im[mask] = 0.0
+        #npix = im.size
+        #npix = len(x)
+        return model.flatten()
 
     
     def jac(self,x,*args,retmodel=False,refit=True):
@@ -747,7 +800,7 @@ class PSFFitter(object):
 
     
 def fitpsf(psf,image,cat,fitradius=None,method='qr',maxiter=10,minpercdiff=1.0,
-           verbose=False):
+           nthreads=1,verbose=False):
     """
     Fit PSF model to stars in an image.
 
@@ -771,6 +824,8 @@ def fitpsf(psf,image,cat,fitradius=None,method='qr',maxiter=10,minpercdiff=1.0,
        Minimum percent change in the parameters to allow until the solution is
        considered converged and the iteration loop is stopped.  Only for methods
        "qr" and "svd".  Default is 1.0.
+    nthreads : int, optional
+       Number of threads to refit the stars with.  Default is 1.
     verbose : boolean, optional
        Verbose output.
 
@@ -814,7 +869,7 @@ def fitpsf(psf,image,cat,fitradius=None,method='qr',maxiter=10,minpercdiff=1.0,
         coords = (cat['x'].data,cat['y'].data)
         epsf1,nbadstar1,rms1 = mkempirical(cube1,order=psf.order,coords=coords,shape=psf._shape)
         initpsf = models.PSFEmpirical(epsf1,imshape=image.shape,order=psf.order)
-        pf = PSFFitter(initpsf,image,cat,fitradius=fitradius,verbose=False)
+        pf = PSFFitter(initpsf,image,cat,fitradius=fitradius,verbose=False,nthreads=nthreads)
         # Fit the amp, xcen, ycen properly
         xdata = np.arange(pf.ntotpix)
         out = pf.model(xdata,[])
@@ -842,7 +897,7 @@ def fitpsf(psf,image,cat,fitradius=None,method='qr',maxiter=10,minpercdiff=1.0,
         return newpsf, None, None, psfcat, pf
 
     
-    pf = PSFFitter(psf,image,cat,fitradius=fitradius,verbose=False) #verbose)
+    pf = PSFFitter(psf,image,cat,fitradius=fitradius,verbose=False,nthreads=nthreads) #verbose)
     xdata = np.arange(pf.ntotpix)
     initpar = psf.params.copy()
     method = str(method).lower()
@@ -887,8 +942,8 @@ def fitpsf(psf,image,cat,fitradius=None,method='qr',maxiter=10,minpercdiff=1.0,
             #bestpar = psf.newpars(bestpar,dbeta,bounds,maxsteps)
             bestpar = psf.newpars(bestpar,new_dbeta,bounds,maxsteps)  
             diff = np.abs(bestpar-oldpar)
-            denom = np.abs(oldpar.copy())
-            denom[denom==0] = 1.0  # deal with zeros
+            denom = np.abs(oldpar)
+            denom = np.where(denom==0,1.0,denom)  # deal with zeros
             percdiff = np.max(diff/denom*100)
             dchisq = chisq-oldchisq
             percdiffchisq = dchisq/oldchisq*100
@@ -949,7 +1004,8 @@ def fitpsf(psf,image,cat,fitradius=None,method='qr',maxiter=10,minpercdiff=1.0,
 
     
 def getpsf(psf,image,cat,fitradius=None,lookup=False,lorder=0,method='qr',subnei=False,
-           allcat=None,maxiter=10,minpercdiff=1.0,reject=False,maxrejiter=3,verbose=False):
+           allcat=None,maxiter=10,minpercdiff=1.0,reject=False,maxrejiter=3,nthreads=1,
+           verbose=False):
     """
     Fit PSF model to stars in an image with outlier rejection of badly-fit stars.
 
@@ -986,6 +1042,8 @@ def getpsf(psf,image,cat,fitradius=None,lookup=False,lorder=0,method='qr',subnei
        Reject PSF stars with high RMS values.  Default is False.
     maxrejiter : int, boolean
        Maximum number of PSF star rejection iterations.  Default is 3.
+    nthreads : int, optional
+       Number of threads to refit the PSF stars with.  Default is 1.
     verbose : boolean, optional
        Verbose output.
 
@@ -1064,21 +1122,30 @@ def getpsf(psf,image,cat,fitradius=None,lookup=False,lorder=0,method='qr',subnei
     flag = 0
     nrejstar = 100
     fitrad = fitradius
-    useimage = image.copy()
+    fwhmpars = None   # PSF parameters that fitrad was last computed from
+    # fitpsf() only reads the image, so no copy is needed until the
+    #  neighbors are subtracted
+    useimage = image
     while (flag==0):
         if verbose:
             print('--- Iteration '+str(nrejiter+1)+' ---')                
 
         # Update the fitting radius
+        #  only re-evaluate the FWHM if the PSF parameters changed appreciably
         if nrejiter>0:
-            fitrad = curpsf.fwhm()
+            if type(curpsf)!=models.PSFEmpirical:
+                curpars = curpsf.params
+            else:
+                curpars = curpsf._data
+            if fwhmpars is None or np.sum(np.abs(curpars-fwhmpars))>0.01:
+                fitrad = curpsf.fwhm()
+                fwhmpars = curpars.copy()
         if verbose:
             print('  Fitting radius = %5.3f' % (fitrad))
                     
         # Reject outliers
         if reject and nrejiter>0:
-            medrms = np.median(pcat['rms'])
-            sigrms = dln.mad(pcat['rms'].data)
+            medrms,sigrms = nanmedmad(np.asarray(pcat['rms'],float))
             gd, = np.where(pcat['rms'] < medrms+3*sigrms)
             nrejstar = len(psfcat)-len(gd)
             if verbose:
@@ -1095,13 +1162,14 @@ def getpsf(psf,image,cat,fitradius=None,lookup=False,lorder=0,method='qr',subnei
                 # Find the neighbors in allcat
                 # Fit the neighbors and PSF stars
                 # Subtract neighbors from the image
-                useimage = image.copy()  # start with original image
-                useimage = subtractnei(useimage,allcat,cat,curpsf)
+                # start with original image, subtractnei() returns a copy
+                useimage = subtractnei(image,allcat,cat,curpsf)
                 
         # Fitting the PSF to the stars
         #-----------------------------
         newpsf,pars,perror,pcat,pf = fitpsf(curpsf,useimage,psfcat,fitradius=fitrad,method=method,
-                                            maxiter=maxiter,minpercdiff=minpercdiff,verbose=verbose)
+                                            maxiter=maxiter,minpercdiff=minpercdiff,nthreads=nthreads,
+                                            verbose=verbose)
         
         # Add information into the output catalog
         ind1,ind2 = dln.match(outcat['id'],pcat['id'])
@@ -1,13 +1,57 @@
 import os
 import numpy as np
-from numba import njit,types,from_dtype
+from numba import njit,prange,types,from_dtype
 from numba.experimental import jitclass
 from numba_kdtree import KDTree
 from . import models_numba as mnb, utils_numba as utils
 
 # Fit a PSF model to multiple stars in an image
 
-@njit
+@njit(inline='always')
+def cubicweights(t):
+    """ Bicubic convolution (a=-0.5) weights for the taps at -1,0,1,2."""
+    w0 = ((-0.5*t+1.0)*t-0.5)*t
+    w1 = (1.5*t-2.5)*t*t+1.0
+    w2 = ((-1.5*t+2.0)*t+0.5)*t
+    w3 = (0.5*t-0.5)*t*t
+    return w0,w1,w2,w3
+
+@njit(parallel=True,cache=True,nogil=True)
+def resamplestars(image,xcen,ycen,amp,npix,fillvalue):
+    """
+    Resample the amplitude-normalized image around each star onto a regular
+    (Npix,Npix) grid centered on the star using bicubic convolution.
+    Grid points off the image are set to fillvalue.
+    """
+    nstars = len(xcen)
+    ny,nx = image.shape
+    nhpix = npix//2
+    cube = np.zeros((nstars,npix,npix),float)
+    for s in prange(nstars):
+        for iy in range(npix):
+            yy = ycen[s]+iy-nhpix
+            y0 = int(np.floor(yy))
+            wy = cubicweights(yy-y0)
+            for ix in range(npix):
+                xx = xcen[s]+ix-nhpix
+                if xx<0 or xx>nx-1 or yy<0 or yy>ny-1:
+                    cube[s,iy,ix] = fillvalue
+                    continue
+                x0 = int(np.floor(xx))
+                wx = cubicweights(xx-x0)
+                val = 0.0
+                for q in range(4):
+                    # replicate the edge pixels
+                    yind = min(max(y0+q-1,0),ny-1)
+                    rowval = 0.0
+                    for p in range(4):
+                        xind = min(max(x0+p-1,0),nx-1)
+                        rowval += wx[p]*image[yind,xind]
+                    val += wy[q]*rowval
+                cube[s,iy,ix] = val/amp[s]
+    return cube
+
+@njit(cache=True,nogil=True)
 def starcube(tab,image,error,npix=51,fillvalue=np.nan):
     """
     Produce a cube of cutouts of stars.
@@ -26,7 +70,7 @@ def starcube(tab,image,error,npix=51,fillvalue=np.nan):
     Returns
     -------
     cube : numpy array
-       Two-dimensional cube (Npix,Npix,Nstars) of the star images.
+       Three-dimensional cube (Nstars,Npix,Npix) of the star images.
 
     Example
     -------
@@ -36,47 +80,15 @@ def starcube(tab,image,error,npix=51,fillvalue=np.nan):
     """
 
     # Get the residuals data
-    nstars = len(tab)
-    nhpix = npix//2
-    cube = np.zeros((npix,npix,nstars),float)
-    xx,yy = utils.meshgrid(np.arange(npix)-nhpix,np.arange(npix)-nhpix)
-    rr = np.sqrt(xx**2+yy**2)        
-    x = xx[0,:]
-    y = yy[:,0]
-    for i in range(nstars):
-        xcen = tab['x'][i]            
-        ycen = tab['y'][i]
-        bbox = mnb.starbbox((xcen,ycen),image.shape,nhpix)
-        flux = bbox.slice(image)
-        err = bbox.slice(error)
-        amp = tab['peak'][i]
-        xim,yim = bbox.xy()
-        xim = xim-xcen
-        yim = yim-ycen
-        # Need to interpolate onto a regular grid
-        im2 = np.zeros((npix,npix),float)+np.nan
-        xind, = np.where((x>=bbox.ixmin-xcen) & (x<=bbox.ixmax-1-xcen))
-        xmin,xmax = np.min(xind),np.max(xind)
-        yind, = np.where((y>=bbox.iymin-ycen) & (y<=bbox.iymax-1-ycen))
-        ymin,ymax = np.min(yind),np.max(yind)
-        # xx/yy are relative coordinates for the final interpolated image
-        #       i.e. [-3, -2, -1, 0, 1, 2, 3]
-        # xim/yim are relative coordinates for the original flux image
-        # for the interpolation we need coordinates relative to to (0,0) of the
-        #    flux image
-        fnx = xmax-xmin+1
-        fny = ymax-ymin+1
-        fxx = xx[ymin:ymax+1,xmin:xmax+1]-xim[0,0]   # relative to flux origin
-        fyy = yy[ymin:ymax+1,xmin:xmax+1]-yim[0,0]
-        fim = mnb.alinearinterp(flux,fxx,fyy)
-        fim = fim.reshape((fny,fnx))
-        im2[ymin:ymax+1,xmin:xmax+1] = fim
-        # Stuff it into 3D array
-        cube[:,:,i] = im2
+    xcen = tab['x'].astype(np.float64)
+    ycen = tab['y'].astype(np.float64)
+    amp = tab['peak'].astype(np.float64)
+    # Need to interpolate onto a regular grid
+    cube = resamplestars(image,xcen,ycen,amp,npix,fillvalue)
     return cube
 
 
-@njit
+@njit(parallel=True,cache=True,nogil=True)
 def mkempirical(cube,order=0,coords=None,shape=None,lookup=False):
     """
     Take a star cube and collapse it to make an empirical PSF using median
@@ -86,7 +98,7 @@ def mkempirical(cube,order=0,coords=None,shape=None,lookup=False):
     ----------
     cube : numpy array
       Three-dimensional cube of star images (or residual images) of shape
-        (Npix,Npix,Nstars).
+        (Nstars,Npix,Npix).
     order : int, optional
       The order of the variations. 0-constant, 1-linear terms.  If order=1,
         Then coords and shape must be input.
@@ -119,50 +131,59 @@ def mkempirical(cube,order=0,coords=None,shape=None,lookup=False):
 
     """
 
-    ny,nx,nstar = cube.shape
+    nstar,ny,nx = cube.shape
     npix = ny
     nhpix = ny//2
     
     # Do outlier rejection in each pixel
-    med = utils.median3d(cube,axis=2,ignore_nan=True)
+    #  the star axis is first so each pixel's samples are contiguous
+    med,sig = utils.nanmedmad3d(cube)
     bady,badx = np.where(np.isfinite(med)==False)
     if len(bady)>0:
         gdmed = utils.median(med,ignore_nan=True)
         for i in range(len(bady)):
             med[bady[i],badx[i]] = gdmed
-    sig = utils.mad3d(cube,axis=2,ignore_nan=True)
     bady,badx = np.where(np.isfinite(sig)==False)
     if len(bady)>0:
         gdsig = utils.median(sig,ignore_nan=True)
         for i in range(len(bady)):
             sig[bady[i],badx[i]] = gdsig
-    # Mask outlier points
-    bady,badx,badk = np.where((np.abs(cube-med.reshape((med.shape)+(-1,)))>3*sig.reshape((med.shape)+(-1,)))
-                              & np.isfinite(cube))
+    # Mean of the pixels without the outliers
+    medim = np.zeros((ny,nx),float)
+    for i in prange(ny):
+        for j in range(nx):
+            tot = 0.0
+            ngood = 0
+            for k in range(nstar):
+                val = cube[k,i,j]
+                if np.isfinite(val) and np.abs(val-med[i,j])<=3*sig[i,j]:
+                    tot += val
+                    ngood += 1
+            if ngood>0:
+                medim[i,j] = tot/ngood
+            else:
+                medim[i,j] = np.nan
+    # Remove any final NaNs
+    bady,badx = np.where(np.isfinite(medim)==False)
     if len(bady)>0:
-        macube = cube.copy()
+        gdmed = utils.median(medim,ignore_nan=True)
         for i in range(len(bady)):
-            macube[bady[i],badx[i],badk[i]] = np.nan
-        medim = utils.mean3d(macube,axis=2,ignore_nan=True)
-        # Remove any final NaNs
-        bady,badx = np.where(np.isfinite(medim)==False)
-        if len(bady)>0:
-            gdmed = utils.median(medim,ignore_nan=True)
-            for i in range(len(bady)):
-                medim[bady[i],badx[i]] = gdmed
-    else:
-        medim = med
+            medim[bady[i],badx[i]] = gdmed
 
     # Check how well each star fits the median
-    goodpix = np.sum(np.sum(np.isfinite(macube),axis=0),axis=0)
-    print('goodpix=',goodpix)
-    #goodpix = macube.count(axis=(0,1))
-    resid2 = (cube-medim.reshape((medim.shape)+(-1,)))**2
-    mnresid2 = utils.sum2d(utils.sum3d(resid2,axis=0,ignore_nan=True),axis=0,ignore_nan=True)/goodpix
-    rms = np.sqrt(mnresid2)
-    print('rms=',rms)
-    #print(utils.sum3d(dum,axis=0,ignore_nan=True))
-    #rms = np.sqrt(np.nansum((cube-medim.reshape((medim.shape)+(-1,)))**2,axis=(0,1))/goodpix)
+    rms = np.zeros(nstar,float)
+    for k in prange(nstar):
+        resid2 = 0.0
+        goodpix = 0
+        for i in range(ny):
+            for j in range(nx):
+                val = cube[k,i,j]
+                if np.isfinite(val)==False:
+                    continue
+                resid2 += (val-medim[i,j])**2
+                if np.abs(val-med[i,j])<=3*sig[i,j]:
+                    goodpix += 1
+        rms[k] = np.sqrt(resid2/max(goodpix,1))
 
     xx,yy = utils.meshgrid(np.arange(npix)-nhpix,np.arange(npix)-nhpix)
     rr = np.sqrt(xx**2+yy**2)        
@@ -191,9 +212,9 @@ def mkempirical(cube,order=0,coords=None,shape=None,lookup=False):
         xcen,ycen = coords[:,0],coords[:,1]
         relx,rely = mnb.relcoord(xcen,ycen,shape)
         # Loop over pixels and fit line to x/y
-        for i in range(ny):
+        for i in prange(ny):
             for j in range(nx):
-                data1 = cube[i,j,:]
+                data1 = cube[:,i,j]
                 if np.sum(np.abs(data1)) != 0:
                     # maybe use a small maxiter
                     pars1,perror1,pcov1 = utils.poly2dfit(relx,rely,data1,data1*0+1)
@@ -340,7 +361,7 @@ def subtractnei(image,error,alltab,psftab,psf):
         resid[bbox.slices].data -= im1
     return resid
 
-@njit
+@njit(inline='always')
 def starbbox(coords,imshape,radius):
     """                                                                                         
     Return the boundary box for a star given radius and image size.                             
@@ -356,8 +377,8 @@ def starbbox(coords,imshape,radius):
                                                                                                 
     Returns                                                                                     
     -------                                                                                     
-    bbox : BoundingBox object                                                                   
-       Bounding box of the x/y ranges.                                                          
+    bbox : tuple
+       Bounding box (xlo,xhi,ylo,yhi) of the x/y ranges.
        Upper values are EXCLUSIVE following the python convention.                              
                                                                                                 
     """
@@ -377,10 +398,14 @@ def starbbox(coords,imshape,radius):
     x1 = xcen+radius
     y0 = ycen-radius
     y1 = ycen+radius
-    xlo = np.maximum(int(np.round(x0-eta)),0)
-    xhi = np.minimum(int(np.round(x1-eta))+1,nx)
-    ylo = np.maximum(int(np.round(y0-eta)),0)
-    yhi = np.minimum(int(np.round(y1-eta))+1,ny)
+    xlo = int(np.round(x0-eta))
+    if xlo<0: xlo=0
+    xhi = int(np.round(x1-eta))+1
+    if xhi>nx: xhi=nx
+    ylo = int(np.round(y0-eta))
+    if ylo<0: ylo=0
+    yhi = int(np.round(y1-eta))+1
+    if yhi>ny: yhi=ny
     # add 1 at the upper end because those values are EXCLUDED
     # by the standard python convention
 
@@ -389,19 +414,9 @@ def starbbox(coords,imshape,radius):
     #xhi = np.minimum(int(np.ceil(xcen+radius+1)),nx)
     #ylo = np.maximum(int(np.floor(ycen-radius)),0)
     #yhi = np.minimum(int(np.ceil(ycen+radius+1)),ny)
-    return np.array([xlo,xhi,ylo,yhi])
-
-# @njit
-# def sliceinsert(array,lo,insert):
-#     """ Insert array values."""
-#     n = insert.size
-#     for i in range(n):
-#         j = i + lo
-#         array[j] = insert[i]
-#     # array is updated in place  
-
+    return (xlo,xhi,ylo,yhi)
 
-@njit
+@njit(cache=True,nogil=True)
 def getstar(image,error,xcen,ycen,fitradius):
     """ Return the entire footprint image/error/x/y arrays for one star."""
     # always return the same size
@@ -409,9 +424,9 @@ def getstar(image,error,xcen,ycen,fitradius):
     # 0.1 left on one side and 0.1 left on the other side
     # that's why we have to add 2 pixels
     npix = int(np.floor(2*fitradius))+2
-    bbox = starbbox((xcen,ycen),image.shape,fitradius)
-    nx = bbox[1]-bbox[0]
-    ny = bbox[3]-bbox[2]
+    xlo,xhi,ylo,yhi = starbbox((xcen,ycen),image.shape,fitradius)
+    nx = xhi-xlo
+    ny = yhi-ylo
     # extra buffer is ALWAYS at the end of each dimension    
     imdata = np.zeros(npix*npix,float)+np.nan
     errdata = np.zeros(npix*npix,float)+np.nan
@@ -419,18 +434,18 @@ def getstar(image,error,xcen,ycen,fitradius):
     ydata = np.zeros(npix*npix,np.int32)-1
     count = 0
     for j in range(npix):
-        y = j + bbox[2]
+        y = j + ylo
         for i in range(npix):
-            x = i + bbox[0]            
+            x = i + xlo
             xdata[count] = x
             ydata[count] = y
-            if x>=bbox[0] and x<=bbox[1]-1 and y>=bbox[2] and y<=bbox[3]-1:
+            if x>=xlo and x<=xhi-1 and y>=ylo and y<=yhi-1:
                 imdata[count] = image[y,x]
                 errdata[count] = error[y,x]
             count += 1
-    return imdata,errdata,xdata,ydata,bbox,nx,ny
+    return imdata,errdata,xdata,ydata,(xlo,xhi,ylo,yhi),nx,ny
 
-@njit
+@njit(cache=True,nogil=True)
 def collatestars(image,error,starx,stary,fitradius):
     """ Get the entire footprint image/error/x/y for all of the stars."""
     nstars = len(starx)
@@ -448,18 +463,21 @@ def collatestars(image,error,starx,stary,fitradius):
         errdata[i,:] = errdata1
         xdata[i,:] = xdata1
         ydata[i,:] = ydata1
-        bbox[i,:] = bbox1
+        bbox[i,0] = bbox1[0]
+        bbox[i,1] = bbox1[1]
+        bbox[i,2] = bbox1[2]
+        bbox[i,3] = bbox1[3]
         shape[i,0] = ny1
         shape[i,1] = nx1
     return imdata,errdata,xdata,ydata,bbox,shape
 
-@njit
+@njit(cache=True,nogil=True)
 def unpackstar(imdata,errdata,xdata,ydata,bbox,shape,istar):
-    """ Return unpacked data for one star."""
-    imdata1 = imdata[istar,:].copy()
-    errdata1 = errdata[istar,:].copy()
-    xdata1 = xdata[istar,:].copy()
-    ydata1 = ydata[istar,:].copy()
+    """ Return unpacked data for one star.  The arrays are views."""
+    imdata1 = imdata[istar]
+    errdata1 = errdata[istar]
+    xdata1 = xdata[istar]
+    ydata1 = ydata[istar]
     bbox1 = bbox[istar,:]
     shape1 = shape[istar,:]
     n = len(imdata1)
@@ -477,16 +495,16 @@ def unpackstar(imdata,errdata,xdata,ydata,bbox,shape,istar):
         ydata1 = ydata1[:shape1[0],:shape1[1]]
     return imdata1,errdata1,xdata1,ydata1,bbox1,shape1
 
-@njit
+@njit(cache=True,nogil=True)
 def getfitstar(image,error,xcen,ycen,fitradius):
     """ Get the fitting pixels for a single star."""
     npix = int(np.floor(2*fitradius))+2
-    bbox = starbbox((xcen,ycen),image.shape,fitradius)
-    flux = image[bbox[2]:bbox[3],bbox[0]:bbox[1]].copy()
-    err = error[bbox[2]:bbox[3],bbox[0]:bbox[1]].copy()
+    xlo,xhi,ylo,yhi = starbbox((xcen,ycen),image.shape,fitradius)
+    flux = image[ylo:yhi,xlo:xhi].copy()
+    err = error[ylo:yhi,xlo:xhi].copy()
     nflux = flux.size
-    nx = bbox[1]-bbox[0]
-    ny = bbox[3]-bbox[2]
+    nx = xhi-xlo
+    ny = yhi-ylo
     imdata = np.zeros(npix*npix,float)
     errdata = np.ones(npix*npix,float)
     xdata = np.zeros(npix*npix,np.int32)-1
@@ -494,20 +512,20 @@ def getfitstar(image,error,xcen,ycen,fitradius):
     mask = np.zeros(npix*npix,np.int32)
     count = 0
     for j in range(ny):
-        y = j + bbox[2]
+        y = j + ylo
         for i in range(nx):
-            x = i + bbox[0]
+            x = i + xlo
             r = np.sqrt((x-xcen)**2 + (y-ycen)**2)
             if r <= fitradius:
                 imdata[count] = flux[j,i]
-                errdata[count] = error[j,i]
+                errdata[count] = err[j,i]
                 xdata[count] = x
                 ydata[count] = y
                 mask[count] = 1
                 count += 1
     return imdata,errdata,xdata,ydata,count,mask
         
-@njit
+@njit(cache=True,nogil=True)
 def collatefitstars(image,error,starx,stary,fitradius):
     nstars = len(starx)
     npix = int(np.floor(2*fitradius))+2
@@ -523,7 +541,7 @@ def collatefitstars(image,error,starx,stary,fitradius):
     for i in range(nstars):
         xcen = starx[i]
         ycen = stary[i]
-        bb = starbbox((xcen,ycen),image.shape,fitradius)
+        xlo,xhi,ylo,yhi = starbbox((xcen,ycen),image.shape,fitradius)
         imdata1,errdata1,xdata1,ydata1,n1,mask1 = getfitstar(image,error,xcen,ycen,fitradius)
         imdata[i,:] = imdata1
         errdata[i,:] = errdata1
@@ -531,12 +549,112 @@ def collatefitstars(image,error,starx,stary,fitradius):
         ydata[i,:] = ydata1
         mask[i,:] = mask1
         ndata[i] = n1
-        bbox[i,:] = bb
+        bbox[i,0] = xlo
+        bbox[i,1] = xhi
+        bbox[i,2] = ylo
+        bbox[i,3] = yhi
     return imdata,errdata,xdata,ydata,bbox,ndata,mask
 
-@njit
+@njit(cache=True,nogil=True)
+def fittemplate(fitradius):
+    """
+    Pixel offsets (dy,dx) from the pixel nearest to a star's center that
+    can fall within the fitting radius for any sub-pixel position of the
+    star, in row-major order.
+    """
+    nrad = int(np.ceil(fitradius))+1
+    # a star can be up to sqrt(0.5) pixels from its nearest pixel center
+    maxr2 = (fitradius+0.7072)**2
+    ntemp = 0
+    for dy in range(-nrad,nrad+1):
+        for dx in range(-nrad,nrad+1):
+            if dx*dx+dy*dy <= maxr2:
+                ntemp += 1
+    template = np.zeros((ntemp,2),np.int32)
+    count = 0
+    for dy in range(-nrad,nrad+1):
+        for dx in range(-nrad,nrad+1):
+            if dx*dx+dy*dy <= maxr2:
+                template[count,0] = dy
+                template[count,1] = dx
+                count += 1
+    return template
+
+@njit(parallel=True,cache=True,nogil=True)
+def collateallstars(image,error,starx,stary,fitradius):
+    """
+    Get the entire footprint and the fitting pixels for all of the stars
+    in a single pass over each star's pixels.  This returns the footprint
+    image/error/x/y arrays, then the fitting image/error/x/y/mask arrays,
+    and finally the per-star metadata packed into one [Nstars,7] array
+    with columns [xlo,xhi,ylo,yhi,ny,nx,ndata].
+    """
+    nstars = len(starx)
+    npix = int(np.floor(2*fitradius))+2
+    # Entire footprint
+    imdata = np.zeros((nstars,npix*npix),float)
+    errdata = np.zeros((nstars,npix*npix),float)
+    xdata = np.zeros((nstars,npix*npix),np.int32)
+    ydata = np.zeros((nstars,npix*npix),np.int32)
+    # Fitting pixels
+    fimdata = np.zeros((nstars,npix*npix),float)
+    ferrdata = np.ones((nstars,npix*npix),float)
+    fxdata = np.full((nstars,npix*npix),-1,np.int32)
+    fydata = np.full((nstars,npix*npix),-1,np.int32)
+    fmask = np.zeros((nstars,npix*npix),np.int32)
+    # bounding box, shape and number of fitting pixels
+    meta = np.zeros((nstars,7),np.int32)
+    # The fitting pixels only need to be searched for in the template
+    template = fittemplate(fitradius)
+    ntemp = len(template)
+    fitradius2 = fitradius**2
+    for s in prange(nstars):
+        xcen = starx[s]
+        ycen = stary[s]
+        xlo,xhi,ylo,yhi = starbbox((xcen,ycen),image.shape,fitradius)
+        meta[s,0] = xlo
+        meta[s,1] = xhi
+        meta[s,2] = ylo
+        meta[s,3] = yhi
+        meta[s,4] = yhi-ylo
+        meta[s,5] = xhi-xlo
+        count = 0
+        for j in range(npix):
+            y = j + ylo
+            for i in range(npix):
+                x = i + xlo
+                xdata[s,count] = x
+                ydata[s,count] = y
+                if x>=xlo and x<=xhi-1 and y>=ylo and y<=yhi-1:
+                    imdata[s,count] = image[y,x]
+                    errdata[s,count] = error[y,x]
+                else:
+                    imdata[s,count] = np.nan
+                    errdata[s,count] = np.nan
+                count += 1
+        # Fitting pixels, the footprint pixels are still in cache
+        ixcen = int(np.round(xcen))
+        iycen = int(np.round(ycen))
+        fcount = 0
+        for k in range(ntemp):
+            y = iycen + template[k,0]
+            x = ixcen + template[k,1]
+            if x<xlo or x>xhi-1 or y<ylo or y>yhi-1:
+                continue
+            if (x-xcen)**2 + (y-ycen)**2 <= fitradius2:
+                fimdata[s,fcount] = image[y,x]
+                ferrdata[s,fcount] = error[y,x]
+                fxdata[s,fcount] = x
+                fydata[s,fcount] = y
+                fmask[s,fcount] = 1
+                fcount += 1
+        meta[s,6] = fcount
+    return (imdata,errdata,xdata,ydata,
+            fimdata,ferrdata,fxdata,fydata,fmask,meta)
+
+@njit(cache=True,nogil=True)
 def unpackfitstar(imdata,errdata,xdata,ydata,bbox,ndata,istar):
-    """ Return unpacked fitting data for one star."""
+    """ Return unpacked fitting data for one star.  The arrays are views."""
     imdata1 = imdata[istar,:]
     errdata1 = errdata[istar,:]
     xdata1 = xdata[istar,:]
@@ -550,6 +668,41 @@ def unpackfitstar(imdata,errdata,xdata,ydata,bbox,ndata,istar):
     ydata1 = ydata1[:n1]
     return imdata1,errdata1,xdata1,ydata1,bbox1,n1
 
+
+@njit(parallel=True,cache=True,nogil=True)
+def fitstars(imdata,errdata,xdata,ydata,ndata,psftype,psfparams,imshape,
+             staramp,starxcen,starycen,starchisq,starrms,verbose):
+    """
+    Fit amp/xcen/ycen for all the stars with a fixed PSF.  The stars are
+    independent and are fit in parallel.  The star parameter arrays are
+    updated in place.
+    """
+    nstars = len(ndata)
+    lookup = np.zeros((1,1,1),float)
+    for i in prange(nstars):
+        n1 = ndata[i]
+        im1 = imdata[i,:n1]
+        err1 = errdata[i,:n1]
+        xdata1 = xdata[i,:n1]
+        ydata1 = ydata[i,:n1]
+        pars = np.zeros(3,float)
+        pars[0] = staramp[i]
+        pars[1] = starxcen[i]
+        pars[2] = starycen[i]
+        pout = mnb.psffit(im1,err1,xdata1,ydata1,pars,psftype,psfparams,
+                          lookup,imshape,verbose)
+        bestpar,perror,cov,flux,fluxerr,chisq = pout
+        rchisq = chisq/n1
+        model,der = mnb.psf(xdata1,ydata1,pars,psftype,psfparams,
+                            lookup,imshape)
+        rms = np.sqrt(np.mean(((im1-model)/bestpar[0])**2))
+        # Update stellar parameters
+        staramp[i] = bestpar[0]
+        starxcen[i] = bestpar[1]
+        starycen[i] = bestpar[2]
+        starchisq[i] = rchisq
+        starrms[i] = rms
+
     
 kv_ty = (types.int64, types.unicode_type)
 spec = [
@@ -563,7 +716,6 @@ spec = [
     ('starinit', types.float64[:,:]),
     ('nstars', types.int32),
     ('niter', types.int32),
-    ('npsfpix', types.int32),
     ('nx', types.int32),
     ('ny', types.int32),
     ('fitradius', types.float64),
@@ -574,30 +726,21 @@ spec = [
     ('starchisq', types.float64[:]),
     ('starrms', types.float64[:]),
     ('starnpix', types.int32[:]),
-    ('star_imdata', types.float64[:,:]),
-    ('star_errdata', types.float64[:,:]),
-    ('star_xdata', types.int32[:,:]),
-    ('star_ydata', types.int32[:,:]),
-    ('star_bbox', types.int32[:,:]),
-    ('star_shape', types.int32[:,:]),
+    ('star_imdata', types.float64[:,::1]),
+    ('star_errdata', types.float64[:,::1]),
+    ('star_xdata', types.int32[:,::1]),
+    ('star_ydata', types.int32[:,::1]),
     ('starfit_imdata', types.float64[:,:]),
     ('starfit_errdata', types.float64[:,:]),
+    ('starfit_wt', types.float64[:,::1]),
     ('starfit_xdata', types.int32[:,:]),
     ('starfit_ydata', types.int32[:,:]),
     ('starfit_mask', types.int32[:,:]),
-    ('starfit_bbox', types.int32[:,:]),
-    ('starfit_ndata', types.int32[:]),
-    ('npix', types.int32),
-    ('radius', types.int32),
+    ('star_meta', types.int32[:,:]),
+    ('_allmodel', types.float64[:,::1]),
+    ('_allderiv', types.float64[:,:,::1]),
     ('verbose', types.boolean),
-    ('niter', types.int32),
-    ('_unitfootflux', types.float64),
-    #('lookup', types.float64[:,:,:]),
-    #('_bounds', types.float64[:,:]),
-    #('_steps', types.float64[:]),
-    ('coords', types.float64[:]),
     ('imshape', types.int32[:]),
-    #('order', types.int32),
 ]
 
 @jitclass(spec)
@@ -640,34 +783,52 @@ class PSFFitter(object):
         self.starrms = np.zeros(self.nstars,float)
         self.starnpix = np.zeros(self.nstars,np.int32)
 
-        # Get information for all the stars
-        imdata,errdata,xdata,ydata,bbox,shape = collatestars(image,error,self.starxcen,
-                                                             self.starycen,fitradius)
+        # Get the footprint and fitting information for all the stars
+        out = collateallstars(image,error,self.starxcen,self.starycen,fitradius)
+        imdata,errdata,xdata,ydata = out[:4]
+        fimdata,ferrdata,fxdata,fydata,fmask,meta = out[4:]
         self.star_imdata = imdata
         self.star_errdata = errdata
         self.star_xdata = xdata
         self.star_ydata = ydata
-        self.star_bbox = bbox
-        self.star_shape = shape
         
-        # Get fitting information for all the stars
-        fimdata,ferrdata,fxdata,fydata,fbbox,fndata,fmask = collatefitstars(image,error,self.starxcen,
-                                                                            self.starycen,fitradius)
         self.starfit_imdata = fimdata
         self.starfit_errdata = ferrdata
+        # Weights, the padding has error=1 so it gets unit weight
+        self.starfit_wt = 1/ferrdata**2
         self.starfit_xdata = fxdata
         self.starfit_ydata = fydata
         self.starfit_mask = fmask
-        self.starfit_bbox = fbbox
-        self.starfit_ndata = fndata
+        # [xlo,xhi,ylo,yhi,ny,nx,ndata] for each star
+        self.star_meta = meta
+
+        # Model and derivative buffers reused by model() and jac()
+        #  only the first ndata pixels of each star are ever written,
+        #  so the padding stays zero without clearing them every call.
+        #  Only the PSF parameter (not amp/xc/yc) derivatives are kept.
+        nparsarr = np.array([6,7,8,8,7])
+        npars = nparsarr[self.psftype-1]
+        maxpix = imdata.shape[1]
+        self._allmodel = np.zeros((nstars,maxpix),float)
+        self._allderiv = np.zeros((nstars,maxpix,npars-3),float)
 
     def unpackstar(self,istar):
         return unpackstar(self.star_imdata,self.star_errdata,self.star_xdata,
-                          self.star_ydata,self.star_bbox,self.star_shape,istar)
+                          self.star_ydata,self.star_meta[:,0:4],self.star_meta[:,4:6],istar)
 
     def unpackfitstar(self,istar):
         return unpackfitstar(self.starfit_imdata,self.starfit_errdata,self.starfit_xdata,
-                             self.starfit_ydata,self.starfit_bbox,self.starfit_ndata,istar)
+                             self.starfit_ydata,self.star_meta[:,0:4],self.star_meta[:,6],istar)
+
+    def allpars(self,args,npars):
+        """ Model parameters [amp,xcen,ycen,psfparams] for all of the stars."""
+        allpars = np.zeros((self.nstars,npars),float)
+        allpars[:,0] = self.staramp
+        allpars[:,1] = self.starxcen
+        allpars[:,2] = self.starycen
+        for i in range(self.nstars):
+            allpars[i,3:] = args
+        return allpars
 
     def psf(self,x,y,pars,psfparams,lookup,deriv):
         """ Get a PSF model for a single star."""
@@ -683,23 +844,20 @@ class PSFFitter(object):
         nparsarr = np.array([6,7,8,8,7])
         npars = nparsarr[self.psftype-1]
         # Loop over the stars and generate the model image
-        allmodel = np.zeros(self.star_imdata.shape,float)
-        maxpix = self.star_imdata.shape[1]
-        for i in range(self.nstars):
-            im1,err1,xdata1,ydata1,bbox1,n1 = self.unpackfitstar(i)
-            allpars = np.zeros(npars,float)
-            allpars[0] = self.staramp[i]
-            allpars[1] = self.starxcen[i]
-            allpars[2] = self.starycen[i]
-            allpars[3:] = args
-            g,_ = mnb.amodel2d(xdata1,ydata1,self.psftype,allpars,0)
-            allmodel[i,:len(g)] = g
-        return allmodel
+        #  the returned array is overwritten by the next call
+        allpars = self.allpars(args,npars)
+        mnb.amodel2d_batch(self.starfit_xdata,self.starfit_ydata,self.star_meta[:,6],
+                           self.psftype,allpars,0,self._allmodel,self._allderiv)
+        return self._allmodel
 
     def chisq(self,pars):
         """ Create the model and return chisq for this set of PSF parameters."""
-        m = self.model(np.arange(10),pars)
-        chisq = np.sum((self.starfit_imdata-m)**2/self.starfit_errdata**2)        
+        nparsarr = np.array([6,7,8,8,7])
+        npars = nparsarr[self.psftype-1]
+        allpars = self.allpars(pars,npars)
+        chisq = mnb.chisq2d_batch(self.starfit_xdata,self.starfit_ydata,
+                                  self.starfit_imdata,self.starfit_errdata,
+                                  self.star_meta[:,6],self.psftype,allpars)
         return chisq
         
     
@@ -806,75 +964,43 @@ class PSFFitter(object):
 
     def fitstars(self,x,psfparams):
         """ Fit amp/xcen/ycen for all the stars using the current PSF."""
-
-        # Loop over the stars and generate the model image
-        lookup = np.zeros((1,1,1),float)
-        allmodel = np.zeros(self.star_imdata.shape,float)
-        maxpix = self.star_imdata.shape[1]
-        npix = int(np.sqrt(maxpix))
-        for i in range(self.nstars):
-            im1,err1,xdata1,ydata1,bbox1,n1 = self.unpackfitstar(i)
-            pars = np.zeros(3,float)
-            pars[0] = self.staramp[i]
-            pars[1] = self.starxcen[i]
-            pars[2] = self.starycen[i]
-            pout = mnb.psffit(im1,err1,xdata1,ydata1,pars,self.psftype,psfparams,
-                              lookup,self.imshape,self.verbose)
-            bestpar,perror,cov,flux,fluxerr,chisq = pout
-            rchisq = chisq/len(xdata1)
-            model,der = mnb.psf(xdata1,ydata1,pars,self.psftype,psfparams,
-                                lookup,self.imshape)
-            rms = np.sqrt(np.mean(((im1-model)/bestpar[0])**2))
-            #print(i,bestpar,rchisq,rms)
-            
-            # Update stellar parameters
-            self.staramp[i] = bestpar[0]
-            self.starxcen[i] = bestpar[1]
-            self.starycen[i] = bestpar[2]
-            self.starchisq[i] = rchisq
-            self.starrms[i] = rms
+        fitstars(self.starfit_imdata,self.starfit_errdata,self.starfit_xdata,
+                 self.starfit_ydata,self.star_meta[:,6],self.psftype,psfparams,
+                 self.imshape,self.staramp,self.starxcen,self.starycen,
+                 self.starchisq,self.starrms,self.verbose)
             
     
     def jac(self,x,args):
         """ jacobian."""
         # input the model parameters        
         if self.verbose:
-            print('model: '+str(self.niter)+' ',args)
+            print('jac: '+str(self.niter)+' ',args)
         # Loop over the stars and generate the model image
         nparsarr = np.array([6,7,8,8,7])
         npars = nparsarr[self.psftype-1]
-        allmodel = np.zeros(self.star_imdata.shape,float)
-        maxpix = self.star_imdata.shape[1]
-        allderiv = np.zeros((self.nstars,maxpix,npars),float)
-        for i in range(self.nstars):
-            im1,err1,xdata1,ydata1,bbox1,n1 = self.unpackfitstar(i)
-            allpars = np.zeros(npars,float)
-            allpars[0] = self.staramp[i]
-            allpars[1] = self.starxcen[i]
-            allpars[2] = self.starycen[i]
-            allpars[3:] = args
-            g,d = mnb.amodel2d(xdata1,ydata1,self.psftype,allpars,npars)
-            allmodel[i,:len(g)] = g
-            allderiv[i,:len(g),:] = d
-        # Trim off the stellar parameter (amp/xc/yc) derivatives
-        allderiv = allderiv[:,:,3:]
-        return allmodel,allderiv
-
-    def linesearch(self,bestpar,dbeta):
-        # Perform line search along search gradient
-
-        # Inside model() the parameters are limited to the PSF bounds()
-        f0 = self.chisq(bestpar)
-        f1 = self.chisq(bestpar+0.5*dbeta)
-        f2 = self.chisq(bestpar+dbeta)
-        alpha = quadratic_bisector(np.array([0.0,0.5,1.0]),np.array([f0,f1,f2]))
-        alpha = np.minimum(np.maximum(alpha,0.0),1.0)  # 0<alpha<1
-        if np.isfinite(alpha)==False:
-            alpha = 1.0
-
-        pars_new = bestpar + alpha * dbeta
-        new_dbeta = alpha * dbeta
-        return alpha,new_dbeta
+        #  the returned arrays are overwritten by the next call
+        allpars = self.allpars(args,npars)
+        #  the stellar parameter (amp/xc/yc) derivatives are not kept
+        mnb.amodel2d_batch(self.starfit_xdata,self.starfit_ydata,self.star_meta[:,6],
+                           self.psftype,allpars,npars,self._allmodel,self._allderiv)
+        return self._allmodel,self._allderiv
+
+    def linesearch(self,bestpar,dbeta,f0,slope):
+        # Perform backtracking line search along search gradient
+        #  f0 is chisq at bestpar and slope is the derivative of chisq
+        #  along dbeta there.  Start with the full step and halve it until
+        #  the Armijo sufficient decrease condition is met, which usually
+        #  takes one chisq evaluation.  If none of the steps satisfies it
+        #  the step is rejected and alpha=0 is returned.
+        slope = np.minimum(slope,0.0)
+        alpha = 1.0
+        for i in range(6):
+            f1 = self.chisq(bestpar+alpha*dbeta)
+            if f1 <= f0 + 1e-4*alpha*slope:
+                return alpha,alpha*dbeta
+            alpha *= 0.5
+
+        return 0.0,0.0*dbeta
     
     # def mklookup(self,order=0):
     #     """ Make an empirical look-up table for the residuals."""
@@ -918,7 +1044,7 @@ class PSFFitter(object):
         g = g.reshape(im.shape)
         return g
 
-@njit
+@njit(nogil=True)
 def fitpsf(psftype,psfparams,image,error,starx,stary,starflux,fitradius,method='qr',maxiter=10,
            minpercdiff=1.0,verbose=False):
     """
@@ -977,8 +1103,8 @@ def fitpsf(psftype,psfparams,image,error,starx,stary,starflux,fitradius,method='
     #-----------------------------
 
     # Empirical PSF - done differently
-    if psf.psftype==6:
-        cube1 = starcube(tab,image,npix=psf.npix,fillvalue=np.nan)
+    #if psf.psftype==6:
+    #     cube1 = starcube(tab,image,npix=psf.npix,fillvalue=np.nan)
     #     coords = (tab['x'].data,tab['y'].data)
     #     epsf1,nbadstar1,rms1 = mkempirical(cube1,order=psf.order,coords=coords,shape=psf._shape)
     #     initpsf = mnb.PSFEmpirical(epsf1,imshape=image.shape,order=psf.order)
@@ -1023,23 +1149,37 @@ def fitpsf(psftype,psfparams,image,error,starx,stary,starflux,fitradius,method='
     oldchisq = 1e30
     bounds = mnb.model2d_bounds(psftype)
     bounds = bounds[3:,:]
+    # Weights, these don't change between iterations
+    wt = pf.starfit_wt.ravel()
+    # Levenberg-Marquardt damping, adapted from the line search
+    damp = 1e-3
     while (niter<maxiter and percdiff>minpercdiff and dchisq<0):
         # Fit the stellar parameters first
         pf.fitstars(xdata,bestpar)
         # Get the Jacobian and model
         m,jac = pf.jac(xdata,bestpar)
-        chisq = np.sum((pf.starfit_imdata-m)**2/pf.starfit_errdata**2)
         dy = (pf.starfit_imdata-m).ravel()
-        # Weights
-        wt = 1/pf.starfit_errdata**2
-        wt = wt.ravel()
-        jac = jac.copy().reshape((jac.shape[0]*jac.shape[1],jac.shape[2]))
+        chisq = np.sum(dy**2*wt)
+        jac = jac.reshape((jac.shape[0]*jac.shape[1],jac.shape[2]))
         m = m.ravel()
         # Solve Jacobian
-        dbeta = mnb.qr_jac_solve(jac,dy,weight=wt)
+        dbeta = utils.lm_jac_solve(jac,dy,wt,damp)
 
         # Perform line search
-        alpha,new_dbeta = pf.linesearch(bestpar,dbeta)
+        # chisq derivative along dbeta, d(sum(wt*dy**2))/dalpha
+        slope = -2*np.sum(wt*dy*(jac @ dbeta))
+        alpha,new_dbeta = pf.linesearch(bestpar,dbeta,chisq,slope)
+        # Trust the model more if the full step was taken, less if not
+        if alpha==1.0:
+            damp *= 0.5
+        elif alpha==0.0:
+            # Step rejected, try again from the same parameters
+            #  with much more damping
+            damp *= 10.0
+            niter += 1
+            continue
+        else:
+            damp *= 2.0
             
         if verbose:
             print('  pars = '+str(bestpar))
@@ -1054,10 +1194,8 @@ def fitpsf(psftype,psfparams,image,error,starx,stary,starflux,fitradius,method='
         
         # Update the parameters 
         diff = np.abs(bestpar-oldpar)
-        denom = np.abs(oldpar.copy())
-        bad, = np.where(denom==0)
-        if len(bad)>0:
-            denom[bad] = 1.0  # deal with zeros
+        denom = np.abs(oldpar)
+        denom = np.where(denom==0,1.0,denom)  # deal with zeros
         percdiff = np.max(diff/denom*100)
         dchisq = chisq-oldchisq
         percdiffchisq = dchisq/oldchisq*100
@@ -1070,18 +1208,17 @@ def fitpsf(psftype,psfparams,image,error,starx,stary,starflux,fitradius,method='
     # Fit the stellar parameters first
     pf.fitstars(xdata,bestpar)
     # Get the Jacobian and model
+    #  the last loop iteration was evaluated before its parameter update,
+    #  so this is needed for the final parameters
     m,jac = pf.jac(xdata,bestpar)
-    chisq = np.sum((pf.starfit_imdata-m)**2/pf.starfit_errdata**2)
     dy = (pf.starfit_imdata-m).ravel()
-    # Weights
-    wt = 1/pf.starfit_errdata**2
-    wt = wt.ravel()
-    jac = jac.copy().reshape((jac.shape[0]*jac.shape[1],jac.shape[2]))
-    rchisq = chisq/np.sum(pf.starfit_ndata)
+    chisq = np.sum(dy**2*wt)
+    jac = jac.reshape((jac.shape[0]*jac.shape[1],jac.shape[2]))
+    rchisq = chisq/np.sum(pf.star_meta[:,6])
     
     # Estimate uncertainties
     # Calculate covariance matrix
-    pcov = mnb.jac_covariance(jac,dy,wt=wt)
+    pcov = utils.jac_covariance(jac,dy,wt)
     perror = np.sqrt(np.diag(pcov))
 
     pars = bestpar
@@ -1096,13 +1233,13 @@ def fitpsf(psftype,psfparams,image,error,starx,stary,starflux,fitradius,method='
     psftab[:,1] = pf.staramp             # amp
     psftab[:,2] = pf.starxcen            # x
     psftab[:,3] = pf.starycen            # y
-    psftab[:,4] = pf.starfit_ndata       # npix
+    psftab[:,4] = pf.star_meta[:,6]      # npix
     psftab[:,5] = pf.starrms             # rms
     psftab[:,6] = pf.starchisq           # chisq
-    psftab[:,7] = pf.star_bbox[:,0]      # ixmin
-    psftab[:,8] = pf.star_bbox[:,1]      # ixmax
-    psftab[:,9] = pf.star_bbox[:,2]      # iymin
-    psftab[:,10] = pf.star_bbox[:,3]     # iymax
+    psftab[:,7] = pf.star_meta[:,0]      # ixmin
+    psftab[:,8] = pf.star_meta[:,1]      # ixmax
+    psftab[:,9] = pf.star_meta[:,2]      # iymin
+    psftab[:,10] = pf.star_meta[:,3]     # iymax
     
     return pars, perror, pcov, psftab, rchisq
     
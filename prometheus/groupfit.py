@@ -19,25 +19,84 @@ import astropy.units as u
 from scipy.optimize import curve_fit, least_squares, line_search
 from scipy.interpolate import interp1d
 from scipy import sparse
+from scipy.linalg import cho_factor, cho_solve
+from scipy.sparse.csgraph import connected_components
 #from astropy.nddata import CCDData,StdDevUncertainty
 from dlnpyutils import utils as dln, bindata
 import copy
+from functools import lru_cache
 import logging
 import time
 import matplotlib
 import sep
-from photutils.aperture import CircularAnnulus
-from astropy.stats import sigma_clipped_stats
-from . import leastsquares as lsq,utils
+from . import leastsquares as lsq,utils,utils_numba,models_numba as mnb
 from .ccddata import CCDData,BoundingBox
 
 # Fit a PSF model to multiple stars in an image
 
+# PSF classes that have a models_numba equivalent
+NUMBAPSFTYPES = {'PSFGaussian':1, 'PSFMoffat':2, 'PSFPenny':3, 'PSFGausspow':4, 'Sersic':5}
+
+def numbapsftype(psf):
+    """ Return the models_numba psftype for a PSF object, or 0 if it has no numba equivalent."""
+    # Binned models and lookup tables are only handled by the PSF object itself
+    if getattr(psf,'binned',False) or getattr(psf,'haslookup',False):
+        return 0
+    return NUMBAPSFTYPES.get(psf.__class__.__name__,0)
+    
+
+def stargrid(xcen,ycen,radius,imshape):
+    """
+    Return the X/Y pixel values of the bounding boxes of many stars at once.
+
+    Parameters
+    ----------
+    xcen : numpy array
+       X centers of the stars.
+    ycen : numpy array
+       Y centers of the stars.
+    radius : float
+       Radius of the bounding boxes in pixels.
+    imshape : list or tuple
+       Image shape (ny,nx) values.  Python images are (Y,X).
+
+    Returns
+    -------
+    x : numpy array
+       [Nstars,Nbox,Nbox] array of X values.
+    y : numpy array
+       [Nstars,Nbox,Nbox] array of Y values.
+    inbox : numpy array
+       [Nstars,Nbox,Nbox] boolean array that is True for the pixels that
+         fall in the star's bounding box (as given by starbbox()) and
+         inside the image.
+
+    Example
+    -------
+
+    x,y,inbox = stargrid(xcen,ycen,radius,imshape)
+
+    """
+    ny,nx = imshape   # python images are (Y,X)
+    # Same limits as starbbox(), upper values are EXCLUSIVE
+    xlo = np.floor(xcen-radius).astype(int).reshape(-1,1,1)
+    xhi = np.ceil(xcen+radius+1).astype(int).reshape(-1,1,1)
+    ylo = np.floor(ycen-radius).astype(int).reshape(-1,1,1)
+    yhi = np.ceil(ycen+radius+1).astype(int).reshape(-1,1,1)
+    # The boxes are at most 2*radius+2 pixels wide
+    off = np.arange(int(np.ceil(2*radius))+2)
+    x = xlo + off.reshape(1,1,-1)
+    y = ylo + off.reshape(1,-1,1)
+    inbox = (x<xhi) & (x>=0) & (x<nx) & (y<yhi) & (y>=0) & (y<ny)
+    x,y = np.broadcast_arrays(x,y)
+    return x,y,inbox
+
     
 class GroupFitter(object):
 
-    def __init__(self,psf,image,cat,fitradius=None,verbose=False):
+    def __init__(self,psf,image,cat,fitradius=None,verbose=False,dtype=np.float64):
         # Save the input values
+        self.dtype = dtype          # dtype of the flattened data and jacobian
         self.verbose = verbose
         self.psf = psf
         self.image = image
@@ -63,13 +122,11 @@ class GroupFitter(object):
             else:
                 amp = cat['flux']/(2*np.pi*(psf.fwhm()/2.35)**2)                
             staramp = np.maximum(amp,0)   # make sure it's positive
-        # Initialize the parameter array
-        pars = np.zeros(self.nstars*3+1,float) # amp, xcen, ycen
-        pars[0:-1:3] = staramp
-        pars[1:-1:3] = cat['x']
-        pars[2:-1:3] = cat['y']
-        pars[-1] = 0.0  # sky offset
-        self.pars = pars
+        # Initialize the parameter arrays, self.pars interleaves them
+        self.staramp = np.array(staramp,float)
+        self.starxcen = np.array(cat['x'],float)
+        self.starycen = np.array(cat['y'],float)
+        self.skyoffset = 0.0  # sky offset
         # Sky and Niter arrays for the stars
         self.starsky = np.zeros(self.nstars,float)
         self.starniter = np.zeros(self.nstars,int)
@@ -80,48 +137,35 @@ class GroupFitter(object):
         self.pixused = None   # initialize pixused
         
         # Get xdata, ydata
+        #  all stars use the same stamp size, so compute the pixel
+        #  masks for all of them at once and only slice out the
+        #  ragged per-star lists in the loop
+        hpsfnpix = self.psf.npix//2
+        xcen = np.asarray(self.starxcen)
+        ycen = np.asarray(self.starycen)
+        fx,fy,fmask = stargrid(xcen,ycen,hpsfnpix,image.shape)     # full PSF region
+        fmask &= np.sqrt( (fx-xcen.reshape(-1,1,1))**2 + (fy-ycen.reshape(-1,1,1))**2 ) <= hpsfnpix
+        x,y,mask = stargrid(xcen,ycen,self.nfitpix,image.shape)     # fitting region
+        mask &= np.sqrt( (x-xcen.reshape(-1,1,1))**2 + (y-ycen.reshape(-1,1,1))**2 ) <= self.fitradius
+        # Use image mask
+        #  mask=True for bad values
+        if image.mask is not None:
+            ny,nx = image.shape
+            fmask &= (image.mask[np.clip(fy,0,ny-1),np.clip(fx,0,nx-1)]==False)
+            mask &= (image.mask[np.clip(y,0,ny-1),np.clip(x,0,nx-1)]==False)
         bboxdata0 = []
         xlist0 = []
         ylist0 = []
-        fbboxdata = []
         fxlist = []
         fylist = []
-        ntotpix = 0
-        hpsfnpix = self.psf.npix//2
         for i in range(self.nstars):
-            xcen = self.starxcen[i]
-            ycen = self.starycen[i]
-            # Full PSF region
-            fbbox = psf.starbbox((xcen,ycen),image.shape,hpsfnpix)
-            fx,fy = psf.bbox2xy(fbbox)
-            frr = np.sqrt( (fx-xcen)**2 + (fy-ycen)**2 )
-            # Use image mask
-            #  mask=True for bad values
-            if image.mask is not None:
-                fmask = (frr<=hpsfnpix) & (image.mask[fy,fx]==False)
-            else:
-                fmask = frr<=hpsfnpix                
-            fx = fx[fmask]  # raveled
-            fy = fy[fmask]
-            fbboxdata.append(fbbox)
-            fxlist.append(fx)
-            fylist.append(fy)
-            # Fitting region
-            bbox = psf.starbbox((xcen,ycen),image.shape,self.nfitpix)
-            x,y = psf.bbox2xy(bbox)
-            rr = np.sqrt( (x-xcen)**2 + (y-ycen)**2 )
-            # Use image mask
-            #  mask=True for bad values
-            if image.mask is not None:           
-                mask = (rr<=self.fitradius) & (image.mask[y,x]==False)
-            else:
-                mask = rr<=self.fitradius                
-            x = x[mask]  # raveled
-            y = y[mask]
-            ntotpix += x.size
+            fxlist.append(fx[i][fmask[i]])  # raveled
+            fylist.append(fy[i][fmask[i]])
+            xlist0.append(x[i][mask[i]])
+            ylist0.append(y[i][mask[i]])
+            bbox = psf.starbbox((xcen[i],ycen[i]),image.shape,self.nfitpix)
             bboxdata0.append(bbox)  # this still includes the corners
-            xlist0.append(x)
-            ylist0.append(y)
+        ntotpix = np.sum(mask)
 
         self.fxlist = fxlist  # full PSF region
         self.fylist = fylist
@@ -144,12 +188,22 @@ class GroupFitter(object):
         # Get unique indexes and inverse indices
         #   the inverse index list takes you from the duplicated pixels
         #   to the unique ones
-        uind1,invindex = np.unique(ind1,return_inverse=True)
+        if image.size < 8*len(ind1):
+            # The indices are bounded by the image size, so flag them in
+            #  a bitmap instead of sorting, O(N)
+            flags = np.zeros(image.size,bool)
+            flags[ind1] = True
+            uind1 = np.flatnonzero(flags)
+            lookup = np.zeros(image.size,int)
+            lookup[uind1] = np.arange(len(uind1))
+            invindex = lookup[ind1]
+        else:
+            uind1,invindex = np.unique(ind1,return_inverse=True)
         ntotpix = len(uind1)
         y,x = np.unravel_index(uind1,image.shape)
         
-        imflatten = image.data.ravel()[uind1]
-        errflatten = image.error.ravel()[uind1]
+        imflatten = image.data.ravel()[uind1].astype(dtype)
+        errflatten = image.error.ravel()[uind1].astype(dtype)
         # Save information on the "flattened" arrays
         self.ntotpix = ntotpix
         self.imflatten = imflatten
@@ -179,6 +233,29 @@ class GroupFitter(object):
         self.invindexlist = invindexlist
         self.xlist = xlist
         self.ylist = ylist
+        # 1D raveled image indices of each star's pixels, python images are (Y,X)
+        self.fravelindexlist = [np.ravel_multi_index((fy,fx),image.shape) for fx,fy in zip(fxlist,fylist)]
+        self.ravelindexlist = [uind1[used] for used in invindexlist]
+
+        # Concatenate the per-star pixel lists into flat arrays with
+        #  CSR-style offsets so all stars can be modeled in one numba call
+        nflat = np.array([len(v) for v in invindexlist])
+        self.staroffsets = np.concatenate(([0],np.cumsum(nflat)))
+        self.xflat = np.concatenate(xlist).astype(float)
+        self.yflat = np.concatenate(ylist).astype(float)
+        self.invflat = np.concatenate(invindexlist)
+        self.starflat = np.repeat(np.arange(self.nstars),nflat)   # star index of each flat pixel
+        self.psftype = numbapsftype(psf)
+        # Output buffers for the numba models, allocated once and reused,
+        #  in the working dtype so float32 halves the model memory traffic
+        self.mflat = np.zeros(len(self.xflat),dtype)
+        self.dflat = np.zeros((len(self.xflat),3),dtype)
+        # Same for the full PSF regions
+        nfflat = np.array([len(v) for v in fxlist])
+        self.fstaroffsets = np.concatenate(([0],np.cumsum(nfflat)))
+        self.fxflat = np.concatenate(fxlist).astype(float)
+        self.fyflat = np.concatenate(fylist).astype(float)
+        self.fravelflat = np.concatenate(self.fravelindexlist)
             
         #self.invindex = invindex  # takes you from duplicates to unique pixels
         #invindexlist = []
@@ -192,54 +269,59 @@ class GroupFitter(object):
         self.bbox = BoundingBox(np.min(x),np.max(x)+1,np.min(y),np.max(y)+1)
         #self.bboxdata = bboxdata
 
+        # Model image of the frozen stars, their parameters no longer change
+        self.frozenmodelim = np.zeros(image.shape,float)
+        # Scratch image reused by sky(), freeze() and centroid()
+        self.scratchim = np.zeros(image.shape,float)
+        # Parameter ordering for the sparse solver and the free parameters it is for
+        self.sparseperm = None
+        self.sparsepermfree = None
+        # Bounded cache of the full-region star models for PSFs without a numba
+        #  equivalent, the frozen stars come back with the same parameters
+        self.fullstarmodel = lru_cache(maxsize=4*self.nstars)(self.fullstarmodel)
+        
         # Create initial sky image
         self.sky()
 
         
+    @property
+    def pars(self):
+        """ Return all the parameters as an interleaved
+            [amp1,xcen1,ycen1,amp2,xcen2,ycen2,...,sky] array.
+            This is a new array built from staramp, starxcen, starycen and skyoffset,
+            so set it with self.pars = pars rather than in place.
+        """
+        pars = np.zeros(3*self.nstars+1,float)
+        pars[0:-1:3] = self.staramp
+        pars[1:-1:3] = self.starxcen
+        pars[2:-1:3] = self.starycen
+        pars[-1] = self.skyoffset
+        return pars
+
+    @pars.setter
+    def pars(self,val):
+        """ Set all the parameters from an interleaved array."""
+        val = np.asarray(val,float)
+        # Stored as separate contiguous arrays
+        self.staramp = val[0:-1:3].copy()
+        self.starxcen = val[1:-1:3].copy()
+        self.starycen = val[2:-1:3].copy()
+        self.skyoffset = val[-1]
+        
     @property
     def starpars(self):
         """ Return the [amp,xcen,ycen] parameters in [Nstars,3] array.
             You can GET a star's parameters like this:
             pars = self.starpars[4]
-            You can also SET a star's parameters a similar way:
-            self.starpars[4] = pars
         """
-        return self.pars[0:3*self.nstars].reshape(self.nstars,3)
-    
-    @property
-    def staramp(self):
-        """ Return the best-fit amps for all stars."""
-        return self.pars[0:-1:3]
-
-    @staramp.setter
-    def staramp(self,val):
-        """ Set staramp values."""
-        self.pars[0:-1:3] = val
-    
-    @property
-    def starxcen(self):
-        """ Return the best-fit X centers for all stars."""        
-        return self.pars[1::3]
-
-    @starxcen.setter
-    def starxcen(self,val):
-        """ Set starxcen values."""
-        self.pars[1::3] = val
-    
-    @property
-    def starycen(self):
-        """ Return the best-fit Y centers for all stars."""        
-        return self.pars[2::3]    
-
-    @starycen.setter
-    def starycen(self,val):
-        """ Set starycen values."""
-        self.pars[2::3] = val
+        return np.stack((self.staramp,self.starxcen,self.starycen),axis=1)
     
     def sky(self,method='sep',rin=None,rout=None):
         """ (Re)calculate the sky."""
         # Remove the current best-fit model
-        resid = self.image.data-self.modelim  # remove model
+        #  the frozen stars' models are cached, only add the free stars
+        resid = np.subtract(self.image.data,self.frozenmodelim,out=self.scratchim)
+        self.addfullmodel(resid.ravel(),np.arange(self.nstars)[self.freestars],sign=-1)
         # SEP smoothly varying background
         if method=='sep':
             bw = np.maximum(int(self.nx/10),64)
@@ -255,14 +337,19 @@ class GroupFitter(object):
                 rin = self.psf.fwhm()*1.5
             if rout is None:
                 rout = self.psf.fwhm()*2.5
-            positions = list(zip(self.starxcen,self.starycen))
-            annulus = CircularAnnulus(positions,r_in=rin,r_out=rout)
-            for i in range(self.nstars):
-                annulus_mask = annulus[i].to_mask(method='center')
-                annulus_data = annulus_mask.multiply(resid,fill_value=np.nan)
-                data = annulus_data[(annulus_mask.data>0) & np.isfinite(annulus_data)]
-                mean_sigclip, median_sigclip, _ = sigma_clipped_stats(data,stdfunc=dln.mad)
-                self.starsky[i] = mean_sigclip
+            # Annulus pixels of all the stars, the pixel centers within
+            #  rin<=r<rout, concatenated star by star
+            off = np.arange(-int(np.ceil(rout))-1,int(np.ceil(rout))+2)
+            xx = np.round(self.starxcen).astype(int).reshape(-1,1,1) + off.reshape(1,1,-1)
+            yy = np.round(self.starycen).astype(int).reshape(-1,1,1) + off.reshape(1,-1,1)
+            r2 = (xx-self.starxcen.reshape(-1,1,1))**2 + (yy-self.starycen.reshape(-1,1,1))**2
+            inannulus = (r2>=rin**2) & (r2<rout**2) & (xx>=0) & (xx<self.nx) & (yy>=0) & (yy<self.ny)
+            starind,yind,xind = np.nonzero(inannulus)
+            data = resid[yy[starind,yind,0],xx[starind,0,xind]]
+            good = np.isfinite(data)
+            offsets = np.concatenate(([0],np.cumsum(np.bincount(starind[good],minlength=self.nstars))))
+            # Sigma-clipped mean of all the stars in one compiled pass
+            self.starsky[:] = utils_numba.sigclipmean_flat(data[good],offsets)
             if hasattr(self,'skyim') is False:
                 self.skyim = np.zeros(self.image.shape,float)
             if self.skyim is None:
@@ -270,11 +357,8 @@ class GroupFitter(object):
             self.skyim += np.median(self.starsky)
         else:
             raise ValueError("Sky method "+method+" not supported")
-
-    @property
-    def skyflatten(self):
-        """ Return the sky values for the pixels that we are fitting."""
-        return self.skyim.ravel()[self.ind1]
+        # Sky values for the pixels that we are fitting
+        self.skyflatten = self.skyim.ravel()[self.ind1]
         
     @property
     def nfreezepars(self):
@@ -290,6 +374,13 @@ class GroupFitter(object):
     def nfreepars(self):
         """ Return the number of free parameters."""
         return np.sum(self.freepars)
+
+    @property
+    def freecolindex(self):
+        """ Return the column of each parameter in the free-parameter jacobian, -1 if frozen."""
+        colindex = np.cumsum(self.freepars)-1
+        colindex[self.freezepars] = -1
+        return colindex
     
     @property
     def nfreezestars(self):
@@ -313,7 +404,9 @@ class GroupFitter(object):
         #            should now be frozen
 
         # Update all the free parameters
-        self.pars[self.freepars] = pars
+        allpars = self.pars
+        allpars[self.freepars] = pars
+        self.pars = allpars
 
         # Update freeze values for "free" parameters
         self.freezepars[self.freepars] = frzpars   # stick in the new values for the "free" parameters
@@ -331,25 +424,16 @@ class GroupFitter(object):
         newfreezestars, = np.where((oldfreezestars==False) & (self.freezestars==True))
         if len(newfreezestars)>0:
             # add models to a full image
-            newmodel = self.image.data.copy()*0
-            for i in newfreezestars:
-                # Save on what iteration this star was frozen
-                self.starniter[i] = self.niter+1
-                #print('freeze: subtracting model for star ',i)
-                pars1 = self.pars[i*3:(i+1)*3]
-                #xind = self.xlist[i]
-                #yind = self.ylist[i]
-                #invindex = self.invindexlist[i]
-                #im1 = self.psf(xind,yind,pars1)
-                #self.resflatten[invindex] -= im1
-                xind = self.fxlist[i]
-                yind = self.fylist[i]
-                im1 = self.psf(xind,yind,pars1)
-                newmodel[yind,xind] += im1
+            newmodel = self.scratchim
+            newmodel.fill(0.0)
+            # Save on what iteration these stars were frozen
+            self.starniter[newfreezestars] = self.niter+1
+            self.addfullmodel(newmodel.ravel(),newfreezestars)
             # Only keep the pixels being fit
             #  and subtract from the residuals
             newmodel1 = newmodel.ravel()[self.ind1]
             self.resflatten -= newmodel1
+            self.frozenmodelim += newmodel
                 
         # Return the new array of free parameters
         frzind = np.arange(len(frzpars))[frzpars]
@@ -361,8 +445,18 @@ class GroupFitter(object):
         self.freezestars = np.zeros(self.nstars,bool)
         self.freezepars = np.zeros(self.nstars*3+1,bool)
         self.resflatten = self.imflatten.copy()
+        self.frozenmodelim[:,:] = 0.0
 
 
+    def sparsesolve(self,jac,resid,weight=None):
+        """ Solve the jacobian with the sparse normal equations.  Which stars overlap does
+            not change between iterations, so the parameter ordering is only recomputed
+            when the free parameters change."""
+        if self.sparseperm is None or np.array_equal(self.sparsepermfree,self.freepars)==False:
+            self.sparseperm = lsq.sparse_normal_ordering(jac)
+            self.sparsepermfree = self.freepars.copy()
+        return lsq.sparse_normal_jac_solve(jac,resid,weight=weight,perm=self.sparseperm)
+
     def mkbounds(self,pars,imshape,xoff=10):
         """ Make bounds for a set of input parameters."""
         # is [amp1,xcen1,ycen1,amp2,xcen2,ycen2, ...]
@@ -456,14 +550,41 @@ class GroupFitter(object):
     def modelim(self):
         """ This returns the full image of the current best model (no sky)
             using the PARS values."""
-        im = np.zeros(self.image.shape,float)
-        for i in range(self.nstars):
-            pars = self.pars[i*3:(i+1)*3]
-            fxind = self.fxlist[i]
-            fyind = self.fylist[i]
-            im1 = self.psf(fxind,fyind,pars)
-            im[fyind,fxind] += im1
-        return im
+        im = np.zeros(self.image.size,float)
+        self.addfullmodel(im,np.arange(self.nstars))
+        return im.reshape(self.image.shape)
+
+    def addfullmodel(self,imflat,dostars,sign=1):
+        """
+        Add the models of stars DOSTARS over their full PSF regions to the flat
+        (raveled) image IMFLAT in place, using the current parameters.  With
+        sign=-1 the models are subtracted instead.  This uses the numba models
+        if the PSF has one.
+        """
+        dostars = np.asarray(dostars,np.int64)
+        if self.psftype>0:
+            starpars = np.zeros((self.nstars,3+len(self.psf.params)),float)
+            starpars[:,0] = sign*self.staramp
+            starpars[:,1] = self.starxcen
+            starpars[:,2] = self.starycen
+            starpars[:,3:] = self.psf.params
+            mnb.amodel2d_addflat(self.fxflat,self.fyflat,self.fstaroffsets,self.fravelflat,dostars,
+                                 self.psftype,starpars,float(self.psf.radius),imflat)
+        else:
+            psfparams = tuple(self.psf.params)
+            for i in dostars:
+                imflat[self.fravelindexlist[i]] += sign*self.fullstarmodel(i,self.staramp[i],self.starxcen[i],
+                                                                           self.starycen[i],psfparams)
+
+    def fullstarmodel(self,i,amp,xcen,ycen,psfparams):
+        """
+        Return the model of star I over its full PSF region.  This is wrapped
+        in an LRU cache in __init__, keyed on the star parameters and the PSF
+        parameters, so a star that is evaluated again with the same values
+        (like a frozen star in the final model) is not recomputed.  The
+        returned array is shared, do not modify it.
+        """
+        return self.psf(self.fxlist[i],self.fylist[i],[amp,xcen,ycen])
         
     @property
     def modelflatten(self):
@@ -471,6 +592,31 @@ class GroupFitter(object):
             using the PARS values."""
         return self.model(np.arange(10),*self.pars,allparams=True,verbose=False)
         
+    def psfflat(self,allpars,dostars,nderiv=0):
+        """
+        Compute the PSF models (and derivatives) of stars DOSTARS on the flat pixel arrays.
+        This uses the numba models if the PSF has one, otherwise psf.jac_batch().
+        The returned model and derivative arrays are reused buffers that are
+        overwritten by the next call, and only the USE pixels are valid.
+        """
+        starpars = np.zeros((self.nstars,3+len(self.psf.params)),float)
+        starpars[:,:3] = np.asarray(allpars[0:3*self.nstars]).reshape(self.nstars,3)
+        starpars[:,3:] = self.psf.params
+        mflat,dflat = self.mflat,self.dflat
+        # Flat pixels belonging to the stars that are computed
+        domask = np.zeros(self.nstars,bool)
+        domask[dostars] = True
+        use = domask[self.starflat]
+        # Compiled code
+        if self.psftype>0:
+            mnb.amodel2d_flat(self.xflat,self.yflat,self.staroffsets,np.asarray(dostars,np.int64),
+                              self.psftype,starpars,nderiv,mflat,dflat)
+        # Batched PSF object, the derivatives come with the model
+        else:
+            mflat[use],dflat[use,:] = self.psf.jac_batch(self.xflat[use],self.yflat[use],self.starflat[use],
+                                                         starpars[:,:3],retmodel=True)
+        return use,mflat,dflat
+        
     def model(self,x,*args,trim=False,allparams=False,verbose=None):
         """ Calculate the model for the pixels we are fitting."""
         # ALLPARAMS:  all of the parameters were input
@@ -486,7 +632,7 @@ class GroupFitter(object):
         # Figure out the parameters of ALL the stars
         #  some stars and parameters are FROZEN
         if self.nfreezepars>0 and allparams is False:
-            allpars = self.pars
+            allpars = self.pars    # a new array, the stored parameters are not changed
             allpars[self.freepars] = args
         else:
             allpars = args
@@ -505,14 +651,19 @@ class GroupFitter(object):
             dostars = np.arange(self.nstars)[self.freestars]
         else:
             dostars = np.arange(self.nstars)
-        for i in dostars:
-            pars = allpars[i*3:(i+1)*3]
-            xind = self.xlist[i]
-            yind = self.ylist[i]
-            invindex = self.invindexlist[i]
-            im1 = psf(xind,yind,pars)
-            allim[invindex] += im1
-            usepix[invindex] = True
+        if self.psftype>0:
+            # All stars at once in compiled code
+            use,mflat,_ = self.psfflat(allpars,dostars)
+            invflat = self.invflat[use]
+            allim += np.bincount(invflat,weights=mflat[use],minlength=self.ntotpix)
+            usepix[invflat] = True
+        elif len(dostars)>0:
+            # Concatenate the star models and scatter them with one bincount
+            invflat = np.concatenate([self.invindexlist[i] for i in dostars])
+            mflat = np.concatenate([psf(self.xlist[i],self.ylist[i],allpars[i*3:(i+1)*3])
+                                    for i in dostars])
+            allim += np.bincount(invflat,weights=mflat,minlength=self.ntotpix)
+            usepix[invflat] = True
 
         allim += allpars[-1]  # add sky offset
             
@@ -523,13 +674,13 @@ class GroupFitter(object):
             unused = np.arange(self.ntotpix)[~usepix]
             allim = np.delete(allim,unused)
         
-        self.niter += 1
-        
         return allim
 
     
-    def jac(self,x,*args,retmodel=False,trim=False,allparams=False,verbose=None):
-        """ Calculate the jacobian for the pixels and parameters we are fitting"""
+    def jac(self,x,*args,retmodel=False,trim=False,allparams=False,retsparse=False,verbose=None):
+        """ Calculate the jacobian for the pixels and parameters we are fitting.
+            With retsparse=True the jacobian is returned as a scipy.sparse CSC matrix
+            that only stores the nonzero derivatives."""
 
         if verbose is None and self.verbose:
             print('jac: ',self.njaciter,args)
@@ -542,10 +693,9 @@ class GroupFitter(object):
         # Figure out the parameters of ALL the stars
         #  some stars and parameters are FROZEN
         if self.nfreezepars>0 and allparams is False:
-            allpars = self.pars
+            allpars = self.pars    # a new array, the stored parameters are not changed
             if len(args) != (len(self.pars)-self.nfreezepars):
-                print('problem')
-                import pdb; pdb.set_trace()
+                raise ValueError('Number of input parameters does not match the number of free parameters')
             allpars[self.freepars] = args
         else:
             allpars = args
@@ -554,11 +704,13 @@ class GroupFitter(object):
         y0,y1 = self.bbox.yrange
         nx = x1-x0-1
         ny = y1-y0-1
-        #jac = np.zeros((nx,ny,len(args)),float)    # image covered by star
-        jac = np.zeros((self.ntotpix,len(self.pars)),float)    # image covered by star
-        usepix = np.zeros(self.ntotpix,bool)
-        if retmodel:
-            im = np.zeros(self.ntotpix,float)
+        # Only allocate the columns of the free parameters, frozen
+        #  parameters have colindex=-1 and are never written
+        if self.nfreezepars>0 and allparams is False:
+            colindex = self.freecolindex
+        else:
+            colindex = np.arange(len(self.pars))
+        ncols = np.max(colindex)+1
 
         # Loop over the stars and generate the model image        
         # ONLY LOOP OVER UNFROZEN STARS
@@ -566,42 +718,52 @@ class GroupFitter(object):
             dostars = np.arange(self.nstars)[self.freestars]
         else:
             dostars = np.arange(self.nstars)
-        for i in dostars:
-            pars = allpars[i*3:(i+1)*3]
-            #bbox = self.bboxdata[i]
-            xind = self.xlist[i]
-            yind = self.ylist[i]
-            invindex = self.invindexlist[i]
-            xdata = (xind,yind)
-            if retmodel:
-                m,jac1 = psf.jac(xdata,*pars,retmodel=True)
-            else:
-                jac1 = psf.jac(xdata,*pars)
-            jac[invindex,i*3] = jac1[:,0]
-            jac[invindex,i*3+1] = jac1[:,1]
-            jac[invindex,i*3+2] = jac1[:,2]
-            #jac[invindex,i*4+3] = jac1[:,3]
-            if retmodel:
-                im[invindex] += m
-            usepix[invindex] = True
-
-        # Sky gradient
-        jac[:,-1] = 1
-            
-        # Remove frozen columns
-        if self.nfreezepars>0 and allparams is False:
-            jac = np.delete(jac,np.arange(len(self.pars))[self.freezepars],axis=1)
-
-
+        # All stars at once
+        use,mflat,dflat = self.psfflat(allpars,dostars,nderiv=3)
+        invflat = self.invflat[use]
+        starflat = self.starflat[use]
+        usepix = np.zeros(self.ntotpix,bool)
+        usepix[invflat] = True
         self.usepix = usepix
         nusepix = np.sum(usepix)
+        if retmodel:
+            im = np.bincount(invflat,weights=mflat[use],minlength=self.ntotpix)
 
-        # Trim out unused pixels
+        # Trim out unused pixels, the jacobian only gets the used rows
         if trim and nusepix<self.ntotpix:
-            unused = np.arange(self.ntotpix)[~usepix]
-            jac = np.delete(jac,unused,axis=0)
+            rowindex = np.cumsum(usepix)-1   # row of each pixel after trimming
+            nrows = nusepix
             if retmodel:
-                im = np.delete(im,unused)
+                im = im[usepix]
+        else:
+            rowindex = np.arange(self.ntotpix)
+            nrows = self.ntotpix
+        rows,cols,data = [],[],[]
+        for k in range(3):
+            col = colindex[3*starflat+k]
+            good = (col>=0)
+            rows.append(rowindex[invflat[good]])
+            cols.append(col[good])
+            data.append(dflat[use,k][good])
+
+        # Sparse jacobian, built directly from the (row,column,value) entries
+        if retsparse:
+            # Sky gradient
+            if colindex[-1]>=0:
+                rows.append(np.arange(nrows))
+                cols.append(np.full(nrows,colindex[-1]))
+                data.append(np.ones(nrows))
+            jac = sparse.csc_matrix((np.concatenate(data).astype(self.dtype,copy=False),
+                                     (np.concatenate(rows),np.concatenate(cols))),shape=(nrows,ncols))
+        # Dense jacobian, column-major since it goes to LAPACK and the
+        #  columns are filled one parameter at a time
+        else:
+            jac = np.zeros((nrows,ncols),self.dtype,order='F')
+            for k in range(3):
+                jac[rows[k],cols[k]] = data[k]
+            # Sky gradient
+            if colindex[-1]>=0:
+                jac[:,colindex[-1]] = 1
         
         self.njaciter += 1
         
@@ -612,6 +774,7 @@ class GroupFitter(object):
 
     def linesearch(self,xdata,bestpar,dbeta,m,jac):
         # Perform line search along search gradient
+        #  returns the step size, the step and the chisq at the new parameters
         # Residuals
         flux = self.resflatten[self.usepix]-self.skyflatten[self.usepix]
         # Weights
@@ -649,7 +812,16 @@ class GroupFitter(object):
         #    alpha = 1.0
         pars_new = start_point + alpha * search_gradient
         new_dbeta = alpha * search_gradient
-        return alpha,new_dbeta
+        # Chisq at the new parameters, reuse the evaluated points if possible
+        if alpha==1.0:
+            chisq = f2
+        elif alpha==0.5:
+            chisq = f1
+        elif alpha==0.0:
+            chisq = f0
+        else:
+            chisq = obj_func(pars_new)
+        return alpha,new_dbeta,chisq
     
         
     def ampfit(self,trim=True):
@@ -664,13 +836,19 @@ class GroupFitter(object):
         # All parameters
         allpars = self.pars
         
-        A = np.zeros((self.ntotpix,self.nstars),float)
         usepix = np.zeros(self.ntotpix,bool)
 
         # Loop over the stars and generate the model image        
         # ONLY LOOP OVER UNFROZEN STARS
+        #  A is sparse, so only fill in the nonzero (row,column,value)
+        #  entries of each star's column and build it in one shot
         dostars = np.arange(self.nstars)[self.freestars]
         guess = np.zeros(self.nfreestars,float)
+        nnz = np.sum([len(self.invindexlist[i]) for i in dostars],dtype=int)
+        rows = np.zeros(nnz,int)
+        cols = np.zeros(nnz,int)
+        data = np.zeros(nnz,float)
+        off = 0
         for count,i in enumerate(dostars):
             pars = allpars[i*3:(i+1)*3].copy()
             guess[count] = pars[0]
@@ -679,30 +857,47 @@ class GroupFitter(object):
             yind = self.ylist[i]
             invindex = self.invindexlist[i]
             im1 = self.psf(xind,yind,pars)
-            A[invindex,i] = im1
+            n = len(invindex)
+            rows[off:off+n] = invindex
+            cols[off:off+n] = count
+            data[off:off+n] = im1
+            off += n
             usepix[invindex] = True
 
         nusepix = np.sum(usepix)
 
         # Residual data
         dy = self.resflatten-self.skyflatten
+        nrows = self.ntotpix
         
         if trim and nusepix<self.ntotpix:
-            unused = np.arange(self.ntotpix)[~usepix]
-            A = np.delete(A,unused,axis=0)
+            # Renumber the rows to skip the unused pixels
+            rows = (np.cumsum(usepix)-1)[rows]
             dy = dy[usepix]
+            nrows = nusepix
 
-        from scipy import sparse
-        A = sparse.csc_matrix(A)   # make sparse
+        A = sparse.csc_matrix((data,(rows,cols)),shape=(nrows,self.nfreestars))
 
         # Use guess to get close to the solution
         dy2 = dy - A.dot(guess)
-        par = sparse.linalg.lsqr(A,dy2,atol=1e-4,btol=1e-4)
-        damp = par[0]
+
+        # Solve the normal equations, AtA is small [Nstar,Nstar] and only
+        #  stars that share pixels have off-diagonal terms
+        AtA = (A.T @ A).tocsc()
+        Atb = A.T @ dy2
+        diag = AtA.diagonal()
+        # Stars with no model pixels get no correction
+        bad = (diag==0)
+        if np.sum(bad)>0:
+            AtA = AtA + sparse.diags(bad.astype(float),format='csc')
+            diag = AtA.diagonal()
+        if AtA.nnz==self.nfreestars:
+            # Isolated stars, the system is diagonal
+            damp = Atb/diag
+        else:
+            damp = sparse.linalg.spsolve(AtA,Atb)
         amp = guess+damp
-        
-        # preconditioning!
-        
+
         return amp
 
     
@@ -715,28 +910,22 @@ class GroupFitter(object):
         # All parameters
         allpars = self.pars
 
-        resid = self.image.data.copy()-self.skyim
+        # The frozen stars' models are cached
+        resid = np.subtract(self.image.data,self.skyim,out=self.scratchim)
+        resid -= self.frozenmodelim
+        residflat = resid.ravel()   # view
         
         # Generate full models 
         # Loop over the stars and generate the model image        
         # ONLY LOOP OVER UNFROZEN STARS
-        fmodels = []
-        #fjac = []
+        #  the full models are concatenated and subtracted in one go
         models = []
         jac = []
         dostars = np.arange(self.nstars)[self.freestars]
-        usepix = np.zeros(self.ntotpix,bool)        
+        # Subtract the full models
+        self.addfullmodel(residflat,dostars,sign=-1)
         for count,i in enumerate(dostars):
-            pars = self.starpars[i]
-            #pars = allpars[i*3:(i+1)*3]
-            # Full models
-            fxind = self.fxlist[i]
-            fyind = self.fylist[i]
-            fim1 = self.psf(fxind,fyind,pars)
-            resid[fyind,fxind] -= fim1
-            fmodels.append(fim1)            
-            #fjac.append(fjac1)
-            #fusepix[finvindex] = True
+            pars = [self.staramp[i],self.starxcen[i],self.starycen[i]]
             # Only fitting models
             xind = self.xlist[i]
             yind = self.ylist[i]
@@ -744,13 +933,12 @@ class GroupFitter(object):
             im1,jac1 = self.psf.jac((xind,yind),*pars,retmodel=True)
             models.append(im1)
             jac.append(jac1)
-            #usepix[invindex] = True
 
         # Loop over all free stars and fit centroid
         xnew = np.zeros(self.nfreestars,float)
         ynew = np.zeros(self.nfreestars,float)
         for count,i in enumerate(dostars):
-            pars = self.starpars[i]
+            pars = [self.staramp[i],self.starxcen[i],self.starycen[i]]
             freezepars = self.freezepars[i*3:(i+1)*3]
             xnew[count] = pars[1]
             ynew[count] = pars[2]
@@ -760,9 +948,6 @@ class GroupFitter(object):
                 continue
             
             # Add the model for this star back in
-            fxind = self.fxlist[i]
-            fyind = self.fylist[i]
-            fmodel1 = fmodels[count]
             #resid[fyind,fxind] += fmodel1
             
             # crowdsource, does a sum
@@ -774,7 +959,7 @@ class GroupFitter(object):
             yind = self.ylist[i]
             jac1 = jac[count]
             jac1 = np.delete(jac1,0,axis=1)  # delete amp column
-            resid1 = resid[yind,xind] 
+            resid1 = residflat[self.ravelindexlist[i]]
 
             # CHOLESKY_JAC_SOLVE NEEDS THE ACTUAL RESIDUALS!!!!
             #  with the star removed!!
@@ -803,8 +988,9 @@ class GroupFitter(object):
         return xnew,ynew
         
         
-    def cov(self):
-        """ Determine the covariance matrix."""
+    def hessian(self):
+        """ Return the weighted Hessian (J.T * W * J) of all the parameters and the
+            reduced chi-squared that the inverse is rescaled by to get the covariance."""
 
         # https://stats.stackexchange.com/questions/93316/parameter-uncertainty-after-non-linear-least-squares-estimation
         # more background here, too: http://ceres-solver.org/nnls_covariance.html        
@@ -812,35 +998,91 @@ class GroupFitter(object):
         # Hessian = J.T * T, Hessian Matrix
         #  higher order terms are assumed to be small
         # https://www8.cs.umu.se/kurser/5DA001/HT07/lectures/lsq-handouts.pdf
-        mjac = self.jac(xdata,*self.pars,allparams=True,trim=False,verbose=False)
+        #  the model comes out of the same pass, it does not include the sky offset
+        allpars = self.pars
+        bestmodel,mjac = self.jac(xdata,*allpars,allparams=True,trim=False,retmodel=True,verbose=False)
+        mjac = mjac.astype(float,copy=False)
         # Weights
         #   If weighted least-squares then
         #   J.T * W * J
         #   where W = I/sig_i**2
-        wt = np.diag(1/self.errflatten**2)
-        hess = mjac.T @ (wt @ mjac)
+        #   scale the rows by the weights instead of making the diagonal W matrix
+        wt = 1/self.errflatten**2
+        hess = mjac.T @ (mjac * wt.reshape(-1,1))
         #hess = mjac.T @ mjac  # not weighted
-        # cov = H-1, covariance matrix is inverse of Hessian matrix
-        cov_orig = lsq.inverse(hess)
         # Rescale to get an unbiased estimate
         # cov_scaled = cov * (RSS/(m-n)), where m=number of measurements, n=number of parameters
         # RSS = residual sum of squares
         #  using rss gives values consistent with what curve_fit returns
-        bestmodel = self.model(xdata,*self.pars,allparams=True,trim=False,verbose=False)
-        resid = self.imflatten-self.skyflatten-bestmodel
+        resid = self.imflatten-self.skyflatten-(bestmodel+allpars[-1])
         #cov = cov_orig * (np.sum(resid**2)/(self.ntotpix-len(self.pars)))
         # Use chi-squared, since we are doing the weighted least-squares and weighted Hessian
         chisq = np.sum(resid**2/self.errflatten**2)        
-        cov = cov_orig * (chisq/(self.ntotpix-len(self.pars)))  # what MPFITFUN suggests, but very small
+        scale = chisq/(self.ntotpix-len(self.pars))  # what MPFITFUN suggests, but very small
+        return hess,scale
+    
+    def cov(self,hess=None,scale=None):
+        """ Determine the covariance matrix."""
+        if hess is None:
+            hess,scale = self.hessian()
+        # cov = H-1, covariance matrix is inverse of Hessian matrix
+        #  the Hessian is symmetric positive definite so use Cholesky,
+        #  fall back to the general inverse if it is singular
+        try:
+            cov_orig = cho_solve(cho_factor(hess),np.eye(len(hess)))
+        except np.linalg.LinAlgError:
+            cov_orig = lsq.inverse(hess)
+        cov = cov_orig * scale
 
         # cov = lqr.jac_covariange(mjac,resid,wt)
         
         return cov
 
+    def perror(self):
+        """ Return the parameter uncertainties, the square root of the diagonal of
+            the covariance matrix.  Stars that don't share any pixels only couple
+            through the sky offset, so the Hessian is block-diagonal with a border.
+            Then only the blocks of the overlapping stars are inverted and the
+            sky is added back with the Schur complement."""
+        hess,scale = self.hessian()
+        nstars = self.nstars
+        # Stars that share pixels have nonzero Hessian terms
+        starhess = np.abs(hess[:-1,:-1]).reshape(nstars,3,nstars,3).sum(axis=(1,3))
+        ncomp,label = connected_components(sparse.csr_matrix(starhess),directed=False)
+        # All of the stars are coupled
+        if ncomp==1:
+            return np.sqrt(np.diag(self.cov(hess,scale)))
+        # H = [[B, c], [c.T, d]], with B block-diagonal
+        #  diag(H-1) = diag(B-1) + (B-1 c)**2 / s  and  1/s for the sky
+        #  where s = d - c.T B-1 c
+        var = np.zeros(3*nstars+1,float)
+        binvc = np.zeros(3*nstars,float)
+        c = hess[:-1,-1]
+        # Invert the blocks of the same size together
+        order = np.argsort(label,kind='stable')
+        compsize = np.bincount(label)
+        compoffset = np.concatenate(([0],np.cumsum(compsize)))
+        for size in np.unique(compsize):
+            comps, = np.where(compsize==size)
+            # Star indices [Ncomp,Nsize], then parameter indices [Ncomp,3*Nsize]
+            stars = order[compoffset[comps].reshape(-1,1)+np.arange(size)]
+            ind = (3*stars.reshape(len(comps),size,1)+np.arange(3)).reshape(len(comps),3*size)
+            blocks = hess[ind[:,:,None],ind[:,None,:]]
+            try:
+                binv = np.linalg.inv(blocks)
+            except np.linalg.LinAlgError:
+                return np.sqrt(np.diag(self.cov(hess,scale)))
+            var[ind] = np.diagonal(binv,axis1=1,axis2=2)
+            binvc[ind] = np.einsum('kij,kj->ki',binv,c[ind])
+        schur = hess[-1,-1] - c @ binvc
+        var[:-1] += binvc**2/schur
+        var[-1] = 1/schur
+        return np.sqrt(var*scale)
         
     
 def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minpercdiff=0.5,
-        reskyiter=2,nofreeze=False,skyfit=True,absolute=False,verbose=False):
+        reskyiter=2,nofreeze=False,minchisqdiff=0.1,skyfit=True,absolute=False,dtype=np.float64,
+        verbose=False):
     """
     Fit PSF to group of stars in an image.
 
@@ -854,7 +1096,9 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
        Catalog with initial amp/x/y values for the stars to use to fit the PSF.
     method : str, optional
        Method to use for solving the non-linear least squares problem: "cholesky",
-       "qr", "svd", and "curve_fit".  Default is "cholesky".
+       "qr", "svd" (complete orthogonal decomposition), "svd_full"
+       (explicit SVD), "sparse" (direct sparse solve of the normal equations), and
+       "curve_fit".  Default is "cholesky".
     fitradius: float, optional
        The fitting radius in pixels.  By default the PSF FWHM is used.
     recenter : boolean, optional
@@ -873,8 +1117,18 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
          Default is False, everything is relative.
     nofreeze : boolean, optional
        Do not freeze any parameters even if they have converged.  Default is False.
+    minchisqdiff : float, optional
+       Minimum percent change in a star's chi-squared.  A star whose chi-squared
+         changes less than this for two iterations in a row is frozen even if
+         its parameters have not converged yet.  Only for methods "cholesky",
+         "qr" and "svd".  Default is 0.1.
     skyfit : boolean, optional
        Fit a constant sky offset with the stellar parameters.  Default is True.
+    dtype : numpy dtype, optional
+       Data type of the flattened data, PSF models and jacobian during the iterations.
+         np.float32 halves the memory traffic, the weighted least-squares solve,
+         the parameters and the final covariance are always float64.
+         Default is np.float64.
     verbose : boolean, optional
        Verbose output.
 
@@ -883,10 +1137,11 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
     out : table
        Table of best-fitting parameters for each star.
        id, amp, amp_error, x, x_err, y, y_err, sky
-    model : numpy array
-       Best-fitting model of the stars and sky background.
+    model : CCDData object
+       Best-fitting model of the stars (no sky).  This only covers the
+         bounding box of the PSF regions of the stars.
     sky : numpy array
-       Best-fitting sky image.
+       Best-fitting sky image, over the same region as the model.
 
     Example
     -------
@@ -905,8 +1160,8 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
 
     # Check the method
     method = str(method).lower()    
-    if method not in ['cholesky','svd','qr','sparse','htcen','curve_fit']:
-        raise ValueError('Only cholesky, svd, qr, sparse, htcen or curve_fit methods currently supported')
+    if method not in ['cholesky','svd','svd_full','qr','sparse','htcen','curve_fit']:
+        raise ValueError('Only cholesky, svd, svd_full, qr, sparse, htcen or curve_fit methods currently supported')
 
     # Make sure image is CCDData
     if isinstance(image,CCDData) is False:
@@ -922,7 +1177,7 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
         cat['y'] -= imy0        
         
     # Start the Group Fitter
-    gf = GroupFitter(psf,image,cat,fitradius=fitradius,verbose=(verbose>=2))
+    gf = GroupFitter(psf,image,cat,fitradius=fitradius,verbose=(verbose>=2),dtype=dtype)
     xdata = np.arange(gf.ntotpix)
     if skyfit==False:
         gf.freezepars[-1] = True  # freeze sky value
@@ -988,6 +1243,8 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
         bestpar = initpar.copy()
         npars = len(bestpar)
         maxsteps = gf.steps(gf.pars,bounds)  # maximum steps, requires all 3*Nstars parameters
+        laststarchisq = np.zeros(gf.nstars,float)
+        nstarchisqconv = np.zeros(gf.nstars,int)   # iterations in a row with stationary chisq
         while (gf.niter<maxiter and maxpercdiff>minpercdiff and gf.nfreepars>0):
             start0 = time.time()
 
@@ -995,13 +1252,18 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
             if method != 'htcen':
                 # Get the Jacobian and model
                 #  only for pixels that are affected by the "free" parameters
-                m,jac = gf.jac(xdata,*bestpar,retmodel=True,trim=True)
+                #  the sparse solver gets the jacobian in sparse form
+                m,jac = gf.jac(xdata,*bestpar,retmodel=True,trim=True,retsparse=(method=='sparse'))
                 # Residuals
-                dy = gf.resflatten[gf.usepix]-gf.skyflatten[gf.usepix]-m
-                # Weights
-                wt = 1/gf.errflatten[gf.usepix]**2
+                dy = (gf.resflatten[gf.usepix]-gf.skyflatten[gf.usepix]-m).astype(gf.dtype,copy=False)
+                # Weights, in float64 so the solvers form and solve the
+                #  normal equations in double precision
+                wt = 1/gf.errflatten[gf.usepix].astype(float)**2
                 # Solve Jacobian
-                dbeta_free = lsq.jac_solve(jac,dy,method=method,weight=wt)
+                if method=='sparse':
+                    dbeta_free = gf.sparsesolve(jac,dy,weight=wt)
+                else:
+                    dbeta_free = lsq.jac_solve(jac,dy,method=method,weight=wt)
                 dbeta_free[~np.isfinite(dbeta_free)] = 0.0  # deal with NaNs, shouldn't happen
                 dbeta = np.zeros(len(gf.pars),float)
                 #import pdb; pdb.set_trace()
@@ -1032,9 +1294,19 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
             chisq = np.sum(dy**2 * wt.ravel())/len(dy)
             
             # Perform line search
-            alpha,new_dbeta_free = gf.linesearch(xdata,bestpar,dbeta_free,m,jac)
+            alpha,new_dbeta_free,lschisq = gf.linesearch(xdata,bestpar,dbeta_free,m,jac)
             new_dbeta = np.zeros(len(gf.pars),float)
             new_dbeta[gf.freepars] = new_dbeta_free
+
+            # Chi-squared of the linear prediction of the residuals
+            #  and each star's share of it
+            if method != 'htcen':
+                chisqpix = np.zeros(gf.ntotpix,float)
+                chisqpix[gf.usepix] = (dy-jac @ new_dbeta_free)**2 * wt
+                starchisq = np.bincount(gf.starflat,weights=chisqpix[gf.invflat],minlength=gf.nstars)
+                chisqdiff = np.abs(starchisq-laststarchisq)/np.maximum(laststarchisq,1e-10)*100
+                nstarchisqconv = np.where(chisqdiff<=minchisqdiff,nstarchisqconv+1,0)
+                laststarchisq = starchisq
             
             # Update parameters
             oldpar = bestpar.copy()
@@ -1057,6 +1329,11 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
             #  also return new free parameters
             if not nofreeze:
                 frzpars = percdiff<=minpercdiff
+                # Also freeze stars whose chisq has been stationary
+                if method != 'htcen':
+                    chisqconv = np.zeros(len(gf.pars),bool)
+                    chisqconv[0:-1] = np.repeat(nstarchisqconv>=2,3)
+                    frzpars |= chisqconv[gf.freepars]
                 freeparsind, = np.where(~gf.freezepars)
                 bestpar = gf.freeze(bestpar,frzpars)
                 # If the only free parameter is the sky offset,
@@ -1074,11 +1351,15 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
             maxpercdiff = np.max(percdiff)
 
             # Get model and chisq
-            if method != 'curve_fit':
+            #  the full model is only needed for the verbose output,
+            #  otherwise use the chisq from the line search
+            if verbose:
                 bestmodel = gf.model(xdata,*gf.pars,allparams=True)
                 resid = gf.imflatten-gf.skyflatten-bestmodel
                 chisq = np.sum(resid**2/gf.errflatten**2)
-                gf.chisq = chisq
+            else:
+                chisq = lschisq
+            gf.chisq = chisq
               
             if verbose:
                 print('Iter = '+str(gf.niter))
@@ -1100,17 +1381,22 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
     # Check that all starniter are set properly
     #  if we stopped "prematurely" then not all stars were frozen
     #  and didn't have starniter set
-    gf.starniter[gf.starniter==0] = gf.niter
+    np.copyto(gf.starniter,gf.niter,where=(gf.starniter==0))
     
     # Make final model
+    #  only return the patch covered by the PSF regions of the stars
     gf.unfreeze()
-    model = CCDData(gf.modelim,bbox=image.bbox,unit=image.unit)
+    fx = np.concatenate(gf.fxlist)
+    fy = np.concatenate(gf.fylist)
+    patch = BoundingBox(np.min(fx),np.max(fx)+1,np.min(fy),np.max(fy)+1)
+    x0,y0 = image.bbox.ixmin,image.bbox.iymin
+    model = CCDData(gf.modelim[patch.slices],unit=image.unit,
+                    bbox=BoundingBox(patch.ixmin+x0,patch.ixmax+x0,patch.iymin+y0,patch.iymax+y0))
         
     # Estimate uncertainties
     if method != 'curve_fit':
-        # Calculate covariance matrix
-        cov = gf.cov()
-        perror = np.sqrt(np.diag(cov))
+        # Uncertainties from the diagonal of the covariance matrix
+        perror = gf.perror()
         
     pars = gf.pars
     if verbose:
@@ -1129,12 +1415,11 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
         outcat['id'] = cat['id']
     else:
         outcat['id'] = np.arange(nstars)+1
-    outcat['amp'] = pars[0:-1:3]
-    outcat['amp_error'] = perror[0:-1:3]
-    outcat['x'] = pars[1::3]
-    outcat['x_error'] = perror[1::3]
-    outcat['y'] = pars[2::3]
-    outcat['y_error'] = perror[2::3]
+    # [Nstars,3] views of the amp/x/y parameters and errors
+    starpars = pars[0:3*nstars].reshape(nstars,3)
+    starperror = perror[0:3*nstars].reshape(nstars,3)
+    outcat['amp'],outcat['x'],outcat['y'] = starpars.T
+    outcat['amp_error'],outcat['x_error'],outcat['y_error'] = starperror.T
     outcat['sky'] = gf.starsky + pars[-1]
     outcat['flux'] = outcat['amp']*psf.flux()
     outcat['flux_error'] = outcat['amp_error']*psf.flux()    
@@ -1167,4 +1452,4 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
     if verbose:
         print('dt = %.2f sec' % (time.time()-start))        
         
-    return outcat,model,gf.skyim
+    return outcat,model,gf.skyim[patch.slices]
@@ -19,7 +19,7 @@ from .clock_numba import clock
 
 
 #@njit(cache=True)
-@njit
+@njit(cache=True)
 def getstar(imshape,mask,xcen,ycen,hpsfnpix,fitradius,skyradius):
     """ Return a star's full footprint, fitted pixels, and sky pixels data."""
     # always return the same size
@@ -69,7 +69,7 @@ def getstar(imshape,mask,xcen,ycen,hpsfnpix,fitradius,skyradius):
     return (fravelindex,fcount,ravelindex,count,skyravelindex,skycount)
 
 #@njit(cache=True)
-@njit
+@njit(cache=True)
 def collatestars(imshape,mask,starx,stary,hpsfnpix,fitradius,skyradius):
     """ Get full footprint, fitted pixels, and sky pixels data for all stars."""
     nstars = len(starx)
@@ -104,7 +104,7 @@ def collatestars(imshape,mask,starx,stary,hpsfnpix,fitradius,skyradius):
     skyravelindex = skyravelindex[:,:maxskyn]
     return (fravelindex,fndata,ravelindex,ndata,skyravelindex,skyndata)
 
-@njit
+@njit(cache=True)
 def initstararrays(image,error,mask,tab,psfnpix,fitradius,skyradius,skyfit):
     """ Initialize all of the star arrays."""
 
@@ -242,7 +242,7 @@ def initstararrays(image,error,mask,tab,psfnpix,fitradius,skyradius,skyfit):
             xflat,yflat,indflat,imflat,errflat,resflat,ntotpix,
             starfitinvindex,starflat_index,starflat_ndata)
 
-@njit
+@njit(cache=True)
 def sky(image,modelim,method='sep',rin=None,rout=None):
     """ (Re)calculate the sky."""
     # Remove the current best-fit model
@@ -279,7 +279,7 @@ def sky(image,modelim,method='sep',rin=None,rout=None):
     #         raise ValueError("Sky method "+method+" not supported")
 
 
-@njit
+@njit(cache=True)
 def psf(xdata,pars,psfdata):
     """ Thin wrapper for getting a PSF model for a single star."""
     xind,yind = xdata
@@ -289,7 +289,7 @@ def psf(xdata,pars,psfdata):
     return im1
         
         
-@njit
+@njit(cache=True)
 def psfjac(xdata,pars,psfdata):
     """ Thin wrapper for getting the PSF model and Jacobian for a single star."""
     xind,yind = xdata
@@ -299,7 +299,7 @@ def psfjac(xdata,pars,psfdata):
     return im1,jac1
     
 
-@njit
+@njit(cache=True)
 def model(psfdata,freezedata,flatdata,pars,trim=False,allparams=False,verbose=False):
     """ Calculate the model for the stars and pixels we are fitting."""
 
@@ -357,7 +357,7 @@ def model(psfdata,freezedata,flatdata,pars,trim=False,allparams=False,verbose=Fa
         
     return allim
 
-@njit
+@njit(cache=True)
 def fullmodel(psfdata,stardata,pars):
     """ Calculate the model for all the stars and the full footprint."""
     
@@ -468,7 +468,7 @@ def jac(psfdata,freezedata,flatdata,pars,trim=False,allparams=False):
         
     return im,jac
 
-@njit
+@njit(cache=True)
 def chisqflat(freezedata,flatdata,psfdata,resflat,errflat,pars):
     """ Return chi-squared of the flat data"""
     # Note this ignores any frozen stars
@@ -477,7 +477,7 @@ def chisqflat(freezedata,flatdata,psfdata,resflat,errflat,pars):
     return chisq
 
 
-@njit
+@njit(cache=True)
 def cov(psfdata,freezedata,covflatdata,pars):
     """ Determine the covariance matrix."""
     
@@ -515,7 +515,7 @@ def cov(psfdata,freezedata,covflatdata,pars):
         
     return cov
 
-@njit
+@njit(cache=True)
 def dofreeze(frzpars,pars,freezedata,flatdata,psfdata,resid,resflat):
     """ Freeze par/stars."""
 
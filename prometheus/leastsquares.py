@@ -11,6 +11,7 @@ __version__ = '20210908'  # yyyymmdd
 import sys
 import numpy as np
 import scipy
+from scipy.linalg.lapack import dpotrf, dpotrs, dgetrf, dgetrs
 
 def ishermitian(A):
     """ check if a matrix is Hermitian (equal to it's conjugate transpose)."""
@@ -269,6 +270,9 @@ def jac_solve(jac,resid,method=None,weight=None):
     if method=='qr':
         dbeta = qr_jac_solve(usejac,resid,weight=weight)
     elif method=='svd':
+        # Complete orthogonal decomposition, rank-revealing like the SVD but cheaper
+        dbeta = qr_jac_solve(usejac,resid,weight=weight,driver='gelsy')
+    elif method=='svd_full':
         dbeta = svd_jac_solve(usejac,resid,weight=weight)
     elif method=='cholesky':
         dbeta = cholesky_jac_solve(usejac,resid,weight=weight)
@@ -289,23 +293,34 @@ def jac_solve(jac,resid,method=None,weight=None):
     
     return dbeta
 
-def qr_jac_solve(jac,resid,weight=None):
-    """ Solve part of a non-linear least squares equation using QR decomposition
-        using the Jacobian."""
+def qr_jac_solve(jac,resid,weight=None,driver=None,dtype=None):
+    """ Solve part of a non-linear least squares equation using the Jacobian
+        with a LAPACK least squares driver.  The default is numpy's gelsd,
+        other scipy drivers ("gelsy", "gelss") can be picked with driver.
+        Set dtype=np.float32 to do the solve in single precision, which is
+        plenty when the fit only needs to converge to ~1e-4 or worse."""
     # jac: Jacobian matrix, first derivatives, [Npix, Npars]
     # resid: residuals [Npix]
     # weight: weights, ~1/error**2 [Npix]
     
-    # QR decomposition
-    if weight is None:
-        q,r = np.linalg.qr(jac)
-        rinv = inverse(r)
-        dbeta = rinv @ (q.T @ resid)
     # Weights input, multiply resid and jac by weights        
+    if weight is not None:
+        jac = jac * weight.reshape(-1,1)
+        resid = resid * weight
+    # Lower precision solve, the step is returned as float64
+    if dtype is not None:
+        jac = jac.astype(dtype,copy=False)
+        resid = resid.astype(dtype,copy=False)
+
+    # A single LAPACK call is faster than an explicit QR factorization for
+    #  tall, skinny Jacobians, and parameters with all-zero columns get a
+    #  zero (minimum-norm) step
+    if driver is None:
+        dbeta = np.linalg.lstsq(jac,resid,rcond=None)[0]
     else:
-        q,r = np.linalg.qr( jac * weight.reshape(-1,1) )
-        rinv = inverse(r)
-        dbeta = rinv @ (q.T @ (resid*weight))
+        dbeta = scipy.linalg.lstsq(jac,resid,lapack_driver=driver,check_finite=False)[0]
+    if dtype is not None:
+        dbeta = dbeta.astype(np.float64)
         
     return dbeta
 
@@ -317,74 +332,104 @@ def svd_jac_solve(jac,resid,weight=None):
 
     # Precondition??
     
-    # Singular Value decomposition (SVD)
-    if weight is None:
-        u,s,vt = np.linalg.svd(jac)
-        #u,s,vt = sparse.linalg.svds(jac)
-        # u: [Npix,Npix]
-        # s: [Npars]
-        # vt: [Npars,Npars]
-        # dy: [Npix]
-        sinv = s.copy()*0  # pseudo-inverse
-        sinv[s!=0] = 1/s[s!=0]
-        npars = len(s)
-        dbeta = vt.T @ ((u.T @ resid)[0:npars]*sinv)
-
     # multply resid and jac by weights
-    else:
-        u,s,vt = np.linalg.svd( jac * weight.reshape(-1,1) )
-        sinv = s.copy()*0  # pseudo-inverse
-        sinv[s!=0] = 1/s[s!=0]
-        npars = len(s)
-        dbeta = vt.T @ ((u.T @ (resid*weight))[0:npars]*sinv)
+    if weight is not None:
+        resid = resid * weight
+        jac = jac * weight.reshape(-1,1)
+
+    # Singular Value decomposition (SVD)
+    #  only the first Npars columns of U are ever used, so skip the
+    #  full [Npix,Npix] matrix
+    u,s,vt = np.linalg.svd(jac,full_matrices=False)
+    #u,s,vt = sparse.linalg.svds(jac)
+    # u: [Npix,Npars]
+    # s: [Npars]
+    # vt: [Npars,Npars]
+    # dy: [Npix]
+    sinv = s.copy()*0  # pseudo-inverse
+    sinv[s!=0] = 1/s[s!=0]
+    dbeta = vt.T @ ((u.T @ resid)*sinv)
         
     return dbeta
 
 def cholesky_jac_sparse_solve(jac,resid,weight=None):
-    """ Solve part a non-linear least squares equation using Cholesky decomposition
-        using the Jacobian, with sparse matrices."""
+    """ Solve part a non-linear least squares equation using the sparse
+        Jacobian with the iterative LSMR solver."""
     # jac: Jacobian matrix, first derivatives, [Npix, Npars]
     # resid: residuals [Npix]
 
-    # Precondition??
-
     from scipy import sparse
+    from scipy.sparse.linalg import lsmr
     
-    # Multipy dy and jac by weights
+    # Multipy dy and jac by weights, once
     if weight is not None:
         resid = resid * weight        
         jac = jac * weight.reshape(-1,1)
 
-    if weight is None:
-        # J * x = resid
-        # J.T J x = J.T resid
-        # A = (J.T @ J)
-        # b = np.dot(J.T*dy)
-        # J is [3*Nstar,Npix]
-        # A is [3*Nstar,3*Nstar]
-        jac = sparse.csc_matrix(jac)  # make it sparse
-        A = jac.T @ jac
-        b = jac.T.dot(resid)
-        # Now solve linear least squares with sparse
-        # Ax = b
-        from sksparse.cholmod import cholesky
-        factor = cholesky(A)
-        dbeta = factor(b)
-
-    # multply resid and jac by weights
-    else:
-        wjac = jac * weight.reshape(-1,1)        
-        wjac = sparse.csc_matrix(wjac)  # make it sparse
-        A = wjac.T @ wjac
-        b = wjac.T.dot(resid*weight)
-        # Now solve linear least squares with sparse
-        # Ax = b
-        from sksparse.cholmod import cholesky
-        factor = cholesky(A)
-        dbeta = factor(b)
+    # J * x = resid
+    # LSMR only needs products with J and J.T, so J.T @ J (which fills
+    #  in even when J is sparse) is never formed
+    # J is [Npix,3*Nstar]
+    jac = sparse.csc_matrix(jac)  # make it sparse
+    # Jacobi preconditioner, scale the columns to unit norm
+    colnorm = np.sqrt(np.asarray(jac.multiply(jac).sum(axis=0)).ravel())
+    colnorm[colnorm==0] = 1.0
+    jac = jac @ sparse.diags(1/colnorm)
+    dbeta = lsmr(jac,resid,atol=1e-8,btol=1e-8)[0]
+    dbeta /= colnorm
 
     return dbeta
 
+def sparse_normal_ordering(jac):
+    """ Return a fill-reducing (reverse Cuthill-McKee) ordering of the parameters
+        for the sparse normal equations.  It only depends on the sparsity pattern
+        of the Jacobian, so it can be reused as long as that doesn't change."""
+    from scipy import sparse
+    from scipy.sparse.csgraph import reverse_cuthill_mckee
+    jac = sparse.csc_matrix(jac)
+    pattern = (abs(jac.T) @ abs(jac)).tocsr()
+    return reverse_cuthill_mckee(pattern,symmetric_mode=True)
+
+def sparse_normal_jac_solve(jac,resid,weight=None,perm=None):
+    """ Solve part a non-linear least squares equation using a direct sparse
+        factorization of the normal equations.  PERM is the parameter ordering
+        from sparse_normal_ordering(), so only the numerical factorization is
+        done here.  JAC can be a dense array or a scipy.sparse matrix."""
+    # jac: Jacobian matrix, first derivatives, [Npix, Npars]
+    # resid: residuals [Npix]
+
+    from scipy import sparse
+    from scipy.sparse.linalg import splu
+
+    # Multipy dy and jac by weights, once
+    if weight is not None:
+        resid = resid * weight
+        if sparse.issparse(jac):
+            jac = sparse.diags(weight) @ jac
+        else:
+            jac = jac * weight.reshape(-1,1)
+
+    # J.T J x = J.T resid
+    #  J.T J is [Npars,Npars] and only parameters of stars that
+    #  share pixels couple
+    jac = sparse.csc_matrix(jac)
+    A = (jac.T @ jac).tocsc()
+    b = jac.T @ resid
+    if perm is None:
+        perm = sparse_normal_ordering(jac)
+    # Factor the permuted matrix in that order, no new column ordering
+    Aperm = A[perm,:][:,perm]
+    try:
+        lu = splu(Aperm,permc_spec='NATURAL',diag_pivot_thresh=0.0,
+                  options={'SymmetricMode':True})
+    # Singular matrix, use the iterative solver
+    except RuntimeError:
+        return cholesky_jac_sparse_solve(jac,resid)
+    x = np.zeros(len(b),float)
+    x[perm] = lu.solve(b[perm])
+
+    return x
+
 def kkt_jac_solve(jac,resid,weight=None,maxiter=None):
     """ Solve part a non-linear least squares equation using KKT (Karush-Kuhn-Tucker)
         method with the Jacobian."""
@@ -416,6 +461,14 @@ def cholesky_jac_solve(jac,resid,weight=None):
     # jac: Jacobian matrix, first derivatives, [Npix, Npars]
     # resid: residuals [Npix]
 
+    # Small problems, like groups of up to 8 stars, use the compiled solver,
+    #  it skips the LAPACK call overhead
+    if weight is not None and jac.shape[1]<=25:
+        from .utils_numba import cholesky_jac_solve as nb_cholesky_jac_solve
+        x,good = nb_cholesky_jac_solve(jac,resid,weight)
+        if good:
+            return x
+
     if weight is None:
         # J * x = resid
         # J.T J x = J.T resid
@@ -458,8 +511,14 @@ def cholesky_solve(A,b):
     #x = scipy.linalg.solve_triangular(Lstar,y)
 
     # this gives better results, not sure why
-    c, low = scipy.linalg.cho_factor(A)
-    x = scipy.linalg.cho_solve((c, low), b)
+    #  Call LAPACK directly, the checks and copies in cho_factor/cho_solve
+    #  cost more than the factorization for our small matrices.
+    #  A is symmetric, so A.T is the Fortran-ordered version of it.
+    #  Don't overwrite A, cholesky_jac_solve falls back to LU with it.
+    c, info = dpotrf(A.T, lower=1, clean=0)
+    if info != 0:
+        raise np.linalg.LinAlgError('Matrix is not positive definite')
+    x, info = dpotrs(c, b, lower=1)
     
     return x
 
@@ -488,8 +547,11 @@ def lu_jac_solve(jac,resid,weight=None):
 def lu_solve(A,b):
     """ Solve linear least squares problem with LU decomposition."""
 
-    lu, piv = scipy.linalg.lu_factor(A)
-    x = scipy.linalg.lu_solve((lu, piv), b)
+    # Call LAPACK directly, skips the checks in lu_factor/lu_solve
+    lu, piv, info = dgetrf(A)
+    if info < 0:
+        raise ValueError('Illegal value in LU factorization')
+    x, info = dgetrs(lu, piv, b)
     
     # Solve by two back substitution problems
     # Ax = b
@@ -544,8 +606,8 @@ def jac_covariance(jac,resid,wt=None):
     #   J.T * W * J
     #   where W = I/sig_i**2
     if wt is not None:
-        wt2 = wt.reshape(-1,1) + np.zeros(npars)
-        hess = jac.T @ (wt2 * jac)
+        #   broadcast the weights instead of tiling them to [Npix,Npars]
+        hess = jac.T @ (jac * wt.reshape(-1,1))
     else:
         hess = jac.T @ jac  # not weighted
 
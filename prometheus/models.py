@@ -2859,6 +2859,62 @@ class PSFBase:
         else:
             return jac
     
+    def jac_batch(self,x,y,starid,starpars,retmodel=False):
+        """
+        Method to return the Jacobian for the pixels of many stars at once.
+
+        Parameters
+        ----------
+        x : numpy array
+            Flat array of X values of the pixels of all the stars.
+        y : numpy array
+            Flat array of Y values of the pixels of all the stars.
+        starid : numpy array
+            Index into STARPARS of the star that each pixel belongs to.
+        starpars : numpy array
+            [Nstars,3] array of the [amp, xcen, ycen] of each star.
+        retmodel : boolean, optional
+            Return the model as well.  Default is retmodel=False.
+
+        Returns
+        -------
+        if retmodel==False
+        jac : numpy array
+          Jacobian matrix of partial derivatives [N,3] with respect
+            to each pixel's own star's [amp, xcen, ycen].
+        model : numpy array
+          Array of (1-D) model values for the input pixels.
+          If retmodel==True, then (model,jac) are returned.
+
+        Example
+        -------
+
+        jac = psf.jac_batch(x,y,starid,starpars)
+
+        """
+        starpars = np.asarray(starpars)
+        # Analytic models without a lookup table are evaluated for all
+        #  pixels at once with per-pixel stellar parameters
+        if not self.binned and not self.haslookup and isinstance(self,PSFEmpirical) is False:
+            pixpars = starpars[starid]
+            inpars = [pixpars[:,0],pixpars[:,1],pixpars[:,2]]+list(self.params)
+            m,deriv = self.evaluate(x,y,inpars,deriv=True,nderiv=3)
+            jac = np.array(deriv).T
+            # Mask any corner pixels
+            rr = np.sqrt((x-pixpars[:,1])**2+(y-pixpars[:,2])**2)
+            m[rr>self.radius] = 0
+        # Otherwise loop over the stars
+        else:
+            m = np.zeros(len(x),float)
+            jac = np.zeros((len(x),3),float)
+            for i in np.unique(starid):
+                ind, = np.where(starid==i)
+                m[ind],jac[ind,:] = self.jac((x[ind],y[ind]),*starpars[i],retmodel=True)
+        if retmodel:
+            return m,jac
+        else:
+            return jac
+        
     def modelall(self,xdata,*args,**kwargs):
         """ Convenience function to use with curve_fit() to fit all parameters of a single stellar profile."""
         # PARS should be [amp,x0,y0,sky, model parameters]
@@ -3374,7 +3430,7 @@ class PSFBase:
         Returns
         -------
         resid : numpy array
-           Three-dimension cube (Npix,Npix,Nstars) of the star images with the
+           Three-dimension cube (Nstars,Npix,Npix) of the star images with the
              best-fitting PSF model subtracted.
 
         Example
@@ -3388,7 +3444,7 @@ class PSFBase:
         nstars = len(cat)
         npix = self.npix
         nhpix = npix//2
-        resid = np.zeros((npix,npix,nstars),float)
+        resid = np.zeros((nstars,npix,npix),float,order='F')
         xx,yy = np.meshgrid(np.arange(npix)-nhpix,np.arange(npix)-nhpix)
         rr = np.sqrt(xx**2+yy**2)        
         x = xx[0,:]
@@ -3420,7 +3476,7 @@ class PSFBase:
             # Get model
             model = self(pars=[1.0,0.0,0.0],bbox=[[-nhpix,nhpix+1],[-nhpix,nhpix+1]])
             # Stuff it into 3D array
-            resid[:,:,i] = im2-model
+            resid[i] = im2-model
         return resid
             
     def __str__(self):
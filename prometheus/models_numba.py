@@ -2510,6 +2510,316 @@ def amodel2d(x,y,psftype,pars,nderiv):
         print('psftype=',psftype,'not supported')
         return
 
+@njit(parallel=True,cache=True)
+def amodel2d_batch(x,y,ndata,psftype,allpars,nderiv,model,deriv):
+    """
+    Two dimensional model function for many stars at once.  The stars
+    are computed in parallel.
+
+    Parameters
+    ----------
+    x : numpy array
+      [Nstars,Maxpix] array of X-values.  Only the first ndata[i] values
+        of each row are used.
+    y : numpy array
+      [Nstars,Maxpix] array of Y-values.
+    ndata : numpy array
+      Number of pixels for each star.
+    psftype : int
+      Type of PSF model: 1-gaussian, 2-moffat, 3-penny, 4-gausspow, 5-sersic.
+    allpars : numpy array
+      [Nstars,Npars] array of the parameters of each star.
+    nderiv : int
+       The number of derivatives to return.
+    model : numpy array
+      [Nstars,Maxpix] output array of the models.  Updated in place.
+    deriv : numpy array
+      [Nstars,Maxpix,Nd] output array of the derivatives.  Updated in
+        place, only used if nderiv>0.  If Nd<nderiv only the last Nd
+        derivatives are kept, e.g. the PSF shape parameters.
+
+    Example
+    -------
+
+    amodel2d_batch(x,y,ndata,1,allpars,0,model,deriv)
+
+    """
+    nstars = len(ndata)
+    nd = deriv.shape[2]
+    for i in numba.prange(nstars):
+        n1 = ndata[i]
+        g,d = amodel2d(x[i,:n1],y[i,:n1],psftype,allpars[i],nderiv)
+        model[i,:n1] = g
+        if nderiv>0:
+            deriv[i,:n1,:] = d[:,nderiv-nd:]
+
+@njit(parallel=True,cache=True)
+def chisq2d_batch(x,y,imdata,errdata,ndata,psftype,allpars):
+    """
+    Chi-squared of the 2D models of many stars against their data.  The
+    stars are computed in parallel and each star's model is only kept
+    while its chi-squared is accumulated.
+
+    Parameters
+    ----------
+    x : numpy array
+      [Nstars,Maxpix] array of X-values.  Only the first ndata[i] values
+        of each row are used.
+    y : numpy array
+      [Nstars,Maxpix] array of Y-values.
+    imdata : numpy array
+      [Nstars,Maxpix] array of the flux values.
+    errdata : numpy array
+      [Nstars,Maxpix] array of the flux uncertainties.
+    ndata : numpy array
+      Number of pixels for each star.
+    psftype : int
+      Type of PSF model: 1-gaussian, 2-moffat, 3-penny, 4-gausspow, 5-sersic.
+    allpars : numpy array
+      [Nstars,Npars] array of the parameters of each star.
+
+    Returns
+    -------
+    chisq : float
+      The total chi-squared of all the stars.
+
+    Example
+    -------
+
+    chisq = chisq2d_batch(x,y,imdata,errdata,ndata,1,allpars)
+
+    """
+    nstars = len(ndata)
+    starchisq = np.zeros(nstars,float)
+    for i in numba.prange(nstars):
+        n1 = ndata[i]
+        g,d = amodel2d(x[i,:n1],y[i,:n1],psftype,allpars[i],0)
+        chisq1 = 0.0
+        for k in range(n1):
+            r = (imdata[i,k]-g[k])/errdata[i,k]
+            chisq1 += r*r
+        starchisq[i] = chisq1
+    return np.sum(starchisq)
+
+@njit(parallel=True,cache=True)
+def amodel2d_flat(x,y,offsets,dostars,psftype,allpars,nderiv,model,deriv):
+    """
+    Two dimensional model function for many stars whose pixels are
+    concatenated into flat arrays.  Star i uses the pixels
+    offsets[i]:offsets[i+1].  The stars are computed in parallel.
+
+    Parameters
+    ----------
+    x : numpy array
+      Flat array of X-values of all the stars.
+    y : numpy array
+      Flat array of Y-values of all the stars.
+    offsets : numpy array
+      [Nstars+1] array of the start of each star's pixels in x/y.
+    dostars : numpy array
+      Indices of the stars to compute.  The other stars are left untouched.
+    psftype : int
+      Type of PSF model: 1-gaussian, 2-moffat, 3-penny, 4-gausspow, 5-sersic.
+    allpars : numpy array
+      [Nstars,Npars] array of the parameters of each star.
+    nderiv : int
+       The number of derivatives to return.
+    model : numpy array
+      Flat output array of the models.  Updated in place.
+    deriv : numpy array
+      [Npix,nderiv] flat output array of the derivatives.  Updated in
+        place, only used if nderiv>0.
+
+    Example
+    -------
+
+    amodel2d_flat(x,y,offsets,dostars,1,allpars,3,model,deriv)
+
+    """
+    for k in numba.prange(len(dostars)):
+        i = dostars[k]
+        lo = offsets[i]
+        hi = offsets[i+1]
+        g,d = amodel2d(x[lo:hi],y[lo:hi],psftype,allpars[i],nderiv)
+        model[lo:hi] = g
+        if nderiv>0:
+            deriv[lo:hi,:] = d
+
+@njit(parallel=True,cache=True)
+def amodel2d_addflat(x,y,offsets,ravelindex,dostars,psftype,allpars,radius,image):
+    """
+    Add the models of many stars to a flat image.  The pixels of the stars
+    are concatenated into flat arrays and star i uses the pixels
+    offsets[i]:offsets[i+1].  The models are computed in parallel and
+    then added to the image in one pass.
+
+    Parameters
+    ----------
+    x : numpy array
+      Flat array of X-values of all the stars.
+    y : numpy array
+      Flat array of Y-values of all the stars.
+    offsets : numpy array
+      [Nstars+1] array of the start of each star's pixels in x/y.
+    ravelindex : numpy array
+      Flat array of the 1D image index of each pixel.
+    dostars : numpy array
+      Indices of the stars to add.
+    psftype : int
+      Type of PSF model: 1-gaussian, 2-moffat, 3-penny, 4-gausspow, 5-sersic.
+    allpars : numpy array
+      [Nstars,Npars] array of the parameters of each star.
+    radius : float
+      PSF radius, the models are zero beyond it.
+    image : numpy array
+      Flat (raveled) image to add the models to.  Updated in place.
+
+    Example
+    -------
+
+    amodel2d_addflat(x,y,offsets,ravelindex,dostars,1,allpars,7.0,image)
+
+    """
+    model = np.zeros(len(x),float)
+    for k in numba.prange(len(dostars)):
+        i = dostars[k]
+        lo = offsets[i]
+        hi = offsets[i+1]
+        g,_ = amodel2d(x[lo:hi],y[lo:hi],psftype,allpars[i],0)
+        g[(x[lo:hi]-allpars[i,1])**2+(y[lo:hi]-allpars[i,2])**2 > radius**2] = 0
+        model[lo:hi] = g
+    # Stars can overlap, add them serially
+    for k in range(len(dostars)):
+        i = dostars[k]
+        for j in range(offsets[i],offsets[i+1]):
+            image[ravelindex[j]] += model[j]
+
+@njit(parallel=True,cache=True)
+def starfit_flat(x,y,flux,err,offsets,psftype,psfparams,radius,initpars,bounds,maxsteps,
+                 niter,minpercdiff,outpars,outerror,outchisq,outrms,outniter):
+    """
+    Fit the amplitude, center and sky of many isolated stars with a fixed
+    PSF shape.  The pixels of the stars are concatenated into flat arrays
+    and star i uses the pixels offsets[i]:offsets[i+1].  The stars are fit
+    in parallel, each with the same iterations as the PSF fit() method:
+    weighted least-squares steps with a three-point line search that are
+    limited by the bounds and maximum steps.
+
+    Parameters
+    ----------
+    x : numpy array
+      Flat array of X-values of all the stars.
+    y : numpy array
+      Flat array of Y-values of all the stars.
+    flux : numpy array
+      Flat array of flux values.
+    err : numpy array
+      Flat array of uncertainties.
+    offsets : numpy array
+      [Nstars+1] array of the start of each star's pixels in x/y.
+    psftype : int
+      Type of PSF model: 1-gaussian, 2-moffat, 3-penny, 4-gausspow, 5-sersic.
+    psfparams : numpy array
+      PSF model parameters.
+    radius : float
+      PSF radius, the models are zero beyond it.
+    initpars : numpy array
+      [Nstars,4] initial amp, xcen, ycen and sky.
+    bounds : numpy array
+      [Nstars,2,4] lower and upper bounds of the parameters.
+    maxsteps : numpy array
+      [Nstars,4] maximum steps of the parameters.
+    niter : int
+      Maximum number of iterations.
+    minpercdiff : float
+      Minimum percent change in the parameters to allow until the solution
+        is considered converged.
+    outpars : numpy array
+      [Nstars,4] output best-fit parameters.
+    outerror : numpy array
+      [Nstars,4] output parameter uncertainties.
+    outchisq : numpy array
+      [Nstars] output reduced chi-squared.
+    outrms : numpy array
+      [Nstars] output RMS of the residuals as a fraction of the amplitude.
+    outniter : numpy array
+      [Nstars] output number of iterations.
+
+    Example
+    -------
+
+    starfit_flat(x,y,flux,err,offsets,1,psfparams,radius,initpars,bounds,maxsteps,3,0.5,
+                 outpars,outerror,outchisq,outrms,outniter)
+
+    """
+    nstars = len(offsets)-1
+    npsfpars = len(psfparams)
+    alphas = np.array([0.0,0.5,1.0])
+    for i in numba.prange(nstars):
+        lo = offsets[i]
+        hi = offsets[i+1]
+        npix = hi-lo
+        x1 = x[lo:hi]
+        y1 = y[lo:hi]
+        flux1 = flux[lo:hi]
+        err1 = err[lo:hi]
+        wt1 = 1.0/np.maximum(err1,1)**2
+        allpars = np.zeros(3+npsfpars,float)
+        allpars[3:] = psfparams
+        bestpar = initpars[i].copy()
+        jac = np.ones((npix,4),float)   # the sky column is all ones
+        m = np.zeros(npix,float)
+        count = 0
+        maxpercdiff = 1e10
+        while (count<niter and maxpercdiff>minpercdiff):
+            allpars[:3] = bestpar[:3]
+            g,d = amodel2d(x1,y1,psftype,allpars,3)
+            g[(x1-bestpar[1])**2+(y1-bestpar[2])**2 > radius**2] = 0
+            m = g+bestpar[3]
+            jac[:,:3] = d
+            dy = flux1-m
+            # Weighted least-squares step
+            dbeta = np.linalg.lstsq(jac*wt1.reshape(-1,1),dy*wt1)[0]
+            for k in range(4):
+                if np.isfinite(dbeta[k])==False:
+                    dbeta[k] = 0.0
+            # Line search, quadratic through the chisq at 0, 0.5 and 1 of the step
+            chisqs = np.zeros(3,float)
+            chisqs[0] = np.sum(dy**2 * wt1)
+            for k in range(1,3):
+                pars1 = bestpar+alphas[k]*dbeta
+                allpars[:3] = pars1[:3]
+                g1,_ = amodel2d(x1,y1,psftype,allpars,0)
+                g1[(x1-pars1[1])**2+(y1-pars1[2])**2 > radius**2] = 0
+                chisqs[k] = np.sum((flux1-g1-pars1[3])**2 * wt1)
+            alpha = utils.quadratic_bisector(alphas,chisqs)
+            if np.isfinite(alpha)==False:
+                alpha = 1.0
+            alpha = min(max(alpha,0.0),1.0)
+            # Update parameters
+            oldpar = bestpar.copy()
+            bestpar = utils.newpars(bestpar,alpha*dbeta,bounds[i],maxsteps[i])
+            # Check differences and changes
+            diff = np.abs(bestpar-oldpar)
+            percdiff = diff/np.maximum(np.abs(oldpar),0.0001)*100
+            percdiff[1:3] = diff[1:3]*100   # x/y
+            maxpercdiff = np.max(percdiff)
+            count += 1
+        # Final model and jacobian
+        allpars[:3] = bestpar[:3]
+        g,d = amodel2d(x1,y1,psftype,allpars,3)
+        g[(x1-bestpar[1])**2+(y1-bestpar[2])**2 > radius**2] = 0
+        model = g+bestpar[3]
+        jac[:,:3] = d
+        # The covariance uses the residuals of the last iteration, like fit()
+        cov = utils.jac_covariance(jac,flux1-m,wt1)
+        for k in range(4):
+            outpars[i,k] = bestpar[k]
+            outerror[i,k] = np.sqrt(cov[k,k])
+        outchisq[i] = np.sum((flux1-model)**2/err1**2)/npix
+        outrms[i] = np.sqrt(np.mean(((flux1-model)/bestpar[0])**2))
+        outniter[i] = count
+
 @njit(cache=True)
 def model2d_flux(psftype,pars):
     """
@@ -2946,6 +3256,52 @@ def relcoord(x,y,shape):
     rely = (y-midpt[0])/shape[0]*2
     return relx,rely
 
+@njit(cache=True)
+def empiricalsample(data3d,coeff,dx,dy,g,gxplus=None,gyplus=None,xoff=0.01,yoff=0.01):
+    """
+    Sample an empirical PSF lookup table with linear interpolation.  All the
+    terms and the offset positions for the derivatives are computed in one
+    compiled loop over the pixels without any temporary arrays.
+
+    Parameters
+    ----------
+    data3d : numpy array
+       The empirical PSF lookup table with shape (Ny,Nx,psforder+1).
+    coeff : numpy array
+       Coefficients of the lookup table terms.
+    dx : numpy array
+       X-values of the pixels relative to the lookup table.
+    dy : numpy array
+       Y-values of the pixels relative to the lookup table.
+    g : numpy array
+       Output array for the (unit amplitude) model, the values are added.
+    gxplus : numpy array, optional
+       Output array for the model offset by -xoff in X, the values are added.
+    gyplus : numpy array, optional
+       Output array for the model offset by -yoff in Y, the values are added.
+    xoff : float, optional
+       X offset for the derivatives.  Default is 0.01.
+    yoff : float, optional
+       Y offset for the derivatives.  Default is 0.01.
+
+    Example
+    -------
+
+    empiricalsample(data3d,coeff,dx,dy,g,gxplus,gyplus)
+
+    """
+    npix = len(dx)
+    npsforder = data3d.shape[2]
+    deriv = gxplus is not None and gyplus is not None
+    for i in range(npsforder):
+        data1 = data3d[:,:,i]
+        c = coeff[i]
+        for j in range(npix):
+            g[j] += utils.linearinterp(data1,dx[j],dy[j]) * c
+            if deriv:
+                gxplus[j] += utils.linearinterp(data1,dx[j]-xoff,dy[j]) * c
+                gyplus[j] += utils.linearinterp(data1,dx[j],dy[j]-yoff) * c
+
 @njit(cache=True)
 def empirical(x, y, pars, data, imshape=None, deriv=False):
     """
@@ -3040,17 +3396,9 @@ def empirical(x, y, pars, data, imshape=None, deriv=False):
         gyplus = np.zeros(npix,float)        
         xoff = 0.01
         yoff = 0.01
-    for i in range(npsforder):
-        # spline is initialized with x,y, z(Nx,Ny)
-        # and evaluated with f(x,y)
-        # since we are using im(Ny,Nx), we have to evalute with f(y,x)
-        g[:] += utils.alinearinterp(data3d[:,:,i],dx,dy) * coeff[i]
-        #g += farr[i](dy,dx,grid=False) * coeff[i]
-        if deriv:
-            gxplus[:] += utils.alinearinterp(data3d[:,:,i],dx-xoff,dy) * coeff[i]
-            gyplus[:] += utils.alinearinterp(data3d[:,:,i],dx,dy-yoff) * coeff[i]
-            #gxplus += farr[i](dy,dx-xoff,grid=False) * coeff[i]
-            #gyplus += farr[i](dy-yoff,dx,grid=False) * coeff[i]
+        empiricalsample(data3d,coeff,dx,dy,g,gxplus,gyplus,xoff,yoff)
+    else:
+        empiricalsample(data3d,coeff,dx,dy,g)
     g *= amp
     if deriv:
         gxplus *= amp
@@ -697,9 +697,6 @@ def getpsf_tests():
     out = gnb.starbbox((5.5,6.5),(1000,1000),5.6)
     print('getpsf_numba.starbbox() okay')
 
-    #out = gnb.sliceinsert(array,lo,insert)
-    #print('getpsf_numba.sliceinsert() okay')
-
     out = gnb.getstar(image,error,xcen,ycen,fitradius)
     print('getpsf_numba.getstar() okay')
 
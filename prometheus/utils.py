@@ -128,16 +128,18 @@ def estimatefwhm(objects,verbose=False):
 
     return medfwhm
 
-def neighbors(objects,nnei=1):
-    """ Find the closest neighbors to a star."""
+def neighbors(objects,nnei=1,kdt=None):
+    """ Find the closest neighbors to a star.  A KD-tree already built
+        on the object x/y coordinates can be input with kdt."""
 
     # Returns distance and index of closest neighbor
     
     # Use KD-tree
     X = np.vstack((objects['x'].data,objects['y'].data)).T
-    kdt = cKDTree(X)
-    # Get distance for 2 closest neighbors
-    dist, ind = kdt.query(X, k=nnei+1)
+    if kdt is None:
+        kdt = cKDTree(X)
+    # Get distance for 2 closest neighbors, query with all cores
+    dist, ind = kdt.query(X, k=nnei+1, workers=-1)
     # closest neighbor is always itself, remove it
     dist = dist[:,1:]
     ind = ind[:,1:]
@@ -147,8 +149,9 @@ def neighbors(objects,nnei=1):
         ind = ind.flatten()
     return dist,ind,magdiff
     
-def pickpsfstars(objects,fwhm,nstars=100,logger=None,verbose=False):
-    """ Pick PSF stars."""
+def pickpsfstars(objects,fwhm,nstars=100,logger=None,verbose=False,kdt=None):
+    """ Pick PSF stars.  A KD-tree of the object x/y coordinates can be
+        input with kdt to avoid rebuilding it."""
 
     print = getprintfunc() # Get print function to be used locally, allows for easy logging   
     
@@ -158,7 +161,7 @@ def pickpsfstars(objects,fwhm,nstars=100,logger=None,verbose=False):
     # -no close neighbors
 
     # Use KD-tree to figure out closest neighbors
-    neidist,neiind,neimagdiff = neighbors(objects)
+    neidist,neiind,neimagdiff = neighbors(objects,kdt=kdt)
 
     # Select good sources
     si = np.argsort(objects['magerr_auto'])
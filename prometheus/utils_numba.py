@@ -323,6 +323,115 @@ def mad3d(data, axis=-1, func=None, ignore_nan=True, zero=False):
             result = median3d(np.abs(data),axis=axis)
     return result * 1.482602218505602
 
+@njit(cache=True)
+def insertsort(data,n):
+    """ Sort the first n elements of a small array in place."""
+    for i in range(1,n):
+        val = data[i]
+        j = i-1
+        while j>=0 and data[j]>val:
+            data[j+1] = data[j]
+            j -= 1
+        data[j+1] = val
+
+@njit(parallel=True,cache=True)
+def nanmedmad3d(data):
+    """
+    Median and MAD along the first axis of a 3D array ignoring NaNs.
+    The pixels are done in parallel and each one sorts a small local
+    buffer, which is much faster than median3d() and mad3d() for the
+    short star axis of a PSF cube.
+    """
+    nz,ny,nx = data.shape
+    med = np.zeros((ny,nx),float)
+    sig = np.zeros((ny,nx),float)
+    for i in numba.prange(ny):
+        buf = np.zeros(nz,float)
+        for j in range(nx):
+            n = 0
+            for k in range(nz):
+                if np.isfinite(data[k,i,j]):
+                    buf[n] = data[k,i,j]
+                    n += 1
+            if n==0:
+                med[i,j] = np.nan
+                sig[i,j] = np.nan
+                continue
+            insertsort(buf,n)
+            if n % 2 == 1:
+                med1 = buf[n//2]
+            else:
+                med1 = 0.5*(buf[n//2-1]+buf[n//2])
+            for k in range(n):
+                buf[k] = np.abs(buf[k]-med1)
+            insertsort(buf,n)
+            if n % 2 == 1:
+                mad1 = buf[n//2]
+            else:
+                mad1 = 0.5*(buf[n//2-1]+buf[n//2])
+            med[i,j] = med1
+            sig[i,j] = mad1 * 1.482602218505602
+    return med,sig
+
+@njit(parallel=True,cache=True)
+def sigclipmean_flat(data,offsets,sigma=3.0,maxiters=5):
+    """
+    Sigma-clipped mean of many sets of values concatenated into one flat
+    array.  Set i is data[offsets[i]:offsets[i+1]].  Each set is clipped
+    around its median using the MAD, like astropy's sigma_clipped_stats()
+    with stdfunc=mad, until no more values are rejected.  The sets are
+    done in parallel.  Empty sets give NaN.
+    """
+    nsets = len(offsets)-1
+    out = np.zeros(nsets,float)
+    for i in numba.prange(nsets):
+        buf = data[offsets[i]:offsets[i+1]].copy()
+        n = len(buf)
+        for it in range(maxiters):
+            if n==0:
+                break
+            med = np.median(buf[:n])
+            sig = np.median(np.abs(buf[:n]-med)) * 1.482602218505602
+            lo = med-sigma*sig
+            hi = med+sigma*sig
+            m = 0
+            for k in range(n):
+                if buf[k]>=lo and buf[k]<=hi:
+                    buf[m] = buf[k]
+                    m += 1
+            if m==n:
+                break
+            n = m
+        if n==0:
+            out[i] = np.nan
+        else:
+            out[i] = np.mean(buf[:n])
+    return out
+
+@njit(cache=True)
+def partmedian(data):
+    """ Median of a 1D array using an O(N) partition instead of a full sort."""
+    n = data.size
+    part = np.partition(data,n//2)
+    med = part[n//2]
+    if n % 2 == 0:
+        med = 0.5*(med+np.max(part[:n//2]))
+    return med
+
+@njit(cache=True)
+def nanmedmad(data):
+    """
+    Median and MAD of a 1D array ignoring NaNs.  Both use partition-based
+    selection, so this is cheaper than calling median() and mad() separately.
+    """
+    data1d = data.ravel()
+    data1d = data1d[np.isfinite(data1d)]
+    if data1d.size==0:
+        return np.nan,np.nan
+    med = partmedian(data1d)
+    sig = partmedian(np.abs(data1d-med)) * 1.482602218505602
+    return med,sig
+
 @njit(cache=True)
 def quadratic_bisector(x,y):
     """ Calculate the axis of symmetric or bisector of parabola"""
@@ -332,11 +441,30 @@ def quadratic_bisector(x,y):
     n = len(x)
     if n<3:
         return None
-    Sxx = np.sum(x**2) - np.sum(x)**2/n
-    Sxy = np.sum(x*y) - np.sum(x)*np.sum(y)/n
-    Sxx2 = np.sum(x**3) - np.sum(x)*np.sum(x**2)/n
-    Sx2y = np.sum(x**2 * y) - np.sum(x**2)*np.sum(y)/n
-    Sx2x2 = np.sum(x**4) - np.sum(x**2)**2/n
+    # Accumulate all of the sums in a single pass
+    sx = 0.0
+    sx2 = 0.0
+    sx3 = 0.0
+    sx4 = 0.0
+    sy = 0.0
+    sxy = 0.0
+    sx2y = 0.0
+    for i in range(n):
+        xi = x[i]
+        yi = y[i]
+        xi2 = xi*xi
+        sx += xi
+        sx2 += xi2
+        sx3 += xi2*xi
+        sx4 += xi2*xi2
+        sy += yi
+        sxy += xi*yi
+        sx2y += xi2*yi
+    Sxx = sx2 - sx**2/n
+    Sxy = sxy - sx*sy/n
+    Sxx2 = sx3 - sx*sx2/n
+    Sx2y = sx2y - sx2*sy/n
+    Sx2x2 = sx4 - sx2**2/n
     #a = ( S(x^2*y)*S(xx)-S(xy)*S(xx^2) ) / ( S(xx)*S(x^2x^2) - S(xx^2)^2 )
     #b = ( S(xy)*S(x^2x^2) - S(x^2y)*S(xx^2) ) / ( S(xx)*S(x^2x^2) - S(xx^2)^2 )
     denom = Sxx*Sx2x2 - Sxx2**2
@@ -598,6 +726,90 @@ def qr_jac_solve(jac,resid,weight=None):
         
     return dbeta
 
+@njit(cache=True)
+def lm_jac_solve(jac,resid,weight=None,damp=0.0):
+    """ Solve part of a non-linear least squares equation with Levenberg-Marquardt
+        damping using QR decomposition of the augmented Jacobian."""
+    # jac: Jacobian matrix, first derivatives, [Npix, Npars]
+    # resid: residuals [Npix]
+    # weight: weights, ~1/error**2 [Npix]
+    # damp: damping factor, 0 is the undamped Gauss-Newton step
+
+    npix,npars = jac.shape
+    # Multiply resid and jac by sqrt(weights), so the solution minimizes
+    #  sum(weight*resid**2), the same chisq the callers use
+    if weight is None:
+        wjac = jac
+        wresid = resid
+    else:
+        sw = np.sqrt(weight)
+        wjac = jac * sw.reshape(-1,1)
+        wresid = resid * sw
+
+    # Marquardt scaling, solve (J.T*J + damp*diag(J.T*J)) dbeta = J.T*resid
+    #  by appending sqrt(damp*diag(J.T*J)) rows to J and zeros to resid
+    jaug = np.zeros((npix+npars,npars),float)
+    jaug[:npix,:] = wjac
+    for i in range(npars):
+        jaug[npix+i,i] = np.sqrt(damp*np.sum(wjac[:,i]**2))
+    raug = np.zeros(npix+npars,float)
+    raug[:npix] = wresid
+    q,r = np.linalg.qr(jaug)
+    # Solve R dbeta = Q.T raug by back substitution, parameters with a
+    #  zero on the diagonal of R (no constraint) get no step
+    qtr = q.T @ raug
+    dbeta = np.zeros(npars,float)
+    for i in range(npars-1,-1,-1):
+        if np.abs(r[i,i])<2e-300:
+            continue
+        sm = qtr[i]
+        for j in range(i+1,npars):
+            sm -= r[i,j]*dbeta[j]
+        dbeta[i] = sm/r[i,i]
+
+    return dbeta
+
+@njit(cache=True)
+def cholesky_jac_solve(jac,resid,weight):
+    """
+    Solve the weighted normal equations with Cholesky decomposition, like
+    leastsquares.cholesky_jac_solve().  This is for small problems where
+    the LAPACK call overhead dominates.  Returns the solution and a flag
+    that is False if the normal matrix is not positive definite.
+    """
+    n = jac.shape[1]
+    # The rows are multiplied by the weights, A = J.T W**2 J
+    wjac = jac.astype(np.float64) * weight.reshape(-1,1)
+    a = wjac.T @ wjac
+    b = wjac.T @ (resid*weight)
+    # Cholesky decomposition A = L L.T, in place in the lower triangle
+    x = np.zeros(n,np.float64)
+    for j in range(n):
+        s = a[j,j]
+        for k in range(j):
+            s -= a[j,k]**2
+        if s<=0 or np.isfinite(s)==False:
+            return x,False
+        a[j,j] = np.sqrt(s)
+        for i in range(j+1,n):
+            s = a[i,j]
+            for k in range(j):
+                s -= a[i,k]*a[j,k]
+            a[i,j] = s/a[j,j]
+    # Solve L y = b by forward substitution
+    for i in range(n):
+        s = b[i]
+        for k in range(i):
+            s -= a[i,k]*x[k]
+        x[i] = s/a[i,i]
+    # Solve L.T x = y by back substitution
+    for i in range(n-1,-1,-1):
+        s = x[i]
+        for k in range(i+1,n):
+            s -= a[k,i]*x[k]
+        x[i] = s/a[i,i]
+    return x,True
+
 
 @njit(cache=True)
 def jac_covariance(jac,resid,wt):
@@ -610,8 +822,8 @@ def jac_covariance(jac,resid,wt):
     #   J.T * W * J
     #   where W = I/sig_i**2
     if wt is not None:
-        wt2 = wt.reshape(-1,1) + np.zeros(npars)
-        hess = jac.T @ (wt2 * jac)
+        #   broadcast the weights instead of tiling them to [Npix,Npars]
+        hess = jac.T @ (jac * wt.reshape(-1,1))
     else:
         hess = jac.T @ jac  # not weighted
 
@@ -939,7 +1151,60 @@ def crossmatch(X1, X2, max_distance=np.inf,k=1):
     dist, ind, neigh = kdt.query(X1, k=k, distance_upper_bound=max_distance)
 
     return dist, ind
-    
+
+@njit(cache=True)
+def pairgroups(n,pairs):
+    """
+    Find the groups of objects that are linked by pairs, directly or through
+    other objects (friends-of-friends), with union-find.
+
+    Parameters
+    ----------
+    n : int
+       Number of objects.
+    pairs : numpy array
+       [Npairs,2] array of the indices of linked objects.
+
+    Returns
+    -------
+    groupid : numpy array
+       Group ID of each object, starting at 1 in the order of the objects.
+
+    Example
+    -------
+
+    groupid = pairgroups(n,pairs)
+
+    """
+    parent = np.arange(n)
+    for k in range(len(pairs)):
+        # Find the roots, with path halving
+        i = pairs[k,0]
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        j = pairs[k,1]
+        while parent[j] != j:
+            parent[j] = parent[parent[j]]
+            j = parent[j]
+        # The lowest index is the root of the merged group
+        if i < j:
+            parent[j] = i
+        elif j < i:
+            parent[i] = j
+    # The root comes before all the other objects in its group
+    groupid = np.zeros(n,np.int64)
+    ngroups = 0
+    for i in range(n):
+        r = i
+        while parent[r] != r:
+            r = parent[r]
+        if groupid[r]==0:
+            ngroups += 1
+            groupid[r] = ngroups
+        groupid[i] = groupid[r]
+    return groupid
+
 
 # from astroML, modified by D. Nidever
 @njit(cache=True)